@@ -0,0 +1,252 @@
+"""
+Batch mode: search many observations through one shared executor
+
+    python batch_pipeline.py [--executor NAME] [--workers N] [--outdir DIR] OBS[:MASK] ...
+
+Each OBS may be a glob, e.g. 'night1/*.fits', and a mask file is given
+after a colon. Every observation gets its own working directory,
+<outdir>/<name>/subbands, laid out as mpi_pipeline_py3.py lays out its
+own (the observation and mask are linked into <outdir>/<name>), with its
+own manifest and logs.
+
+All observations share one StreamScheduler. prepsubband, realfft and
+accelsearch are chained per .dat as in the pipeline's streaming mode, an
+observation is sifted once its searches are done, and its candidates
+are folded after that, highest sigma first, each published to the
+observation's results.jsonl as it finishes (see results.py). The
+executor holds a couple of tasks per worker, filled round-robin over the
+observations in progress, so a long observation cannot starve the
+others, and the cores stay busy through the tail of each one.
+
+Tasks change directory on their worker, so the backend must be process,
+mpi, queue or serial.
+"""
+import os, sys, glob
+from operator import itemgetter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from mpi_pipeline_py3 import (read_header, dedispersion_plan, DDPLAN_PLOT, dedisperse_tasks, dedisperse_outputs,
+                              realfft, accelsearch, prepfold, ACCEL_sift, fold_task, fold_prefix, zmax)
+from executor import get_executor, parse_args, in_dir
+from scheduler import StreamScheduler
+from manifest import Manifest
+from results import ResultsIndex, by_sigma
+from failures import FailureReport
+
+WINDOW_PER_WORKER = 2 #Tasks in the executor per worker; the rest wait for their observation's turn
+MAX_ACTIVE = 8 #Observations in progress at once; the next one starts when one finishes
+STAGES = ('dedisperse', 'fft', 'accelsearch', 'sifting', 'folding')
+
+
+def parse_observations(args):
+    '''
+    (filename, maskfile, name) for every OBS[:MASK] argument, with globs
+    expanded. name is the observation's directory under outdir: its file
+    name without the extension, or, for files of the same name, its path
+    below their common directory, e.g. night1_obs for night1/obs.fits.
+    '''
+    observations = []
+    for arg in args:
+        pattern, _, maskfile = arg.partition(':')
+        for filename in sorted(glob.glob(pattern)) or [pattern]:
+            observations.append((os.path.abspath(filename), os.path.abspath(maskfile) if maskfile else None))
+    stems = {}
+    for filename, maskfile in observations:
+        stems.setdefault(os.path.splitext(os.path.basename(filename))[0], []).append(filename)
+    named = []
+    names = {}
+    for filename, maskfile in observations:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if len(stems[name]) > 1:
+            common = os.path.commonpath([os.path.dirname(f) for f in stems[name]])
+            name = os.path.splitext(os.path.relpath(filename, common))[0].replace(os.sep, '_')
+        if name in names:
+            raise ValueError('%s and %s would share the directory %s' % (names[name], filename, name))
+        names[name] = filename
+        named.append((filename, maskfile, name))
+    return named
+
+
+def sift(zmax):
+    # ACCEL_sift as a scheduler task: (output, stdout, cands)
+    cands = ACCEL_sift(zmax)
+    return '', 'sifted %d candidates\n' % len(cands), cands
+
+
+def symlink(src, dst):
+    if not os.path.lexists(dst):
+        os.symlink(src, dst)
+
+
+class Observation(object):
+    '''One observation's working directory, manifest and logs.'''
+
+    def __init__(self, filename, maskfile, outdir, name):
+        self.name = name
+        self.obsdir = os.path.abspath(os.path.join(outdir, self.name))
+        self.workdir = os.path.join(self.obsdir, 'subbands')
+        if not os.access(self.workdir, os.F_OK):
+            os.makedirs(self.workdir)
+        #prepsubband_f reads '../'+filename and prepfold reads filename, both from workdir
+        self.filename = os.path.basename(filename)
+        symlink(filename, os.path.join(self.obsdir, self.filename))
+        symlink(filename, os.path.join(self.workdir, self.filename))
+        self.maskfile = None
+        if maskfile:
+            self.maskfile = os.path.basename(maskfile)
+            symlink(maskfile, os.path.join(self.obsdir, self.maskfile))
+        self.manifest = Manifest(os.path.join(self.workdir, 'manifest.jsonl'), root=self.workdir)
+        self.results = ResultsIndex(os.path.join(self.workdir, 'results.jsonl'), root=self.workdir)
+        self.logs = dict((stage, open(os.path.join(self.workdir, stage+'.log'), 'wt')) for stage in STAGES)
+        self.stage = 'search'
+
+    def __str__(self):
+        return self.name
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def glob(self, pattern):
+        '''Names (relative to workdir) of the files in workdir matching pattern.'''
+        return [os.path.relpath(f, self.workdir) for f in glob.glob(self.path(pattern))]
+
+    def close(self):
+        self.manifest.close()
+        self.results.close()
+        for logfile in self.logs.values():
+            logfile.close()
+
+
+class Batch(object):
+
+    def __init__(self, executor, failures, observations, outdir):
+        self.failures = failures
+        self.scheduler = StreamScheduler(executor, failures, window=WINDOW_PER_WORKER*executor.workers, idle=self.next_stage)
+        self.observations = list(observations)
+        self.outdir = outdir
+        self.active = 0
+
+    def task(self, obs, function, args, stage, then=None):
+        # a StreamScheduler task running function(*args) in obs's working directory
+        return partial(in_dir, obs.workdir, function), args, obs.logs[stage], then
+
+    def submit(self, obs, tasks):
+        for task in tasks:
+            self.scheduler.submit(*task, group=obs)
+
+    def run(self):
+        while self.observations and self.active < MAX_ACTIVE:
+            self.start_next()
+        self.scheduler.join()
+
+    def start_next(self):
+        filename, maskfile, name = self.observations.pop(0)
+        self.start(Observation(filename, maskfile, self.outdir, name))
+
+    def start(self, obs):
+        print('starting %s' % obs)
+        self.active += 1
+        try:
+            output, header = read_header(obs.path(obs.filename))
+            ddplanout, ddplan = dedispersion_plan(header, os.path.join(obs.obsdir, 'DDplan.ps') if DDPLAN_PLOT else None)
+            Nsamp = int(header['Spectra per file'])
+            tasks = dedisperse_tasks(ddplan, Nsamp, obs.filename, obs.maskfile)
+        except Exception as e:
+            # a truncated file or a missing header key fails just this observation
+            self.failures.add(obs, e)
+            self.finish(obs)
+            return
+        tasks.sort(key=itemgetter(3), reverse=True)
+        for function, dml, datfiles, cost in tasks:
+            if obs.manifest.done('prepsubband:'+datfiles[0]):
+                self.submit(obs, self.after_prepsubband(obs, datfiles, None))
+            else:
+                self.submit(obs, [self.task(obs, function, (dml,), 'dedisperse', partial(self.after_prepsubband, obs, datfiles))])
+        if not self.scheduler.outstanding[obs]:
+            self.next_stage(obs) # nothing left to search
+
+    #Each after_* callback checkpoints its task (result is None if it was
+    #already done) and returns the follow-up tasks still to run
+    def after_prepsubband(self, obs, datfiles, result):
+        if result is not None:
+            obs.manifest.record('prepsubband:'+datfiles[0], result[1], dedisperse_outputs(datfiles))
+        tasks = []
+        for df in datfiles:
+            if not os.access(obs.path(df), os.F_OK):
+                continue
+            if obs.manifest.done('realfft:'+df):
+                tasks.extend(self.after_realfft(obs, df, None))
+            else:
+                tasks.append(self.task(obs, realfft, (df,), 'fft', partial(self.after_realfft, obs, df)))
+        return tasks
+
+    def after_realfft(self, obs, df, result):
+        fftfile = df[:-4]+'.fft'
+        if result is not None:
+            obs.manifest.record('realfft:'+df, result[1], [fftfile])
+        if obs.manifest.done('accelsearch:'+fftfile):
+            return []
+        return [self.task(obs, accelsearch, (fftfile,), 'accelsearch', partial(self.after_accelsearch, obs, fftfile))]
+
+    def after_accelsearch(self, obs, fftfile, result):
+        obs.manifest.record('accelsearch:'+fftfile, result[1], obs.glob(fftfile[:-4]+'_ACCEL_%d*' % zmax))
+        return []
+
+    def after_sift(self, obs, result):
+        cands = by_sigma(obs.manifest.pending(result[2], fold_task))
+        return [self.task(obs, prepfold, (obs.filename, cand), 'folding', partial(self.after_fold, obs, cand)) for cand in cands]
+
+    def after_fold(self, obs, cand, result):
+        outputs = obs.glob(fold_prefix(cand) + '*.pfd*')
+        obs.manifest.record(fold_task(cand), result[1], outputs)
+        obs.results.publish(cand, outputs)
+        return []
+
+    def next_stage(self, obs):
+        # called once obs has no tasks left
+        if obs.stage == 'search':
+            obs.stage = 'fold'
+            for subfile in obs.glob('*.sub*'):
+                os.remove(obs.path(subfile))
+            self.submit(obs, [self.task(obs, sift, (zmax,), 'sifting', partial(self.after_sift, obs))])
+        else:
+            print('finished %s' % obs)
+            self.finish(obs)
+
+    def finish(self, obs):
+        # obs has nothing left to run; its slot goes to the next observation
+        obs.close()
+        self.active -= 1
+        if self.observations:
+            self.start_next()
+
+
+if __name__ == "__main__":
+
+    backend, workers = parse_args(sys.argv)
+    outdir = '.'
+    if '--outdir' in sys.argv:
+        ii = sys.argv.index('--outdir')
+        outdir = sys.argv[ii+1]
+        del sys.argv[ii:ii+2]
+    try:
+        observations = parse_observations(sys.argv[1:])
+    except ValueError as e:
+        sys.exit(str(e))
+    if not os.access(outdir, os.F_OK):
+        os.makedirs(outdir)
+
+    executor = get_executor(backend, workers, wdir=os.getcwd())
+    if isinstance(executor, ThreadPoolExecutor) or hasattr(executor, 'map_tasks'):
+        sys.exit('batch mode changes directory on its workers; use the process, mpi, queue or serial backend')
+
+    failures = FailureReport(os.path.join(outdir, 'failed_tasks.jsonl'))
+    batch = Batch(executor, failures, observations, outdir)
+    batch.run()
+    executor.shutdown(wait = False)
+
+    failures.close()
+    if len(failures):
+        print(failures.summary())
+        sys.exit(1)
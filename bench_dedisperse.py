@@ -0,0 +1,148 @@
+"""
+Dedispersion engines compared on synthetic data
+
+Writes a SIGPROC filterbank of noise with a train of dispersed pulses,
+dedisperses one DDplan-like chunk of it (NDMS trials, one sample of
+delay across the band apart) with prepsubband, when it is on the PATH,
+with dedisp.py and with fdmt.py, and prints the time each took and the
+S/N of the pulses in its series at their DM:
+
+    python bench_dedisperse.py [--nchan N] [--nsamp N] [--ndms N] [--downsamp N]
+"""
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+from subprocess import getoutput
+import numpy as np
+
+import dedisp
+import fdmt
+
+TSAMP = 64e-6 #Seconds per raw sample
+FTOP = 1500.0 #MHz, centre of the highest channel
+BANDWIDTH = 300.0 #MHz
+PULSE_EVERY = 2**15 #Raw samples between pulses
+PULSE_WIDTH = 4 #Raw samples
+PULSE_AMP = 0.5 #Per channel and sample, in units of the noise
+NSUB = 32 #Subbands for dedisp.py when mpi_pipeline_py3.py (and its Nsub) cannot be imported
+ROOTNAME = 'Sband' #Of the .dat names, as the pipeline's
+
+
+def write_filterbank(path, data, tsamp, ftop, foff):
+    '''data (nchan, nspec), highest channel first, as a 32-bit SIGPROC filterbank.'''
+    def string(s):
+        return struct.pack('<i', len(s)) + s.encode()
+    header = [string('HEADER_START'),
+              string('source_name'), string('SYNTHETIC'),
+              string('telescope_id'), struct.pack('<i', 0),
+              string('machine_id'), struct.pack('<i', 0),
+              string('data_type'), struct.pack('<i', 1),
+              string('src_raj'), struct.pack('<d', 0.0),
+              string('src_dej'), struct.pack('<d', 0.0),
+              string('tstart'), struct.pack('<d', 56000.0),
+              string('tsamp'), struct.pack('<d', tsamp),
+              string('nbits'), struct.pack('<i', 32),
+              string('nifs'), struct.pack('<i', 1),
+              string('nchans'), struct.pack('<i', data.shape[0]),
+              string('fch1'), struct.pack('<d', ftop),
+              string('foff'), struct.pack('<d', foff),
+              string('HEADER_END')]
+    with open(path, 'wb') as f:
+        f.write(b''.join(header))
+        data.T.astype('<f4').tofile(f)
+
+
+def channel_freqs(nchan):
+    return FTOP - np.arange(nchan) * (BANDWIDTH / nchan)
+
+
+def synthetic(nchan, nspec, dm, seed=0):
+    '''Noise with a pulse every PULSE_EVERY samples dispersed at dm, highest channel first.'''
+    freqs = channel_freqs(nchan)
+    data = np.random.default_rng(seed).standard_normal((nchan, nspec), dtype=np.float32)
+    delays = np.rint((dedisp.delay_from_dm(dm, freqs) - dedisp.delay_from_dm(dm, FTOP)) / TSAMP).astype(np.int64)
+    for start in range(PULSE_EVERY // 2, nspec - delays.max() - PULSE_WIDTH, PULSE_EVERY):
+        for chan in range(nchan):
+            data[chan, start + delays[chan]:start + delays[chan] + PULSE_WIDTH] += PULSE_AMP
+    return data
+
+
+def snr(series):
+    """Peak S/N of a series, against its median and MAD."""
+    median = np.median(series)
+    sigma = 1.4826 * np.median(np.abs(series - median))
+    return float((series.max() - median) / sigma) if sigma else 0.0
+
+
+def run_prepsubband(pipeline, filename, dml, dDM, NDMs, Nout, subdownsamp, datdownsamp):
+    for cmd in pipeline.prepsubband_cmds(dml[0], dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, None, dml):
+        getoutput(cmd)
+
+
+def bench(nchan, nspec, ndms, downsamp):
+    dt = TSAMP * downsamp
+    freqs = channel_freqs(nchan)
+    dDM = float('%.3f' % (dt / (dedisp.delay_from_dm(1.0, freqs.min()) - dedisp.delay_from_dm(1.0, FTOP))))
+    dms = dedisp.dm_trials(0.0, dDM, ndms)
+    pulse = ndms // 2
+    data = synthetic(nchan, nspec, dms[pulse])
+    dml = np.array(dms)
+    if shutil.which('prepsubband'):
+        # the pipeline needs PRESTO's python package, which comes with prepsubband
+        import mpi_pipeline_py3 as pipeline
+        datfiles = pipeline.dat_names(dml[0], dDM, ndms)
+        nsub = pipeline.Nsub
+    else:
+        pipeline = None
+        datfiles = ['%s_DM%.2f.dat' % (ROOTNAME, dm) for dm in dms]
+        nsub = NSUB
+    Nout = nspec // downsamp
+    Nout -= Nout % 500
+    subdownsamp, datdownsamp = (downsamp // 2, 2) if downsamp >= 2 else (1, 1)
+    filename = 'synthetic.fil'
+
+    engines = [('dedisp.py', lambda: dedisp.dedisperse('../' + filename, dms, datfiles, Nout, nsub, np.mean(dml), subdownsamp, datdownsamp)),
+               ('fdmt.py', lambda: fdmt.dedisperse('../' + filename, dms, datfiles, Nout, downsamp))]
+    if pipeline is not None:
+        engines.insert(0, ('prepsubband', lambda: run_prepsubband(pipeline, filename, dml, dDM, ndms, Nout, subdownsamp, datdownsamp)))
+    else:
+        print('prepsubband is not on the PATH; comparing the in-process engines only')
+
+    print('%d channels, %d samples of %gus, %d DMs from 0 by %g, pulses at DM %.3f, downsampled by %d'
+          % (nchan, nspec, TSAMP * 1e6, ndms, dDM, dms[pulse], downsamp))
+    scratch = tempfile.mkdtemp(prefix='bench_dedisperse_')
+    cwd = os.getcwd()
+    try:
+        write_filterbank(os.path.join(scratch, filename), data, TSAMP, FTOP, -BANDWIDTH / nchan)
+        del data
+        times = {}
+        for name, run in engines:
+            os.makedirs(os.path.join(scratch, name))
+            os.chdir(os.path.join(scratch, name))
+            start = time.time()
+            run()
+            times[name] = time.time() - start
+            os.chdir(cwd)
+
+        print('%-12s %9s %9s %12s' % ('engine', 'seconds', 'DMs/s', 'pulse S/N'))
+        for name, run in engines:
+            series = dedisp.read_dat(os.path.join(scratch, name, datfiles[pulse]))
+            print('%-12s %9.2f %9.1f %12.1f' % (name, times[name], ndms / times[name], snr(series)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+
+    options = {'--nchan': 512, '--nsamp': 2**18, '--ndms': 256, '--downsamp': 1}
+    args = sys.argv[1:]
+    while args:
+        if args[0] not in options or len(args) < 2:
+            sys.exit('usage: python bench_dedisperse.py [--nchan N] [--nsamp N] [--ndms N] [--downsamp N]')
+        options[args[0]] = int(args[1])
+        args = args[2:]
+    bench(options['--nchan'], options['--nsamp'], options['--ndms'], options['--downsamp'])
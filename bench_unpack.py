@@ -0,0 +1,66 @@
+"""
+Throughput of unpack.py
+
+Unpacks a block of random packed spectra into a preallocated float32
+buffer again and again, for each number of bits, with and without a
+scale and offset per channel, and prints GB/s of packed input read and
+of float32 written. The shift-and-mask unpacking the lookup tables
+replace is timed alongside for comparison:
+
+    python bench_unpack.py [--nchan N] [--mb MB] [--repeat N]
+"""
+import sys
+import time
+import numpy as np
+
+from unpack import Unpacker
+
+
+def shift_and_mask(packed, nbits, scale, offset):
+    # one pass per sample in a byte, then the scaling as another pass
+    shifts = np.arange(8 - nbits, -1, -nbits, dtype=np.uint8)
+    samples = ((packed[..., None] >> shifts) & ((1 << nbits) - 1)).reshape(len(packed), -1)
+    return samples.astype(np.float32) * scale + offset
+
+
+def rate(function, nbytes, repeat):
+    """Best GB/s of nbytes over repeat calls of function."""
+    best = None
+    for ii in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return nbytes / best / 1e9
+
+
+def bench(nchan, mb, repeat):
+    rng = np.random.default_rng(0)
+    scale = rng.uniform(0.5, 2.0, nchan).astype(np.float32)
+    offset = rng.uniform(-1.0, 1.0, nchan).astype(np.float32)
+    print('%d channels, %d MB of packed spectra, best of %d' % (nchan, mb, repeat))
+    print('%5s %-8s %12s %12s %14s' % ('bits', 'scaled', 'in GB/s', 'out GB/s', 'shift+mask in'))
+    for nbits in (1, 2, 4, 8):
+        nspec = mb * 2**20 * 8 // (nchan * nbits)
+        packed = rng.integers(0, 256, (nspec, nchan * nbits // 8), dtype=np.uint8)
+        out = np.empty((nspec, nchan), dtype=np.float32)
+        for scaled in (False, True):
+            unpacker = Unpacker(nbits, nchan, scale, offset) if scaled else Unpacker(nbits, nchan)
+            gbs = rate(lambda: unpacker(packed, out), packed.nbytes, repeat)
+            if scaled:
+                naive = rate(lambda: shift_and_mask(packed, nbits, scale, offset), packed.nbytes, repeat)
+            else:
+                naive = rate(lambda: shift_and_mask(packed, nbits, 1.0, 0.0), packed.nbytes, repeat)
+            print('%5d %-8s %12.2f %12.2f %14.2f' % (nbits, scaled, gbs, gbs * out.nbytes / packed.nbytes, naive))
+
+
+if __name__ == "__main__":
+
+    options = {'--nchan': 1024, '--mb': 64, '--repeat': 5}
+    args = sys.argv[1:]
+    while args:
+        if args[0] not in options or len(args) < 2:
+            sys.exit('usage: python bench_unpack.py [--nchan N] [--mb MB] [--repeat N]')
+        options[args[0]] = int(args[1])
+        args = args[2:]
+    bench(options['--nchan'], options['--mb'], options['--repeat'])
@@ -0,0 +1,190 @@
+"""
+Content-addressed result cache for PRESTO tool calls
+
+A tool call is keyed by its normalized command line, the version of the
+tool binary and a fingerprint of each input file. When the same key is
+seen again, the outputs saved from the first run are hardlinked back
+into the working directory instead of rerunning the tool, so rerunning
+an observation after changing only the sifting thresholds or zmax skips
+everything upstream of the change.
+
+Each cache entry is a directory <root>/<key[:2]>/<key> holding the output
+files, the captured tool output (output.log) and meta.json. An entry is
+built in a temporary directory and renamed into place, so concurrent
+workers never see half-written entries. The cache is kept under a size
+limit by evicting the least recently used entries; a hit touches
+meta.json to mark the entry as used. Restored files are links into their
+entry, so on a miss the outputs already in the working directory are
+removed before the tool runs, rather than overwritten in place.
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from resources import getstatusoutput, cache_hit
+
+#Files up to this size are hashed whole; larger ones (the raw data) are sampled
+FULL_HASH_BYTES = 256 * 2**20
+SAMPLE_BYTES = 2**20
+SAMPLES = 16
+#Rescan the whole cache for eviction at least this often (s), to count what other workers stored
+RESCAN_SECONDS = 300
+
+
+class ResultCache(object):
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.versions = {}
+        self.fingerprints = {}
+        self.total = None # bytes at the last scan, plus what this process stored since
+        self.scanned = 0.0
+        if not os.access(root, os.F_OK):
+            os.makedirs(root, exist_ok=True)
+
+    def tool_version(self, tool):
+        """Path, size and mtime of the tool binary; changes when PRESTO is rebuilt."""
+        if tool not in self.versions:
+            path = shutil.which(tool) or tool
+            try:
+                st = os.stat(path)
+                self.versions[tool] = '%s %d %d' % (os.path.realpath(path), st.st_size, st.st_mtime)
+            except OSError:
+                self.versions[tool] = tool
+        return self.versions[tool]
+
+    def fingerprint(self, path):
+        """Hash of the file contents (sampled for large files), memoized per size and mtime."""
+        st = os.stat(path)
+        memo = (os.path.realpath(path), st.st_size, st.st_mtime)
+        if memo not in self.fingerprints:
+            digest = hashlib.sha1(str(st.st_size).encode())
+            with open(path, 'rb') as f:
+                if st.st_size <= FULL_HASH_BYTES:
+                    for block in iter(lambda: f.read(SAMPLE_BYTES), b''):
+                        digest.update(block)
+                else:
+                    step = (st.st_size - SAMPLE_BYTES) // (SAMPLES - 1)
+                    for ii in range(SAMPLES):
+                        f.seek(ii * step)
+                        digest.update(f.read(SAMPLE_BYTES))
+            self.fingerprints[memo] = digest.hexdigest()
+        return self.fingerprints[memo]
+
+    def key(self, cmd, inputs):
+        cmd = ' '.join(cmd.split())
+        digest = hashlib.sha1(cmd.encode())
+        digest.update(self.tool_version(cmd.split()[0]).encode())
+        for path in sorted(inputs):
+            digest.update(('\n%s %s' % (path, self.fingerprint(path))).encode())
+        return digest.hexdigest()
+
+    def getstatusoutput(self, cmd, inputs, outputs, cwd='', call=getstatusoutput):
+        """
+        Same as subprocess.getstatusoutput(cmd), but cached. inputs are the
+        files cmd reads and outputs the glob patterns (relative to the
+        working directory) of the files it writes. Only runs that exit
+        with status 0 are stored. cwd is the directory cmd runs in, if not
+        the working directory, and call(cmd) is what runs it on a miss.
+        """
+        prefix = os.path.join(cwd, '') if cwd else ''
+
+        def matches(patterns):
+            return [f for pattern in patterns for f in glob.glob(os.path.join(cwd, pattern))]
+
+        inputs = matches(inputs)
+        # keyed on the names cmd sees, so a run in another directory finds the same entry
+        key = self.key(cmd, [f[len(prefix):] if prefix and f.startswith(prefix) else f for f in inputs])
+        entry = os.path.join(self.root, key[:2], key)
+        try:
+            output = self.restore(entry, cwd)
+        except (IOError, OSError):
+            pass # miss, or the entry was evicted under us
+        else:
+            cache_hit()
+            return 0, output
+
+        # earlier outputs may be links into cache entries, which the tool would overwrite in place
+        for name in set(matches(outputs)) - set(inputs):
+            os.remove(name)
+        start = time.time() - 1
+        status, output = call(cmd)
+        files = [f for f in matches(outputs) if os.stat(f).st_mtime >= start]
+        if status == 0 and files:
+            size = self.store(entry, cmd, output, files)
+            if self.total is not None:
+                self.total += size
+            # scanning every entry is O(cache size), so only when it may be needed
+            if self.total is None or self.total > self.max_bytes or time.time() - self.scanned > RESCAN_SECONDS:
+                self.evict()
+        return status, output
+
+    def getoutput(self, cmd, inputs, outputs):
+        return self.getstatusoutput(cmd, inputs, outputs)[1]
+
+    def restore(self, entry, cwd=''):
+        with open(os.path.join(entry, 'output.log')) as log:
+            output = log.read()
+        os.utime(os.path.join(entry, 'meta.json'))
+        filesdir = os.path.join(entry, 'files')
+        for name in os.listdir(filesdir):
+            path = os.path.join(cwd, name)
+            if os.path.lexists(path):
+                os.remove(path)
+            link(os.path.join(filesdir, name), path)
+        return output
+
+    def store(self, entry, cmd, output, files):
+        """Save files and output as entry; returns the bytes added to the cache."""
+        parent = os.path.dirname(entry)
+        if not os.access(parent, os.F_OK):
+            os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        os.mkdir(os.path.join(tmp, 'files'))
+        size = 0
+        for name in files:
+            link(name, os.path.join(tmp, 'files', os.path.basename(name)))
+            size += os.stat(name).st_size
+        with open(os.path.join(tmp, 'output.log'), 'wt') as log:
+            log.write(output)
+        with open(os.path.join(tmp, 'meta.json'), 'wt') as meta:
+            json.dump({'cmd': cmd, 'size': size}, meta)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True) # another worker stored it first
+            return 0
+        return size
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for metafile in glob.glob(os.path.join(self.root, '??', '*', 'meta.json')):
+            try:
+                with open(metafile) as meta:
+                    size = json.load(meta)['size']
+                used = os.stat(metafile).st_mtime
+            except (IOError, OSError, ValueError):
+                continue
+            entries.append((used, size, os.path.dirname(metafile)))
+            total += size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            used, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self.total = total
+        self.scanned = time.time()
+
+
+def link(src, dst):
+    """Hardlink src to dst, copying if they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
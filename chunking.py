@@ -0,0 +1,225 @@
+"""
+DDplan chunks sized for the workers at hand
+
+DDplan.py picks each row's calls (how many prepsubband calls, each of
+DMs_per_call DMs) for a serial run: as few subband passes over the raw
+data as the subband smearing allows. With many workers a row of a few
+big calls leaves most of them idle while it runs. optimize() splits rows
+into more, smaller calls when that shortens the predicted makespan of
+the whole plan on the workers, trading extra subband passes for
+parallelism.
+
+A row is only ever split into calls of fewer DMs: the subband DM step
+(dsubDM) shrinks with them, so the smearing stays within what DDplan.py
+allowed, and the DM trials, .dat names and hiDM are those of the plan.
+Calls stay equal in size (a divisor of the row's #DMs), so every call of
+a row is the same partial.
+
+The cost of a call is modelled as
+
+    seconds = per_call + per_pass * Nsamp * Nchan + per_dm * NDMs * Nsub * Nsamp / DownSamp
+
+(start-up, one pass over every raw sample forming the subbands, and each
+DM's shift-and-sum of the downsampled subbands). CostLog records the run
+time of each call in a JSON-lines file as it finishes and fits the three
+coefficients to them by least squares (dropping any coefficient that
+comes out negative and refitting), per dedispersion function, so the
+model calibrates itself on the machine it runs on. Until there are enough
+timings it uses rough defaults. The makespan of a set of calls on N
+workers is predicted as the longest-processing-time-first schedule gives
+it, which is how ranked_results submits them.
+
+    python chunking.py FILE WORKERS [--maxdm DM] [--nsub N] [--costs FILE]
+
+prints the DDplan for FILE, and the one chunked for WORKERS.
+"""
+import os
+import sys
+import json
+import heapq
+import numpy as np
+from resources import stage_of, own_work
+
+DEFAULT_COEFFICIENTS = (1.0, 3e-9, 1e-9) #Seconds per call, per raw sample and channel, per DM and downsampled subband sample
+MIN_TIMINGS = 6 #Timings of a function needed before they replace the defaults
+
+
+def features(Nchan, Nsub, Nsamp, DownSamp, NDMs):
+    """What a call of NDMs at DownSamp costs in units of each coefficient."""
+    return (1.0, float(Nsamp) * Nchan, float(NDMs) * Nsub * Nsamp / DownSamp)
+
+
+class CostModel(object):
+    '''Predicted seconds of one dedispersion call (see features()).'''
+
+    def __init__(self, coefficients=DEFAULT_COEFFICIENTS):
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+
+    @classmethod
+    def fit(cls, timings):
+        '''
+        The least-squares fit to timings, (features, seconds) pairs, with
+        no coefficient negative; the defaults when there are too few.
+        '''
+        if len(timings) < MIN_TIMINGS:
+            return cls()
+        A = np.array([f for f, _ in timings], dtype=np.float64)
+        b = np.array([s for _, s in timings], dtype=np.float64)
+        scale = A.max(axis=0) # the columns differ by ~10 orders of magnitude
+        scale[scale == 0] = 1.0
+        A = A / scale
+        # drop the most negative coefficient and refit until none are left
+        kept = list(range(A.shape[1]))
+        while kept:
+            x = np.linalg.lstsq(A[:, kept], b, rcond=None)[0]
+            if x.min() >= 0:
+                break
+            del kept[int(np.argmin(x))]
+        coefficients = np.zeros(A.shape[1])
+        if kept:
+            coefficients[kept] = x
+        if not coefficients.any():
+            return cls()
+        return cls(coefficients / scale)
+
+    def predict(self, Nchan, Nsub, Nsamp, DownSamp, NDMs):
+        return float(np.dot(self.coefficients, features(Nchan, Nsub, Nsamp, DownSamp, NDMs)))
+
+
+class Timed(object):
+    '''
+    function(dml), appending its run time to path as a JSON line: only the
+    work it did itself, without time spent waiting on other workers, and
+    nothing when its tools were served from the result cache. It is named
+    after function's stage, so the MemoryLimiter still knows it.
+    '''
+
+    def __init__(self, function, path, row):
+        self.function = function
+        self.path = path
+        self.row = row # the features() arguments of the call
+        self.__name__ = stage_of(function)
+
+    def __call__(self, dml):
+        result, seconds = own_work(self.function, dml)
+        if seconds is None:
+            return result # served from the result cache, which says nothing of the cost
+        record = dict(self.row, stage=self.__name__, seconds=seconds)
+        # one short line per write, so appends from several workers do not interleave
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        return result
+
+
+class CostLog(object):
+    '''The timings of dedispersion calls for an observation of Nchan channels in Nsub subbands, in path.'''
+
+    def __init__(self, path, Nchan, Nsub):
+        self.path = os.path.abspath(path)
+        self.Nchan = Nchan
+        self.Nsub = Nsub
+
+    def timed(self, function, Nsamp, DownSamp, NDMs):
+        """function, recording the run time of each call."""
+        row = {'Nchan': self.Nchan, 'Nsub': self.Nsub, 'Nsamp': Nsamp, 'DownSamp': DownSamp, 'NDMs': NDMs}
+        return Timed(function, self.path, row)
+
+    def timings(self, stage):
+        """(features, seconds) of every recorded call of stage."""
+        timings = []
+        if not os.access(self.path, os.F_OK):
+            return timings
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash
+                if record.get('stage') == stage:
+                    timings.append((features(record['Nchan'], record['Nsub'], record['Nsamp'], record['DownSamp'], record['NDMs']),
+                                    record['seconds']))
+        return timings
+
+    def model(self, stage):
+        return CostModel.fit(self.timings(stage))
+
+
+def makespan(costs, workers):
+    """Finish time of costs on workers, longest first, each to the worker free soonest."""
+    loads = [0.0] * max(int(workers), 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def chunk_counts(numDMs, calls):
+    """The numbers of equal calls numDMs can be split into, from calls up."""
+    return [n for n in range(int(calls), int(numDMs) + 1) if numDMs % n == 0]
+
+
+def optimize(ddplan, model, workers, Nchan, Nsub, Nsamp, keep=()):
+    '''
+    ddplan with each row's calls (and DMs_per_call and dsubDM with them)
+    chosen to minimise the predicted makespan on workers. For each limit
+    on the cost of a call, every row takes the fewest calls that keep
+    under it, and the limit whose plan finishes first (then does the
+    least work) wins; the plan itself is one of them. The rows in keep
+    are left as they are.
+    '''
+    options = []
+    for ii, row in enumerate(ddplan):
+        numDMs, DownSamp = int(row['numDMs']), int(row['DownSamp'])
+        counts = [int(row['calls'])] if ii in keep else chunk_counts(numDMs, row['calls'])
+        options.append([(n, model.predict(Nchan, Nsub, Nsamp, DownSamp, numDMs // n)) for n in counts])
+
+    best = None
+    for limit in sorted(set(cost for row in options for _, cost in row)):
+        # calls only get cheaper as a row is split further
+        chosen = [next(((n, cost) for n, cost in row if cost <= limit), row[-1]) for row in options]
+        costs = [cost for n, cost in chosen for call in range(n)]
+        predicted = (makespan(costs, workers), sum(costs))
+        if best is None or predicted < best[0]:
+            best = (predicted, [n for n, _ in chosen])
+
+    chunked = np.array(ddplan, copy=True)
+    for row, n in zip(chunked, best[1]):
+        row['calls'] = n
+        row['DMs_per_call'] = row['numDMs'] // n
+        row['dsubDM'] = round(row['DMs_per_call'] * row['dDM'], 2)
+    return chunked
+
+
+def predicted_makespan(ddplan, model, workers, Nchan, Nsub, Nsamp):
+    costs = [model.predict(Nchan, Nsub, Nsamp, int(row['DownSamp']), int(row['DMs_per_call']))
+             for row in ddplan for call in range(int(row['calls']))]
+    return makespan(costs, workers)
+
+
+if __name__ == "__main__":
+
+    import ddplan as planner
+    from rawdata import open_raw
+
+    options = {'--maxdm': '80', '--nsub': '32', '--costs': 'chunk_costs.jsonl'}
+    args = sys.argv[1:3]
+    flags = sys.argv[3:]
+    while flags:
+        if flags[0] not in options or len(flags) < 2:
+            break
+        options[flags[0]] = flags[1]
+        flags = flags[2:]
+    if len(args) != 2 or flags:
+        sys.exit('usage: python chunking.py FILE WORKERS [--maxdm DM] [--nsub N] [--costs FILE]')
+    try:
+        raw = open_raw(args[0])
+    except ValueError as e:
+        sys.exit(str(e))
+    with raw:
+        Nchan, Nsamp = raw.nchan, raw.nspec
+        ddplan = planner.plan(float(options['--maxdm']), Nchan, raw.tsamp, raw.bandwidth, raw.fcenter, int(options['--nsub']))
+    workers, Nsub = int(args[1]), int(options['--nsub'])
+    model = CostLog(options['--costs'], Nchan, Nsub).model('prepsubband_f')
+    chunked = optimize(ddplan, model, workers, Nchan, Nsub, Nsamp)
+    for title, plan in (('DDplan', ddplan), ('Chunked for %d workers' % workers, chunked)):
+        print('%s: predicted %.1fs' % (title, predicted_makespan(plan, model, workers, Nchan, Nsub, Nsamp)))
+        print('\n'.join(planner.table(plan)))
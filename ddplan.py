@@ -0,0 +1,189 @@
+"""
+Dedispersion plans in-process
+
+A port of the planning in PRESTO's DDplan.py (v3), so the pipelines
+no longer run DDplan.py, render DDplan.ps and scrape the table out of
+its output. plan() returns the rows DDplan.py prints as a structured
+array:
+
+    lowDM hiDM dDM DownSamp dsubDM numDMs DMs_per_call calls work_fract
+
+with the DMs rounded as DDplan.py prints them, so the prepsubband
+command lines and .dat names are those the scraped table gave. Plans are
+memoized on their arguments (Nchan, tsamp, BW, fcenter, Nsub and the DM
+range), so a batch of observations with one setup plans once.
+table() formats a plan as DDplan.py does, and draw() still runs DDplan.py
+when the plot itself is wanted.
+"""
+from functools import lru_cache
+from subprocess import getoutput
+import numpy as np
+
+#DM steps DDplan.py chooses from
+ALLOW_DDMS = (0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0,
+              3.0, 5.0, 10.0, 20.0, 30.0, 50.0, 100.0, 200.0, 300.0)
+FUDGE = 1.2 #DDplan.py's 'ff': how much larger one time scale must be to count as larger
+SMEARFACT = 2.0 #A row ends where channel smearing is this many times all other smearing
+BLOCKLEN = 1024 #Spectra per block (DDplan.py -k); downsampling factors divide it
+
+PLAN_DTYPE = np.dtype([('lowDM', 'f8'), ('hiDM', 'f8'), ('dDM', 'f8'), ('DownSamp', 'i8'),
+                       ('dsubDM', 'f8'), ('numDMs', 'i8'), ('DMs_per_call', 'i8'), ('calls', 'i8'),
+                       ('work_fract', 'f8')])
+
+
+def dm_smear(DM, BW, f_ctr, cDM=0.0):
+    """Smearing (ms) by DM across BW MHz centred on f_ctr MHz."""
+    return 1000.0 * np.fabs(DM - cDM) * BW / (0.0001205 * f_ctr**3.0)
+
+
+def BW_smear(DMstep, BW, f_ctr):
+    """Smearing (ms) across BW from searching with DM steps of DMstep."""
+    return dm_smear(0.5 * DMstep, BW, f_ctr)
+
+
+def guess_DMstep(dt, BW, f_ctr):
+    """The DM step whose smearing across BW equals the sample time dt."""
+    return dt * 0.0001205 * f_ctr**3.0 / (0.5 * BW)
+
+
+def subband_smear(subDMstep, numsub, BW, f_ctr):
+    """Smearing (ms) across each of numsub subbands from subband DM steps of subDMstep."""
+    if numsub == 0:
+        return 0.0
+    return dm_smear(0.5 * subDMstep, BW / numsub, f_ctr)
+
+
+def total_smear(DM, DMstep, dt, f_ctr, BW, numchan, subDMstep, cohdm=0.0, numsub=0):
+    """Total smearing (ms) at DM from sampling, channels, subbands and the DM step."""
+    return np.sqrt(2 * (1000.0 * dt)**2.0 +
+                   dm_smear(DM, BW / numchan, f_ctr, cohdm)**2.0 +
+                   subband_smear(subDMstep, numsub, BW, f_ctr)**2.0 +
+                   BW_smear(DMstep, BW, f_ctr)**2.0)
+
+
+def choose_downsamps(blocklen):
+    '''Downsampling factors that divide blocklen, each 1.5 to 2 times the last where possible.'''
+    x = np.asarray([n for n in np.arange(1, 260) if blocklen % n == 0])
+    if len(x) == 1:
+        return list(x)
+    if (x[1:] / x[:-1]).min() >= 1.5:
+        return list(x)
+    newx = [1]
+    if 2 in x:
+        newx.append(2)
+    if 3 in x:
+        newx.append(3)
+    while newx[-1] < x[-1]:
+        maxnewx = newx[-1]
+        if round(1.5 * maxnewx + 1e-7) in x:
+            newx.append(int(round(1.5 * maxnewx + 1e-7)))
+        elif 2 * maxnewx in x:
+            newx.append(2 * maxnewx)
+        elif x[-1] > 1.5 * maxnewx:
+            newx.append(int(x[x > 1.5 * maxnewx].min()))
+        else:
+            break
+    return newx
+
+
+def plan_row(dt, f_ctr, BW, numchan, cDM, downsamp, loDM, hiDM, dDM, numsub, numprocs=1):
+    '''
+    One row of the plan (DDplan.py's dedisp_method): from loDM in steps of
+    dDM at downsamp until channel smearing dominates or hiDM is reached.
+    Returns (lowDM, hiDM, dDM, downsamp, dsubDM, numDMs, DMs_per_call, calls).
+    '''
+    chanwidth = BW / numchan
+    BW_smearing = BW_smear(dDM, BW, f_ctr)
+    calls = 0
+    DMs_per_call = 0
+    if numsub:
+        # the largest subband DM step whose smearing stays the smallest contribution
+        DMs_per_call = 2
+        while subband_smear((DMs_per_call + 2) * dDM, numsub, BW, f_ctr) <= 0.8 * min(BW_smearing, 1000.0 * dt * downsamp):
+            DMs_per_call += 2
+        dsubDM = DMs_per_call * dDM
+        sub_smearing = subband_smear(dsubDM, numsub, BW, f_ctr)
+    else:
+        dsubDM = dDM
+        sub_smearing = 0.0
+
+    other_smear = np.sqrt((1000.0 * dt)**2.0 + (1000.0 * dt * downsamp)**2.0 + BW_smearing**2.0 + sub_smearing**2.0)
+    cross_DM = min(SMEARFACT * 0.001 * other_smear / chanwidth * 0.0001205 * f_ctr**3.0 + cDM, hiDM)
+    numDMs = int(np.ceil((cross_DM - loDM) / dDM))
+    if numsub:
+        calls = int(np.ceil(numDMs * dDM / dsubDM))
+        if numprocs > 1 and calls % numprocs:
+            # a whole number of calls per processor
+            calls = (calls // numprocs + 1) * numprocs
+            while DMs_per_call > 1 and calls * DMs_per_call > numDMs:
+                DMs_per_call -= 1
+        numDMs = calls * DMs_per_call
+    if numprocs > 1 and numDMs % numprocs:
+        numDMs = (numDMs // numprocs + 1) * numprocs
+    return loDM, loDM + numDMs * dDM, dDM, downsamp, dsubDM, numDMs, DMs_per_call, calls
+
+
+@lru_cache(maxsize=64)
+def plan(maxDM, Nchan, tsamp, BW, fcenter, Nsub, lowDM=0.0, cDM=0.0, numprocs=1, ok_smearing=0.0, blocklen=BLOCKLEN):
+    '''
+    The dedispersion plan DDplan.py makes for Nchan channels of tsamp
+    seconds over BW MHz centred on fcenter MHz, in Nsub subbands, from
+    lowDM to maxDM: a read-only PLAN_DTYPE array, one element per row.
+    '''
+    downsamps = choose_downsamps(blocklen)
+    dtms = 1000.0 * tsamp
+    chanwidth = BW / Nchan
+
+    # the smallest smearing these data allow
+    min_chan_smearing = dm_smear(np.linspace(lowDM, maxDM, 10000), chanwidth, fcenter, cDM).min()
+    min_BW_smearing = BW_smear(ALLOW_DDMS[0], BW, fcenter)
+    ok_smearing = max(ok_smearing, min_chan_smearing, min_BW_smearing, dtms)
+
+    # start downsampled if the data have finer time resolution than that
+    index_downsamps = 0
+    if FUDGE * min_chan_smearing > dtms or ok_smearing > dtms:
+        okval = ok_smearing if ok_smearing > FUDGE * min_chan_smearing else FUDGE * min_chan_smearing
+        while index_downsamps + 1 < len(downsamps) and dtms * downsamps[index_downsamps + 1] < okval:
+            index_downsamps += 1
+    downsamp = downsamps[index_downsamps]
+
+    dDM = guess_DMstep(tsamp * downsamp, BW, fcenter)
+    index_dDMs = 0
+    while ALLOW_DDMS[index_dDMs + 1] < FUDGE * dDM:
+        index_dDMs += 1
+
+    rows = [plan_row(tsamp, fcenter, BW, Nchan, cDM, downsamp, lowDM, maxDM, ALLOW_DDMS[index_dDMs], Nsub, numprocs)]
+    while rows[-1][1] < maxDM:
+        # each further row at the next downsampling and the DM step that suits it
+        index_downsamps += 1
+        if index_downsamps >= len(downsamps):
+            raise ValueError('no downsampling factor of %d left to reach DM %g' % (blocklen, maxDM))
+        downsamp = downsamps[index_downsamps]
+        while BW_smear(ALLOW_DDMS[index_dDMs + 1], BW, fcenter) < FUDGE * dtms * downsamp:
+            index_dDMs += 1
+        rows.append(plan_row(tsamp, fcenter, BW, Nchan, cDM, downsamp, rows[-1][1], maxDM, ALLOW_DDMS[index_dDMs], Nsub, numprocs))
+
+    work = np.array([row[5] / float(row[3]) for row in rows])
+    table = np.array([row + (fract,) for row, fract in zip(rows, work / work.sum())], dtype=PLAN_DTYPE)
+    # as DDplan.py prints them, which is what prepsubband was given
+    for field, decimals in (('lowDM', 3), ('hiDM', 3), ('dDM', 2), ('dsubDM', 2)):
+        table[field] = np.round(table[field], decimals)
+    table.flags.writeable = False # the cached plan is shared
+    return table
+
+
+def table(plan, numsub=True):
+    '''plan as the lines of DDplan.py's table, header first.'''
+    if numsub:
+        lines = ['  Low DM    High DM     dDM  DownSamp  dsubDM   #DMs  DMs/call  calls  WorkFract']
+        lines += ['%9.3f  %9.3f  %6.2f    %4d  %6.2f  %6d  %6d  %6d    %.4g' % tuple(row[name] for name in PLAN_DTYPE.names) for row in plan]
+    else:
+        lines = ['  Low DM    High DM     dDM  DownSamp   #DMs  WorkFract']
+        lines += ['%9.3f  %9.3f  %6.2f    %4d  %6d    %.4g' % (row['lowDM'], row['hiDM'], row['dDM'], row['DownSamp'], row['numDMs'], row['work_fract'])
+                  for row in plan]
+    return lines
+
+
+def draw(psfile, maxDM, Nchan, tsamp, BW, fcenter, Nsub, lowDM=0.0):
+    '''Run DDplan.py for its plot of the plan in psfile, and return its output.'''
+    return getoutput('DDplan.py -l %s -d %s -n %d -b %s -t %.12g -f %s -s %d -o %s' % (lowDM, maxDM, Nchan, BW, tsamp, fcenter, Nsub, psfile))
@@ -0,0 +1,311 @@
+"""
+Subband dedispersion in-process with NumPy
+
+The alternative to prepsubband_f's two prepsubband runs per DM chunk: the
+raw data are read in blocks and summed into Nsub subbands dedispersed at
+the chunk's subDM (prepsubband -sub), then the subbands are shifted and
+summed into a series for every DM of the chunk (prepsubband on the .sub
+files), without the .sub files in between. Delays are PRESTO's
+(delay_from_dm), referenced to the highest channel of each subband and
+then to the highest subband, and rounded to the nearest sample as
+prepsubband rounds them. The series are written as .dat (little-endian
+float32) with a PRESTO .inf each, so realfft and accelsearch take them
+as they take prepsubband's.
+
+prepsubband -sub reads and unpacks the whole raw file for every DM chunk,
+so a DDplan row of 20 calls reads it 20 times. shared_subbands() forms
+the subbands of every chunk of a row in one pass over the raw data, into
+one .npy (chunk, subband, sample) that the row's chunks all read.
+
+Downsampling averages, and masked samples (an rfifind .mask) are
+replaced by the channel's mean over the block, so the series match
+prepsubband's in shape rather than bit for bit. To check an observation:
+
+    python dedisp.py validate OBS [MASK]
+
+dedisperses one DM chunk with both, prints the correlation of every pair
+of series and how long each took.
+"""
+import os
+import sys
+import time
+import fcntl
+import shutil
+import tempfile
+from subprocess import getoutput
+import numpy as np
+from rawdata import open_raw
+from resources import waiting
+
+BLOCK = 2**16 #Raw samples summed into subbands at a time
+VALIDATE_ROW = -1 #DDplan row whose first prepsubband call 'validate' repeats (the last is the cheapest)
+
+
+def delay_from_dm(dm, freq):
+    """Dispersion delay in seconds at freq (MHz), as PRESTO's delay_from_dm."""
+    return dm / (0.000241 * freq * freq)
+
+
+class RawData(object):
+    '''
+    A PSRFITS (.fits) or SIGPROC filterbank (.fil) file read through
+    rawdata.py, with the channels in increasing frequency as PRESTO orders
+    them.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reader = open_raw(filename)
+        for name in ('telescope', 'source', 'ra', 'dec', 'mjd', 'beam', 'nspec', 'tsamp', 'nchan', 'chanwidth'):
+            setattr(self, name, getattr(self.reader, name))
+        freqs = np.asarray(self.reader.freqs, dtype=np.float64)
+        self.flip = freqs[0] > freqs[-1]
+        self.freqs = freqs[::-1] if self.flip else freqs
+
+    def spectra(self, start, nspec):
+        """nspec spectra from sample start as float32 (nchan, nspec), a copy of the file's."""
+        data = self.reader.spectra(start, nspec).T
+        return np.array(data[::-1] if self.flip else data, dtype=np.float32, order='C')
+
+
+def channel_delays(freqs, Nsub, subDM, tsamp):
+    """Delay of each channel (samples) at subDM, relative to the highest channel of its subband."""
+    delays = delay_from_dm(subDM, freqs)
+    top = delays.reshape(Nsub, -1).min(axis=1)
+    return np.rint((delays - np.repeat(top, len(freqs) // Nsub)) / tsamp).astype(np.int64)
+
+
+def subband_delays(subfreqs, dm, dt):
+    """Delay of each subband (samples of dt) at dm, relative to the highest subband."""
+    delays = delay_from_dm(dm, subfreqs)
+    return np.rint((delays - delays.min()) / dt).astype(np.int64)
+
+
+def read_mask(maskfile, nchan):
+    '''(ptsperint, zapped) from an rfifind .mask, where zapped[ii] are the channels masked in interval ii.'''
+    from presto.rfifind import rfifind
+    mask = rfifind(maskfile)
+    zapped = []
+    for ii in range(mask.nint):
+        chans = set(mask.mask_zap_chans) | set(mask.mask_zap_chans_per_int[ii])
+        if ii in mask.mask_zap_ints:
+            chans = range(nchan)
+        zapped.append(np.array(sorted(chans), dtype=np.int64))
+    return int(mask.ptsperint), zapped
+
+
+def apply_mask(block, start, mask):
+    # replace the masked samples of block (which starts at sample start) by their channel's mean over the block
+    ptsperint, zapped = mask
+    means = block.mean(axis=1)
+    first, last = start // ptsperint, (start + block.shape[1] - 1) // ptsperint
+    for ii in range(first, min(last + 1, len(zapped))):
+        if len(zapped[ii]):
+            lo = max(ii * ptsperint - start, 0)
+            hi = min((ii + 1) * ptsperint - start, block.shape[1])
+            block[zapped[ii], lo:hi] = means[zapped[ii], None]
+
+
+def form_subbands(raw, Nsub, subDMs, downsamp, mask=None, out=None):
+    '''
+    The whole observation summed into Nsub subbands dedispersed at each of
+    subDMs and averaged down by downsamp, from one pass over the raw data:
+    float32 (len(subDMs), Nsub, nspec // downsamp), written into out if given.
+    '''
+    delays = [channel_delays(raw.freqs, Nsub, subDM, raw.tsamp) for subDM in subDMs]
+    maxdelay = max(int(d.max()) for d in delays)
+    perchan = raw.nchan // Nsub
+    block = BLOCK - BLOCK % downsamp
+    nsub = raw.nspec // downsamp
+    if out is None:
+        out = np.empty((len(subDMs), Nsub, nsub), dtype=np.float32)
+    for start in range(0, nsub * downsamp, block):
+        n = min(block, nsub * downsamp - start)
+        nread = min(n + maxdelay, raw.nspec - start)
+        data = raw.spectra(start, nread)
+        if mask is not None:
+            apply_mask(data, start, mask)
+        if nread < n + maxdelay:
+            # past the end of the observation, pad with each channel's mean
+            data = np.concatenate((data, np.repeat(data.mean(axis=1)[:, None], n + maxdelay - nread, axis=1)), axis=1)
+        for subbands, chan_delays in zip(out, delays):
+            summed = np.zeros((Nsub, n), dtype=np.float32)
+            for chan in range(raw.nchan):
+                summed[chan // perchan] += data[chan, chan_delays[chan]:chan_delays[chan] + n]
+            subbands[:, start // downsamp:(start + n) // downsamp] = summed.reshape(Nsub, -1, downsamp).mean(axis=2)
+    return out
+
+
+def shared_subbands(path, raw, Nsub, subDMs, downsamp, maskfile=None):
+    '''
+    form_subbands() for all of subDMs, as a read-only memmap of path (a
+    .npy). The first process to ask forms them there; the others wait
+    for it and then read the same file.
+    '''
+    with open(path + '.lock', 'a') as lock:
+        start = time.time()
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        waiting(time.time() - start) # not this call's own work (see chunking.py)
+        if not os.access(path, os.F_OK):
+            mask = read_mask(maskfile, raw.nchan) if maskfile else None
+            out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32,
+                                            shape=(len(subDMs), Nsub, raw.nspec // downsamp))
+            form_subbands(raw, Nsub, subDMs, downsamp, mask, out)
+            out.flush()
+            del out
+            os.rename(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+def dedisperse_subbands(subbands, subfreqs, dm, dt, downsamp, Nout):
+    '''
+    The subbands (samples of dt) shifted to dm and summed, averaged down
+    by downsamp and cut or padded (with the mean) to Nout samples.
+    '''
+    nsamp = subbands.shape[1]
+    series = np.zeros(nsamp, dtype=np.float32)
+    for sub, delay in zip(subbands, subband_delays(subfreqs, dm, dt)):
+        series[:nsamp - delay] += sub[delay:]
+        if delay:
+            series[nsamp - delay:] += sub.mean()
+    nout = nsamp // downsamp
+    series = series[:nout * downsamp].reshape(nout, downsamp).mean(axis=1)
+    if nout >= Nout:
+        return series[:Nout]
+    return np.concatenate((series, np.full(Nout - nout, series.mean(), dtype=np.float32)))
+
+
+def write_inf(basename, raw, dm, N, dt, notes='Dedispersed in-process with dedisp.py'):
+    """basename.inf describing N samples of dt at dm, as PRESTO's writeinf writes it."""
+    mjd_i = int(raw.mjd)
+    fields = [('Data file name without suffix', basename),
+              ('Telescope used', raw.telescope),
+              ('Instrument used', 'Unknown'),
+              ('Object being observed', raw.source),
+              ('J2000 Right Ascension (hh:mm:ss.ssss)', raw.ra),
+              ('J2000 Declination     (dd:mm:ss.ssss)', raw.dec),
+              ('Data observed by', 'Unknown'),
+              ('Epoch of observation (MJD)', '%d.%015d' % (mjd_i, round((raw.mjd - mjd_i) * 1e15))),
+              ('Barycentered?           (1=yes, 0=no)', '0'),
+              ('Number of bins in the time series', '%-11d' % N),
+              ('Width of each time series bin (sec)', '%.15g' % dt),
+              ('Any breaks in the data? (1 yes, 0 no)', '0'),
+              ('Type of observation (EM band)', 'Radio'),
+              ('Beam diameter (arcsec)', '%.0f' % raw.beam),
+              ('Dispersion measure (cm-3 pc)', '%.12g' % dm),
+              ('Central freq of low channel (Mhz)', '%.12g' % raw.freqs[0]),
+              ('Total bandwidth (Mhz)', '%.12g' % (raw.nchan * raw.chanwidth)),
+              ('Number of channels', '%d' % raw.nchan),
+              ('Channel bandwidth (Mhz)', '%.12g' % raw.chanwidth),
+              ('Data analyzed by', 'Unknown')]
+    with open(basename + '.inf', 'wt') as inf:
+        for label, value in fields:
+            inf.write(' %-39s=  %s\n' % (label, value))
+        inf.write(' Any additional notes:\n    %s\n\n' % notes)
+
+
+def dedisperse(filename, dms, datfiles, Nout, Nsub, subDM, subdownsamp, datdownsamp, maskfile=None, shared=None):
+    '''
+    Write datfiles (and their .inf), the observation dedispersed at each of
+    dms through Nsub subbands formed at subDM, as the two prepsubband calls
+    of prepsubband_f would. With shared=(path, subDMs), where subDMs are
+    those of every chunk of the DDplan row, the subbands are taken from
+    shared_subbands() instead. Returns a log of what was done.
+    '''
+    subdownsamp, datdownsamp = int(subdownsamp), int(datdownsamp)
+    raw = RawData(filename)
+    start = time.time()
+    if shared:
+        path, subDMs = shared
+        subbands = shared_subbands(path, raw, Nsub, subDMs, subdownsamp, maskfile)[np.argmin(np.abs(np.subtract(subDMs, subDM)))]
+        log = ['subbands at DM %.2f: %d x %d samples from %s after %.2fs\n' % (subDM, Nsub, subbands.shape[1], path, time.time() - start)]
+    else:
+        mask = read_mask(maskfile, raw.nchan) if maskfile else None
+        subbands = form_subbands(raw, Nsub, [subDM], subdownsamp, mask)[0]
+        log = ['subbands at DM %.2f: %d x %d samples in %.2fs\n' % (subDM, Nsub, subbands.shape[1], time.time() - start)]
+    subfreqs = raw.freqs.reshape(Nsub, -1).max(axis=1)
+    dt = raw.tsamp * subdownsamp
+    for dm, datfile in zip(dms, datfiles):
+        series = dedisperse_subbands(subbands, subfreqs, dm, dt, datdownsamp, int(Nout))
+        series.astype('<f4').tofile(datfile)
+        write_inf(datfile[:-4], raw, dm, len(series), dt * datdownsamp)
+    log.append('%d series of %d samples in %.2fs\n' % (len(datfiles), int(Nout), time.time() - start))
+    return ''.join(log)
+
+
+def dm_trials(lodm, dDM, NDMs):
+    """The DMs prepsubband dedisperses to for -lodm lodm -dmstep dDM -numdms NDMs (both given as '%f')."""
+    lodm, dDM = float("%f" % lodm), float("%f" % dDM)
+    return [lodm + ii*dDM for ii in range(NDMs)]
+
+
+def read_dat(path):
+    return np.fromfile(path, dtype='<f4')
+
+
+def compare(a, b):
+    """Correlation coefficient of two series over their common length."""
+    n = min(len(a), len(b))
+    a = a[:n] - a[:n].mean()
+    b = b[:n] - b[:n].mean()
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / norm) if norm else 1.0
+
+
+def validate(filename, maskfile=None):
+    '''
+    Dedisperse one DM chunk of the observation (the first call of DDplan
+    row VALIDATE_ROW) with prepsubband and with
+    dedisperse() in scratch directories, and print how well every pair
+    of series agrees and the time each took.
+    '''
+    import mpi_pipeline_py3 as pipeline
+    output, header = pipeline.read_header(filename)
+    ddplanout, ddplan = pipeline.dedispersion_plan(header)
+    Nsamp = int(header['Spectra per file'])
+    function, dml, datfiles, cost = pipeline.dedisperse_tasks([ddplan[VALIDATE_ROW]], Nsamp, os.path.basename(filename), maskfile and os.path.basename(maskfile))[0]
+    lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp = function.args[:6]
+    dms = dm_trials(dml[0], dDM, NDMs)
+
+    scratch = tempfile.mkdtemp(prefix='dedisp_')
+    try:
+        workdirs = {}
+        for name in ('prepsubband', 'numpy'):
+            workdirs[name] = os.path.join(scratch, name, 'subbands')
+            os.makedirs(workdirs[name])
+            for infile in (filename, maskfile):
+                if infile:
+                    os.symlink(os.path.abspath(infile), os.path.join(scratch, name, os.path.basename(infile)))
+        cwd = os.getcwd()
+        try:
+            os.chdir(workdirs['prepsubband'])
+            start = time.time()
+            for cmd in pipeline.prepsubband_cmds(*function.args + (dml,)):
+                getoutput(cmd)
+            prepsubband_time = time.time() - start
+            os.chdir(workdirs['numpy'])
+            start = time.time()
+            dedisperse('../' + os.path.basename(filename), dms, datfiles, Nout, pipeline.Nsub, np.mean(dml),
+                       subdownsamp, datdownsamp, maskfile and '../' + os.path.basename(maskfile))
+            numpy_time = time.time() - start
+        finally:
+            os.chdir(cwd)
+
+        print('%-24s %12s' % ('series', 'correlation'))
+        for df in datfiles:
+            a = os.path.join(workdirs['prepsubband'], df)
+            b = os.path.join(workdirs['numpy'], df)
+            if os.access(a, os.F_OK) and os.access(b, os.F_OK):
+                print('%-24s %12.6f' % (df, compare(read_dat(a), read_dat(b))))
+            else:
+                print('%-24s %12s' % (df, 'missing'))
+        print('prepsubband %.2fs, dedisp.py %.2fs for %d DMs' % (prepsubband_time, numpy_time, len(datfiles)))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3 or sys.argv[1] != 'validate':
+        sys.exit('usage: python dedisp.py validate OBS [MASK]')
+    validate(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
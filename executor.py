@@ -0,0 +1,223 @@
+"""
+Executor backends for the PRESTO pipeline
+
+Every backend is a concurrent.futures.Executor, so the pipeline scripts
+use the same map / submit / as_completed calls whichever one runs them:
+
+    process   a local process pool (the default)
+    thread    a thread pool; enough for stages that only wait on a PRESTO
+              subprocess, and cheaper to start than processes
+    mpi       mpi4py's MPIPoolExecutor, for running across nodes
+    hybrid    one MPI worker per node, each running batches of tasks on a
+              local pool sized to the node's cores
+    queue     a task queue on a shared filesystem ($PIPELINE_QUEUE_DIR)
+              served by taskqueue.py workers, started on any node at any
+              time; no MPI needed
+    serial    runs each task in the calling thread, as a baseline and
+              for debugging
+
+The backend and worker count are chosen at run time with
+'--executor NAME' and '--workers N' on a script's command line, or with
+the PIPELINE_EXECUTOR and PIPELINE_WORKERS environment variables. For
+the hybrid backend the worker count is the number of nodes, e.g. on 16
+nodes with one rank each plus one for the pipeline itself:
+
+    mpiexec -n 17 --map-by ppr:1:node python -m mpi4py.futures \
+        mpi_pipeline_py3.py --executor hybrid --workers 16 obs.fits
+"""
+import os
+import multiprocessing as mp
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+BACKENDS = ('process', 'thread', 'mpi', 'hybrid', 'queue', 'serial')
+BATCHES_PER_NODE = 4 #More batches than nodes lets idle nodes pick up the slack
+
+
+class SerialExecutor(Executor):
+    """Runs every task as soon as it is submitted, in the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class HybridExecutor(Executor):
+    """
+    Spreads work over nodes with one MPI worker per node, each of which
+    runs its share on a node-local pool ($PIPELINE_NODE_EXECUTOR, default
+    'process', sized to the node's cores).
+
+    map() and map_tasks() split the tasks into cost-balanced batches, a
+    few per node, so the expensive stages scale across the allocation
+    without one MPI process per task. A single submit() runs on one
+    node's pool, but each node takes one submission at a time, so the
+    pipeline maps whole stages rather than streaming them on this backend.
+    """
+
+    def __init__(self, nodes=None, wdir=None):
+        from mpi4py import MPI
+        from mpi4py.futures import MPIPoolExecutor
+        if nodes is None:
+            nodes = MPI.COMM_WORLD.Get_attr(MPI.UNIVERSE_SIZE) or 1
+        self.nodes = nodes
+        self.mpi = MPIPoolExecutor(max_workers=nodes, wdir=wdir,
+                                   path=[os.path.dirname(os.path.abspath(__file__))])
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        def unpack(batch):
+            try:
+                result, error = batch.result()[0]
+            except Exception as e:
+                result, error = None, e
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        self.mpi.submit(_node_batch, [(fn, args)]).add_done_callback(unpack)
+        return future
+
+    def map(self, fn, *iterables, **kwargs):
+        tasks = [(fn, args) for args in zip(*iterables)]
+        return iter(self.map_tasks(tasks, [1] * len(tasks)))
+
+    def map_tasks(self, tasks, costs, failures=None):
+        """
+        Run (function, args) tasks, returning their results in order. With
+        a FailureReport, a task that raises (or whose node's batch is lost)
+        is added to it and its result is None; without one, the first
+        error is raised once every batch has finished.
+        """
+        batches = partition(costs, self.nodes * BATCHES_PER_NODE)
+        futures = [self.mpi.submit(_node_batch, [tasks[ii] for ii in batch]) for batch in batches]
+        results = [None] * len(tasks)
+        errors = []
+        for batch, future in zip(batches, futures):
+            try:
+                outcomes = future.result()
+            except Exception as e:
+                outcomes = [(None, e)] * len(batch)
+            for ii, (result, error) in zip(batch, outcomes):
+                if error is None:
+                    results[ii] = result
+                elif failures is not None:
+                    failures.add(tasks[ii][1][0], error)
+                else:
+                    errors.append(error)
+        if errors:
+            raise errors[0]
+        return results
+
+    def shutdown(self, wait=True):
+        self.mpi.shutdown(wait=wait)
+
+
+def partition(costs, nbatches):
+    """
+    Split task indices into at most nbatches batches of similar total
+    cost, placing the most expensive tasks first (LPT); a batch lists its
+    tasks most expensive first.
+    """
+    batches = [[] for ii in range(min(nbatches, len(costs)))]
+    loads = [0.0] * len(batches)
+    for ii in sorted(range(len(costs)), key=lambda ii: costs[ii], reverse=True):
+        jj = loads.index(min(loads))
+        batches[jj].append(ii)
+        loads[jj] += costs[ii]
+    return batches
+
+
+_node_executor = None
+
+def _node_batch(tasks):
+    # Runs on a node's MPI worker; its local pool lives as long as the worker
+    global _node_executor
+    if _node_executor is None:
+        _node_executor = get_executor(os.environ.get('PIPELINE_NODE_EXECUTOR', 'process'))
+    futures = [_node_executor.submit(function, *args) for function, args in tasks]
+    # (result, None) or (None, error) per task, so one failure does not lose the rest of the batch
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append((future.result(), None))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+def in_dir(path, function, *args):
+    """
+    Run function(*args) with path as the working directory. The directory
+    is per process, so this needs a process, mpi or serial executor.
+    """
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        return function(*args)
+    finally:
+        os.chdir(cwd)
+
+
+def get_executor(backend=None, workers=None, wdir=None):
+    """
+    Create the executor for backend (default: $PIPELINE_EXECUTOR or
+    'process') with workers workers (default: $PIPELINE_WORKERS, or the
+    number of cores; for MPI the universe size). wdir is the working
+    directory of MPI workers. The executor's 'workers' attribute is the
+    number of tasks it runs at once.
+    """
+    if backend is None:
+        backend = os.environ.get('PIPELINE_EXECUTOR', 'process')
+    if workers is None and os.environ.get('PIPELINE_WORKERS'):
+        workers = int(os.environ['PIPELINE_WORKERS'])
+
+    if backend == 'process':
+        executor = ProcessPoolExecutor(workers or mp.cpu_count())
+    elif backend == 'thread':
+        executor = ThreadPoolExecutor(workers or mp.cpu_count())
+    elif backend == 'mpi':
+        # mpi4py is only needed when this backend is used
+        from mpi4py import MPI
+        from mpi4py.futures import MPIPoolExecutor
+        if workers is None:
+            workers = MPI.COMM_WORLD.Get_attr(MPI.UNIVERSE_SIZE)
+        executor = MPIPoolExecutor(max_workers=workers, wdir=wdir)
+    elif backend == 'hybrid':
+        executor = HybridExecutor(workers, wdir)
+    elif backend == 'queue':
+        # its worker count follows the workers serving the queue, unless given
+        from taskqueue import QueueExecutor
+        queue_dir = os.environ.get('PIPELINE_QUEUE_DIR')
+        if queue_dir is None:
+            raise ValueError('the queue backend needs PIPELINE_QUEUE_DIR, a directory every node can reach')
+        return QueueExecutor(queue_dir, wdir, workers)
+    elif backend == 'serial':
+        executor = SerialExecutor()
+        workers = 1
+    else:
+        raise ValueError("unknown executor backend '%s' (choose from %s)" % (backend, ', '.join(BACKENDS)))
+    executor.workers = workers or mp.cpu_count() # how many tasks run at once
+    return executor
+
+
+def parse_args(argv):
+    """
+    Remove '--executor NAME' and '--workers N' from argv in place, so the
+    scripts keep reading their positional arguments from sys.argv, and
+    return (backend, workers); either is None when not given.
+    """
+    backend = workers = None
+    for flag in ('--executor', '--workers'):
+        if flag in argv:
+            ii = argv.index(flag)
+            value = argv[ii+1]
+            del argv[ii:ii+2]
+            if flag == '--executor':
+                backend = value
+            else:
+                workers = int(value)
+    return backend, workers
@@ -0,0 +1,81 @@
+"""
+Retries and failure isolation for the PRESTO pipeline tasks
+
+A tool call that exits non-zero is retried a few times with exponential
+backoff, since a full scratch disk or an NFS hiccup often clears up, and
+raises TaskFailed if it keeps failing. The stage runners catch that per
+task, add it to a FailureReport and carry on with the rest of the stage,
+so one bad DM trial does not throw away the work that finished.
+
+The report is written to failed_tasks.jsonl as the failures happen.
+Failed tasks are never checkpointed in the manifest, so rerunning the
+pipeline retries just those.
+"""
+import os
+import json
+import time
+import threading
+
+RETRIES = int(os.environ.get('PIPELINE_RETRIES', 2)) #Extra attempts for a tool call that exits non-zero
+RETRY_BACKOFF = 5.0 #Seconds before the first retry, doubling for each one after
+OUTPUT_TAIL = 2000 #Characters of a failed tool's output kept in the report
+
+
+class TaskFailed(Exception):
+    """A tool call that still exited non-zero after its retries."""
+
+    def __init__(self, cmd, status, output):
+        Exception.__init__(self, "'%s' exited with status %d" % (cmd, status))
+        self.cmd = cmd
+        self.status = status
+        self.output = output
+
+    def __reduce__(self):
+        # so it pickles back from pool and MPI workers
+        return (TaskFailed, (self.cmd, self.status, self.output))
+
+
+def retried(call, cmd, retries=RETRIES, backoff=RETRY_BACKOFF):
+    """
+    Return the output of call(cmd), which returns (status, output),
+    calling it again while the status is non-zero; raise TaskFailed once
+    the retries are used up.
+    """
+    for attempt in range(retries + 1):
+        status, output = call(cmd)
+        if status == 0:
+            return output
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    raise TaskFailed(cmd, status, output)
+
+
+class FailureReport(object):
+
+    def __init__(self, path='failed_tasks.jsonl'):
+        self.path = path
+        self.failures = []
+        self.lock = threading.Lock()
+        self.file = open(path, 'wt')
+
+    def add(self, task, error):
+        """Record that task failed with error (usually a TaskFailed)."""
+        entry = {'task': str(task), 'error': str(error)}
+        if isinstance(error, TaskFailed):
+            entry.update(cmd=error.cmd, status=error.status, output=error.output[-OUTPUT_TAIL:])
+        with self.lock:
+            self.failures.append(entry)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+        print('task failed: %s' % error)
+
+    def __len__(self):
+        return len(self.failures)
+
+    def summary(self):
+        lines = ['%d task(s) failed, see %s:' % (len(self.failures), self.path)]
+        lines.extend('    %s' % entry['error'] for entry in self.failures)
+        return '\n'.join(lines)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,139 @@
+"""
+Tree dedispersion (the fast dispersion measure transform) with NumPy
+
+dedisp.py and prepsubband shift and sum Nsub subbands once for every DM,
+O(Nsamp * Nsub * NDMs) after the subbands are formed. The FDMT (Zackay &
+Ofek 2017) dedisperses to every delay across the band at once instead:
+adjacent channels are summed in pairs for each delay across the pair,
+adjacent pairs into fours for each delay across the four, and so on up
+the band, every level reusing the sums of the one below. All the delays
+from dtmin to dtmax cost O(Nsamp * (Nchan + NDT) * log2 Nchan), and each
+step of the tree is whole-array work on the rows of a block of channels.
+
+Channels are taken as points at their centre frequencies, as prepsubband
+takes them, and delays are rounded to the nearest sample at every level,
+so a channel can land a sample off where a direct sum would put it: a
+pulse one sample wide keeps about three quarters of its peak, pulses two
+or more samples wide nearly all of it. The delays across the band are
+one sample apart, which is the DM step DDplan picks for a row, and the
+.dat for each DM of a DDplan chunk is the delay nearest to it.
+bench_dedisperse.py compares it with prepsubband and dedisp.py.
+"""
+import time
+import numpy as np
+from dedisp import RawData, delay_from_dm, read_mask, apply_mask, write_inf
+
+BLOCK = 2**14 #Output samples dedispersed at a time (each block reads the largest delay's worth more)
+
+
+def band_delays(dms, freqs, dt):
+    """Delay (samples of dt) of the lowest channel behind the highest at each of dms."""
+    dms = np.asarray(dms, dtype=np.float64)
+    return np.rint((delay_from_dm(dms, freqs.min()) - delay_from_dm(dms, freqs.max())) / dt).astype(np.int64)
+
+
+def merge(low, high, inv2, first, last):
+    # the state of low's channels and high's (the next ones up) together, for delays first..last across both
+    lo, mid, lfirst, lrows = low
+    mid1, hi, hfirst, hrows = high
+    span = inv2[lo] - inv2[hi]
+    dts = np.arange(first, last + 1)
+    hdt = np.rint(dts * ((inv2[mid1] - inv2[hi]) / span)).astype(np.int64) # across high's channels
+    shift = np.rint(dts * ((inv2[mid] - inv2[hi]) / span)).astype(np.int64) # low's top channel behind the highest
+    hidx = np.clip(hdt - hfirst, 0, len(hrows) - 1)
+    lidx = np.clip(dts - shift - lfirst, 0, len(lrows) - 1)
+    n = lrows.shape[1]
+    rows = np.zeros((len(dts), n), dtype=np.float32)
+    # shift never decreases with the delay, so the rows sharing a shift are a slice, and so are low's rows for them
+    shifts, starts = np.unique(shift, return_index=True)
+    for s, a, b in zip(shifts, starts, list(starts[1:]) + [len(dts)]):
+        if s >= n:
+            continue
+        if lidx[b - 1] - lidx[a] == b - 1 - a:
+            low_rows = lrows[lidx[a]:lidx[b - 1] + 1, s:]
+        else:
+            low_rows = lrows[lidx[a:b], s:] # clipped at the edge of low's delays
+        np.add(hrows[hidx[a:b], :n - s], low_rows, out=rows[a:b, :n - s])
+    return lo, hi, first, rows
+
+
+def fdmt(data, freqs, dtmin, dtmax):
+    '''
+    The channels of data (nchan, n), in increasing frequency freqs,
+    summed along every dispersion sweep whose lowest channel lags the
+    highest by dtmin..dtmax samples: float32 (dtmax - dtmin + 1, n),
+    referenced to the highest channel. The last dtmax samples of each
+    row run off the end of data and are incomplete.
+    '''
+    inv2 = 1.0 / np.asarray(freqs, dtype=np.float64)**2
+    band = inv2[0] - inv2[-1]
+    data = np.asarray(data, dtype=np.float32)
+    # a state is (lowest channel, highest channel, first delay, rows): the channels summed for delays from first across them
+    states = [(chan, chan, 0, data[chan:chan + 1]) for chan in range(len(freqs))]
+    while len(states) > 1:
+        merged = []
+        for low, high in zip(states[0::2], states[1::2]):
+            frac = (inv2[low[0]] - inv2[high[1]]) / band
+            merged.append(merge(low, high, inv2, int(np.floor(dtmin * frac)), int(np.ceil(dtmax * frac))))
+        if len(states) % 2:
+            merged.append(states[-1])
+        states = merged
+    lo, hi, first, rows = states[0]
+    return rows[dtmin - first:dtmax - first + 1]
+
+
+def downsampled(raw, start, nspec, downsamp, mask=None):
+    """nspec raw spectra from start averaged down by downsamp, padded past the end of the observation with each channel's mean."""
+    data = np.empty((raw.nchan, nspec // downsamp), dtype=np.float32)
+    step = BLOCK * downsamp
+    means = None
+    for ii in range(0, nspec, step):
+        n = min(step, nspec - ii)
+        nread = max(min(n, raw.nspec - start - ii), 0)
+        if nread:
+            block = raw.spectra(start + ii, nread)
+            if mask is not None:
+                apply_mask(block, start + ii, mask)
+            means = block.mean(axis=1)
+        else:
+            block = np.empty((raw.nchan, 0), dtype=np.float32)
+        if nread < n:
+            block = np.concatenate((block, np.repeat(means[:, None], n - nread, axis=1)), axis=1)
+        data[:, ii // downsamp:(ii + n) // downsamp] = block.reshape(raw.nchan, -1, downsamp).mean(axis=2)
+    return data
+
+
+def dedisperse(filename, dms, datfiles, Nout, downsamp, maskfile=None):
+    '''
+    Write datfiles (and their .inf), the observation averaged down by
+    downsamp and dedispersed at each of dms, from the FDMT over the delays
+    the dms span. Returns a log of what was done.
+    '''
+    downsamp, Nout = int(downsamp), int(Nout)
+    raw = RawData(filename)
+    mask = read_mask(maskfile, raw.nchan) if maskfile else None
+    dt = raw.tsamp * downsamp
+    delays = band_delays(dms, raw.freqs, dt)
+    dtmin, dtmax = int(delays.min()), int(delays.max())
+    nout = min(raw.nspec // downsamp, Nout)
+    start = time.time()
+    sums = np.zeros(len(datfiles))
+    outs = [open(df, 'wb') for df in datfiles]
+    try:
+        for first in range(0, nout, BLOCK):
+            n = min(BLOCK, nout - first)
+            data = downsampled(raw, first * downsamp, (n + dtmax) * downsamp, downsamp, mask)
+            series = fdmt(data, raw.freqs, dtmin, dtmax)[delays - dtmin, :n]
+            sums += series.sum(axis=1)
+            for out, row in zip(outs, series):
+                row.astype('<f4').tofile(out)
+        if nout < Nout:
+            # as prepsubband does for -numout past the end, pad with the mean
+            for out, total in zip(outs, sums):
+                np.full(Nout - nout, total / max(nout, 1), dtype='<f4').tofile(out)
+    finally:
+        for out in outs:
+            out.close()
+    for dm, df in zip(dms, datfiles):
+        write_inf(df[:-4], raw, dm, Nout, dt, notes='Dedispersed in-process with fdmt.py')
+    return 'FDMT over delays %d..%d: %d series of %d samples in %.2fs\n' % (dtmin, dtmax, len(datfiles), Nout, time.time() - start)
@@ -0,0 +1,78 @@
+"""
+Wall-clock budget for the fold stage
+
+With a low sifting threshold there can be thousands of candidates, and
+folding them all takes hours. Given '--fold-budget SECONDS', the fold
+stage takes candidates in sigma order and starts each one only if it is
+predicted to finish before the budget runs out; the first one that would
+not, and every candidate after it, is deferred and written to a list
+instead of folded.
+
+A fold's cost is modelled from the observation (fold_cost) and turned
+into seconds with the rate measured on the folds finished so far, so the
+prediction calibrates itself on the machine it runs on. Until the first
+fold finishes there is no rate, and candidates start while any budget is
+left. Deferred candidates are not in the manifest, so rerunning with a
+bigger budget folds just those.
+"""
+import time
+
+
+def fold_cost(cand, Nint, Nsub, Nchan, Nsamp, tsamp):
+    '''
+    Relative cost of folding cand with prepfold: every sample of every
+    channel is read and summed into subbands, and every subband sample is
+    spread over the Nint profile bins it covers, which is more than one
+    bin once the period is shorter than Nint samples.
+    '''
+    return Nsamp * (Nchan + Nsub * max(1.0, Nint * tsamp / cand.p))
+
+
+def parse_budget(argv):
+    """
+    Remove '--fold-budget SECONDS' from argv in place and return the
+    budget in seconds, or None when it is not given.
+    """
+    if '--fold-budget' not in argv:
+        return None
+    ii = argv.index('--fold-budget')
+    seconds = float(argv[ii+1])
+    del argv[ii:ii+2]
+    return seconds
+
+
+class FoldBudget(object):
+
+    def __init__(self, seconds, cost):
+        self.deadline = time.time() + seconds
+        self.cost = cost # cand -> fold_cost units
+        self.started = {} # id(cand) -> start time
+        self.units = 0.0
+        self.seconds = 0.0
+        self.deferred = []
+
+    def predict(self, cand):
+        """Seconds cand's fold should take, or None before any fold has finished."""
+        if not self.units:
+            return None
+        return self.cost(cand) * self.seconds / self.units
+
+    def admitted(self, cands):
+        '''
+        Yield cands in order while each is predicted to finish in time,
+        moving the rest to deferred. Meant to be consumed lazily, one
+        candidate whenever a worker is free, so a candidate starts as it
+        is yielded.
+        '''
+        for ii, cand in enumerate(cands):
+            now = time.time()
+            if now + (self.predict(cand) or 0.0) > self.deadline:
+                self.deferred.extend(cands[ii:])
+                return
+            self.started[id(cand)] = now
+            yield cand
+
+    def finished(self, cand):
+        """Calibrate the rate with cand's fold, which just finished."""
+        self.units += self.cost(cand)
+        self.seconds += time.time() - self.started.pop(id(cand))
@@ -0,0 +1,195 @@
+"""
+Local job server for the steps/*.py scripts
+
+Each step script pays for a fresh interpreter, numpy and presto imports
+and a new worker pool every time it runs, which is seconds of overhead
+per call for a small observation. The job server does the imports once
+and keeps running; a step script started with PIPELINE_JOBSERVER set to
+the server's socket sends its command line to the server and exits with
+the run's exit status, without importing any of it:
+
+    python jobserver.py /tmp/presto.sock &
+    export PIPELINE_JOBSERVER=/tmp/presto.sock
+    python steps/fft.py                      # runs in the server
+
+The server forks a child per run from its warm process, so the child and
+the pool workers it forks start with everything already imported. The
+child gets the client's working directory, environment, arguments and
+its stdin/stdout/stderr (passed over the socket), so a run behaves as if
+the script had been started directly. If the client goes away, e.g. on
+Ctrl-C, the run and everything it started is killed.
+
+The mpi and hybrid backends need processes started by mpiexec, so runs
+through the server use the local backends.
+"""
+import os
+import sys
+import json
+import signal
+import socket
+import selectors
+import traceback
+
+PRELOAD = ('numpy', 'presto.sifting', 'concurrent.futures', 'multiprocessing',
+           'executor', 'manifest', 'results', 'scheduler') #Imported once by the server, not by every run
+MAX_REQUEST = 1 << 20 #Bytes of a request (command line and environment)
+
+
+def submit(path, script, argv):
+    '''
+    Run script with argv on the job server listening on path, with this
+    process's working directory, environment and standard streams, and
+    return its exit status.
+    '''
+    request = {'script': os.path.abspath(script), 'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        socket.send_fds(conn, [(json.dumps(request) + '\n').encode()], [0, 1, 2])
+        reply = conn.makefile('rb').readline() # a closed connection means the server died
+        return int(reply) if reply else 1
+
+
+def preload():
+    for name in PRELOAD:
+        try:
+            __import__(name)
+        except ImportError as e:
+            print('jobserver: not preloading %s (%s)' % (name, e))
+
+
+def receive(conn):
+    '''The request on conn and the client's standard stream fds.'''
+    data, fds, flags, addr = socket.recv_fds(conn, MAX_REQUEST, 3)
+    while not data.endswith(b'\n'):
+        more = conn.recv(MAX_REQUEST)
+        if not more:
+            raise ValueError('truncated request')
+        data += more
+    return json.loads(data), fds
+
+
+def run_script(request, fds):
+    '''Run the requested script in this (forked) process and return its exit status.'''
+    import runpy
+    for fd, stdfd in zip(fds, (0, 1, 2)):
+        os.dup2(fd, stdfd)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.environ.pop('PIPELINE_JOBSERVER', None) # the script runs here, not in another client
+    sys.argv = request['argv']
+    try:
+        runpy.run_path(request['script'], run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+
+
+def start(request, fds, listener):
+    '''
+    Fork a child for request in its own process group; return its pid and
+    the read end of a pipe that sees EOF when the child exits.
+    '''
+    done_r, done_w = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            os.close(done_r)
+            listener.close()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = run_script(request, fds)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status) # done_w closes with the child and everything it started
+    os.close(done_w)
+    for fd in fds:
+        os.close(fd)
+    return pid, done_r
+
+
+def serve(path):
+    preload()
+    if os.path.exists(path):
+        os.remove(path) # left over from a server that was killed
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177) # runs execute as this user, so only this user may connect
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    jobs = set()
+    print('jobserver: listening on %s' % path)
+    try:
+        while True:
+            for key, events in selector.select():
+                if key.fileobj is listener:
+                    conn, addr = listener.accept()
+                    try:
+                        conn.settimeout(5.0)
+                        request, fds = receive(conn)
+                        conn.settimeout(None)
+                    except (OSError, ValueError) as e:
+                        print('jobserver: bad request: %s' % e)
+                        conn.close()
+                        continue
+                    pid, done = start(request, fds, listener)
+                    job = (pid, conn, done)
+                    jobs.add(job)
+                    selector.register(conn, selectors.EVENT_READ, job)
+                    selector.register(done, selectors.EVENT_READ, job)
+                elif key.data in jobs:
+                    pid, conn, done = key.data
+                    jobs.remove(key.data) # conn and done can both be ready; finish the job once
+                    if key.fileobj is conn:
+                        # the client sends nothing after its request, so this is it going away
+                        try:
+                            os.killpg(pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                    status = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+                    selector.unregister(conn)
+                    selector.unregister(done)
+                    os.close(done)
+                    try:
+                        conn.sendall(b'%d\n' % (status if status >= 0 else 128 - status))
+                    except OSError:
+                        pass
+                    conn.close()
+    finally:
+        listener.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    elif os.environ.get('PIPELINE_JOBSERVER'):
+        path = os.environ['PIPELINE_JOBSERVER']
+    else:
+        sys.exit('usage: python jobserver.py SOCKET (or set PIPELINE_JOBSERVER)')
+    # The shared pipeline modules are preloaded from this directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # so the socket is removed
+    try:
+        serve(path)
+    except KeyboardInterrupt:
+        pass
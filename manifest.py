@@ -0,0 +1,81 @@
+"""
+Checkpoint/resume manifest for the PRESTO pipeline
+
+Every completed task is appended as one JSON line to a manifest file in
+the working directory ('subbands/manifest.jsonl'), with its command line
+and the size and mtime of each output file it wrote. On restart a task
+is skipped only if its entry is present and all of those outputs are
+still on disk unchanged, so a crashed run reschedules just the missing
+work. Records are written from the main process only.
+
+Task names are '<stage>:<first input or output>', e.g.
+'realfft:Sband_DM10.00.dat', and are shared by mpi_pipeline_py3.py and
+the steps/*.py scripts so either can resume the other's run.
+"""
+import os
+import json
+import threading
+
+
+class Manifest(object):
+    """
+    Output names are relative to root (default: the current directory),
+    the directory the tasks run in.
+    """
+
+    def __init__(self, path='manifest.jsonl', root=''):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.access(path, os.F_OK):
+            with open(path) as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # last line torn by a crash
+                    self.entries[entry['task']] = entry
+        self.file = open(path, 'at')
+
+    def done(self, task):
+        """True if task completed and its outputs are unchanged since."""
+        entry = self.entries.get(task)
+        if entry is None:
+            return False
+        for name, (size, mtime) in entry['outputs'].items():
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime != mtime:
+                return False
+        return True
+
+    def pending(self, items, task):
+        """The items whose task(item) name is not done yet."""
+        return [item for item in items if not self.done(task(item))]
+
+    def record(self, task, cmd, outputs):
+        """
+        Record task as completed by cmd, writing the outputs that exist.
+        A task that wrote none of its outputs is not recorded.
+        """
+        files = {}
+        for name in outputs:
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            files[name] = (st.st_size, st.st_mtime)
+        if not files:
+            return False
+        entry = {'task': task, 'cmd': cmd, 'outputs': files}
+        with self.lock:
+            self.entries[task] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+        return True
+
+    def close(self):
+        self.file.close()
@@ -8,24 +8,57 @@ zhuwwpku@gmail.com
 Modified by EAFIT University's team, ASC20-21
 2020-12-29
 """
-import os, sys, glob, re
+import os, sys, glob, re, shutil, tempfile, asyncio
 from subprocess import getoutput
 import numpy as np
 
 # Since we are using PRESTO v3.0.1
 from presto import sifting
-from operator import attrgetter
+from operator import attrgetter, itemgetter
+from itertools import groupby
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from executor import get_executor, parse_args
+from scheduler import StreamScheduler, ranked_results, ordered_results, unordered_results
+from failures import TaskFailed, FailureReport, retried, RETRIES, RETRY_BACKOFF
+from manifest import Manifest
+from results import ResultsIndex, by_sigma
+from foldbudget import FoldBudget, fold_cost, parse_budget
+from cache import ResultCache
+from staging import staged
+import dedisp
+import fdmt
+import ddplan as planner
+import chunking
+from speculate import speculative_results
+import resources
+from runner import Runner, summary
+from resources import stage_of, MemoryLimiter, prepsubband_memory, dedisp_memory, fdmt_memory, realfft_memory, accelsearch_memory
 
 from io import StringIO
 #For profiling
 import cProfile, pstats
 PROFILE = False #Change to False unless you need to find out bottlenecks
+STREAMING = True #Start realfft/accelsearch on each .dat as soon as prepsubband writes it
+DDPLAN_PLOT = False #Also run DDplan.py to draw the plan in DDplan.ps (ddplan.py makes the plan itself)
+FLAT_DDPLAN = True #Submit every DDplan row at once, most expensive prepsubband calls first
+FUSED = False #Dedisperse, realfft and accelsearch each DM chunk back-to-back in node-local scratch
+SCRATCH_DIR = '/dev/shm' #Node-local scratch (tmpfs or local SSD) for FUSED tasks
+CACHE_DIR = os.environ.get('PIPELINE_CACHE_DIR') #Reuse tool outputs across runs when set
+NUMPY_DEDISPERSION = False #Dedisperse in-process with dedisp.py instead of running prepsubband twice per DM chunk
+SHARED_SUBBANDS = False #With NUMPY_DEDISPERSION, read the raw data once per DDplan row: its first chunk forms every chunk's subbands while the rest wait
+OPTIMIZE_CHUNKS = False #Split DDplan rows into more, smaller prepsubband calls when that finishes sooner on the workers (see chunking.py)
+CHUNK_COSTS = os.environ.get('PIPELINE_CHUNK_COSTS', 'chunk_costs.jsonl') #Run times of dedispersion calls that calibrate chunking.py's cost model; share one across runs by setting this
+FDMT_ROWS = () #Indices of the DDplan rows dedispersed with fdmt.py's tree dedispersion instead (best for rows with many DMs per call)
+STAGE_DIR = os.environ.get('PIPELINE_STAGE_DIR') #When set, the tools read the observation from a copy made once per node in this node-local directory
+CACHE_MAX_GB = float(os.environ.get('PIPELINE_CACHE_MAX_GB', 100)) #LRU eviction above this size
+ASYNC_RUNNER = False #Run the tools from one asyncio loop instead of the executor, each task's output going to logs/<task>.log
+ORDERED_LOGS = True #Keep mapped stages' logs in task order; False writes each result as soon as it finishes
+REORDER_WINDOW = 256 #At most this many tasks of a mapped stage in flight or waiting to be logged
+SPECULATE = True #Rerun straggling accelsearch/prepfold tasks on idle workers and keep the first copy to finish
+MEMORY_AWARE = True #On a local pool, only start a task when its stage's memory fits in the node's free RAM
 
 
 #Tutorial_Mode = True
@@ -43,39 +76,279 @@ zmax = 0
 def query(question, answer, input_type):
     print("Based on output of the last step, answer the following questions:")
     Ntry = 3
-    while not input_type(raw_input("%s:" % question)) == answer and Ntry > 0:
+    while not input_type(input("%s:" % question)) == answer and Ntry > 0:
         Ntry -= 1
         print("try again...")
     if Ntry == 0:print("The correct answer is:", answer)
 
+
+if CACHE_DIR:
+    result_cache = ResultCache(CACHE_DIR, CACHE_MAX_GB * 2**30)
+else:
+    result_cache = None
+
+
+def run(cmd, inputs, outputs):
+    '''
+    getoutput(cmd), or the outputs of an earlier run of cmd on the same
+    inputs restored from the result cache. inputs are the files (or globs)
+    cmd reads and outputs the globs of the files it writes. The peak
+    memory of cmd is recorded for the MemoryLimiter (see resources.py).
+    cmd is retried while it exits non-zero, then raises TaskFailed.
+    '''
+    if result_cache is None:
+        return retried(resources.getstatusoutput, cmd)
+    return retried(partial(result_cache.getstatusoutput, inputs=inputs, outputs=outputs), cmd)
+
     
-def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
+def read_header(filename):
+    '''readfile's output for filename, and the header fields in it as a dict.'''
+    readheadercmd = 'readfile %s | iconv --to-code utf-8//IGNORE' % filename
+    output = getoutput(readheadercmd)
+    header = {}
+    for line in output.split('\n'):
+        items = line.split("=")
+        if len(items) > 1:
+            header[items[0].strip()] = items[1].strip()
+    return output, header
+
+
+def dedispersion_plan(header, psfile=None):
+    '''
+    The dedispersion plan for the observation described by header (see
+    ddplan.py): DDplan.py's table of it, and its rows (lowDM hiDM dDM
+    DownSamp dsubDM numDMs DMs_per_call calls work_fract). With psfile,
+    DDplan.py also draws it there.
+    '''
+    Nchan = int(header['Number of channels'])
+    tsamp = float(header['Sample time (us)']) * 1.e-6
+    BandWidth = float(header['Total Bandwidth (MHz)'])
+    fcenter = float(header['Central freq (MHz)'])
+    ddplan = planner.plan(maxDM, Nchan, tsamp, BandWidth, fcenter, Nsub)
+    if psfile:
+        planner.draw(psfile, maxDM, Nchan, tsamp, BandWidth, fcenter, Nsub)
+    return '\n'.join(planner.table(ddplan)), ddplan
+
+
+def input_path(path):
+    '''path, or its node-local copy when STAGE_DIR is set (see staging.py).'''
+    if STAGE_DIR:
+        return staged(path, STAGE_DIR)
+    return path
+
+
+def prepsubband_cmds(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
+    '''The two prepsubband command lines for one DM chunk: form the subbands, then dedisperse them.'''
     lodm = dml[0]
     subDM = np.mean(dml)
     if maskfile:
-        prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -mask ../%s -o %s %s" % (subDM, Nsub, subdownsamp, maskfile, rootname, '../'+filename)
+        prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -mask %s -o %s %s" % (subDM, Nsub, subdownsamp, input_path('../'+maskfile), rootname, input_path('../'+filename))
     else:
-        prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -o %s %s" % (subDM, Nsub, subdownsamp, rootname, '../'+filename)
-    output = getoutput(prepsubband)
-
+        prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -o %s %s" % (subDM, Nsub, subdownsamp, rootname, input_path('../'+filename))
     subnames = rootname+"_DM%.2f.sub[0-9]*" % subDM
     prepsubcmd = "prepsubband -nsub %(Nsub)d -lodm %(lowdm)f -dmstep %(dDM)f -numdms %(NDMs)d -numout %(Nout)d -downsamp %(DownSamp)d -o %(root)s %(subfile)s" % {
                 'Nsub':Nsub, 'lowdm':lodm, 'dDM':dDM, 'NDMs':NDMs, 'Nout':Nout, 'DownSamp':datdownsamp, 'root':rootname, 'subfile':subnames}
-    output = ''.join((output, getoutput(prepsubcmd))) # joining both outputs faster than '+='
+    return prepsubband, prepsubcmd
+
+
+def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
+    prepsubband, prepsubcmd = prepsubband_cmds(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml)
+    subDM = np.mean(dml)
+    rawfiles = ['../'+filename, '../'+maskfile] if maskfile else ['../'+filename]
+    output = run(prepsubband, rawfiles, [rootname+"_DM%.2f.sub*" % subDM])
+
+    subnames = rootname+"_DM%.2f.sub[0-9]*" % subDM
+    datfiles = dat_names(dml[0], dDM, NDMs)
+    output = ''.join((output, run(prepsubcmd, [subnames], dedisperse_outputs(datfiles)))) # joining both outputs faster than '+='
     stdout = ''.join((prepsubband, '\n', prepsubcmd, '\n'))
     return output, stdout 
 
 
+def dedisperse_numpy(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml, subDMs=None):
+    '''
+    prepsubband_f done in-process by dedisp.py, with no .sub files. Given
+    the subDMs of every chunk in the row, the subbands come from the row's
+    shared .subbands.npy (see dedisp.shared_subbands).
+    '''
+    subDM = np.mean(dml)
+    datfiles = dat_names(dml[0], dDM, NDMs)
+    stdout = 'dedisp.py subDM %.2f: %s .. %s\n' % (subDM, datfiles[0], datfiles[-1])
+    shared = subDMs and (rootname+"_DM%.2f-%.2f.subbands.npy" % (subDMs[0], subDMs[-1]), subDMs)
+    output = dedisp.dedisperse(input_path('../'+filename), dedisp.dm_trials(dml[0], dDM, NDMs), datfiles, Nout, Nsub, subDM,
+                               subdownsamp, datdownsamp, maskfile and input_path('../'+maskfile), shared)
+    return output, stdout
+
+
+def dedisperse_fdmt(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
+    '''prepsubband_f done in-process by fdmt.py, at the row's whole downsampling with no subbands.'''
+    datfiles = dat_names(dml[0], dDM, NDMs)
+    stdout = 'fdmt.py: %s .. %s\n' % (datfiles[0], datfiles[-1])
+    output = fdmt.dedisperse(input_path('../'+filename), dedisp.dm_trials(dml[0], dDM, NDMs), datfiles, Nout,
+                             subdownsamp * datdownsamp, maskfile and input_path('../'+maskfile))
+    return output, stdout
+
+
+def write_logs(logfile, result):
+    for output, stdout in result:
+        logfile.write(output)
+        sys.stdout.write(stdout)
+
+
+def stage_results(executor, function, items, failures):
+    '''
+    (item, result) for function over items as the tasks finish, so a stage's
+    log is written while it runs rather than after its slowest task. Tasks
+    that fail go to failures and are left out.
+    '''
+    if hasattr(executor, 'map_tasks'):
+        #The hybrid backend runs a stage as per-node batches; a failed task's result is None
+        results = executor.map_tasks([(function, (item,)) for item in items], [1] * len(items), failures)
+        return [(item, result) for item, result in zip(items, results) if result is not None]
+    if ORDERED_LOGS:
+        return ordered_results(executor, function, items, REORDER_WINDOW, failures)
+    return unordered_results(executor, function, items, REORDER_WINDOW, failures)
+
+
+def log_result(logfile, result, failures):
+    # The tool's own output is in result.log; the stage log gets one line per task
+    logfile.write(summary(result))
+    sys.stdout.write(result.cmd + '\n')
+    if result.status != 0:
+        failures.add(result.name, TaskFailed(result.cmd, result.status, 'see %s' % result.log))
+
+
+def dat_names(lodm, dDM, NDMs):
+    # prepsubband parses -lodm/-dmstep from '%f' and names each series with '%.2f'
+    lodm, dDM = float("%f" % lodm), float("%f" % dDM)
+    return ["%s_DM%.2f.dat" % (rootname, lodm + ii*dDM) for ii in range(NDMs)]
+
+
+def dedisperse_step():
+    '''The function that dedisperses one DM chunk: dedisperse_numpy or prepsubband_f.'''
+    return dedisperse_numpy if NUMPY_DEDISPERSION else prepsubband_f
+
+
+def dedisperse_tasks(ddplan, Nsamp, filename, maskfile, step=None, costs=None):
+    '''
+    One (function, dml, datfiles, cost) task per prepsubband call in the DDplan,
+    where datfiles are the .dat files that call writes and cost is an
+    estimate of its run time (NDMs * Nout / DownSamp) used to rank it.
+    step replaces dedisperse_step() (or dedisperse_fdmt for the FDMT_ROWS),
+    e.g. with fused_search. With costs (a chunking.CostLog) and no step,
+    each call's run time is recorded there.
+    '''
+    tasks = []
+    for row, plan in enumerate(ddplan):
+        lowDM = float(plan['lowDM'])
+        hiDM = float(plan['hiDM'])
+        dDM = float(plan['dDM'])
+        DownSamp = int(plan['DownSamp'])
+        NDMs = int(plan['DMs_per_call'])
+        calls = int(plan['calls'])
+        Nout = Nsamp/DownSamp 
+        Nout -= (Nout % 500)
+        dmlist = np.split(np.arange(lowDM, hiDM, dDM), calls)
+
+        subdownsamp = DownSamp/2
+        datdownsamp = 2
+        if DownSamp < 2: subdownsamp = datdownsamp = 1
+
+        rowstep = step or (dedisperse_fdmt if row in FDMT_ROWS else dedisperse_step())
+        function = partial(rowstep, lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile) # for passing several params to Executor.map
+        if rowstep is dedisperse_numpy and SHARED_SUBBANDS:
+            function = partial(function, subDMs=tuple(float(np.mean(dml)) for dml in dmlist))
+        if costs is not None and step is None:
+            function = costs.timed(function, Nsamp, DownSamp, NDMs)
+        for dml in dmlist:
+            tasks.append((function, dml, dat_names(dml[0], dDM, NDMs), NDMs*Nout/DownSamp))
+    return tasks
+
+
+def realfft_cmd(df):
+    return "realfft %s" % df
+
+
 def realfft(df): 
-    fftcmd = "realfft %s" % df
+    fftcmd = realfft_cmd(df)
     stdout = "%s\n" % fftcmd
-    return getoutput(fftcmd), stdout
+    return run(fftcmd, [df], [df[:-4]+'.fft']), stdout
+
+
+def accelsearch_cmd(fft_file):
+    return "accelsearch -zmax %d %s"  % (zmax, fft_file)
 
 
 def accelsearch(fft_file):
-    searchcmd = "accelsearch -zmax %d %s"  % (zmax, fft_file)
+    searchcmd = accelsearch_cmd(fft_file)
     stdout = "%s\n" % searchcmd
-    return getoutput(searchcmd), stdout
+    return run(searchcmd, [fft_file, fft_file[:-4]+'.inf'], [fft_file[:-4]+'_ACCEL_%d*' % zmax]), stdout
+
+
+def fused_search(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
+    '''
+    prepsubband_f, realfft and accelsearch for one DM chunk on one worker,
+    run in a scratch directory under SCRATCH_DIR. Each intermediate file is
+    removed as soon as the next step has read it, and only the .inf and
+    ACCEL files are copied back to the working directory. It changes the
+    worker's directory, so it needs a process, mpi or serial executor.
+    '''
+    resultdir = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix=rootname+'_', dir=SCRATCH_DIR)
+    workdir = os.path.join(scratch, 'work')
+    os.mkdir(workdir)
+    #prepsubband_f reads '../'+filename, so link the inputs next to workdir
+    for infile in (filename, maskfile):
+        if infile:
+            link = os.path.join(scratch, infile)
+            if not os.access(os.path.dirname(link), os.F_OK):
+                os.makedirs(os.path.dirname(link))
+            os.symlink(os.path.abspath(os.path.join(resultdir, '..', infile)), link)
+
+    os.chdir(workdir)
+    try:
+        output, stdout = dedisperse_step()(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml)
+        outputs, stdouts = [output], [stdout]
+        for subfile in glob.glob('*.sub*'):
+            os.remove(subfile)
+        for df in dat_names(dml[0], dDM, NDMs):
+            if not os.access(df, os.F_OK):
+                continue
+            for step, infile in ((realfft, df), (accelsearch, df[:-4]+'.fft')):
+                output, stdout = step(infile)
+                outputs.append(output)
+                stdouts.append(stdout)
+                os.remove(infile)
+        for result in glob.glob('*.inf') + glob.glob('*_ACCEL_%d*' % zmax):
+            shutil.copy(result, resultdir)
+    finally:
+        os.chdir(resultdir)
+        shutil.rmtree(scratch)
+    return ''.join(outputs), ''.join(stdouts)
+
+
+def dedisperse_outputs(datfiles):
+    return datfiles + [df[:-4]+'.inf' for df in datfiles]
+
+
+def accel_outputs(fft_file):
+    return glob.glob(fft_file[:-4]+'_ACCEL_%d*' % zmax)
+
+
+def fused_outputs(datfiles):
+    return [df[:-4]+'.inf' for df in datfiles] + [f for df in datfiles for f in accel_outputs(df[:-4]+'.fft')]
+
+
+def fold_task(cand):
+    return 'prepfold:%s_%.12g' % (cand.DMstr, cand.p)
+
+
+def fold_prefix(cand):
+    # prepfold -p names its outputs <root>_DM<DMstr>_<P>ms_Cand.*; the period leaves out other candidates at the same DM
+    return '%s_DM%s_%.2fms_' % (rootname, cand.DMstr, cand.p * 1000.0)
+
+
+def fold_outputs(cand):
+    return glob.glob(fold_prefix(cand) + '*.pfd*')
 
                      
 def ACCEL_sift(zmax):
@@ -155,15 +428,23 @@ def ACCEL_sift(zmax):
     return cands
 
 
+def prepfold_cmd(filename, cand):
+    return "prepfold -n %(Nint)d -nsub %(Nsub)d -dm %(dm)f -p %(period)f %(filfile)s -o %(outfile)s -noxwin -nodmsearch" % {
+                'Nint':Nint, 'Nsub':Nsub, 'dm':cand.DM,  'period':cand.p, 'filfile':input_path(filename), 'outfile':rootname+'_DM'+cand.DMstr} #full plots
+
+
 def prepfold(filename, cand):
-    foldcmd = "prepfold -n %(Nint)d -nsub %(Nsub)d -dm %(dm)f -p %(period)f %(filfile)s -o %(outfile)s -noxwin -nodmsearch" % {
-                'Nint':Nint, 'Nsub':Nsub, 'dm':cand.DM,  'period':cand.p, 'filfile':filename, 'outfile':rootname+'_DM'+cand.DMstr} #full plots
+    foldcmd = prepfold_cmd(filename, cand)
     stdout = "%s\n" % foldcmd
-    return getoutput(foldcmd), stdout
+    return run(foldcmd, [filename], [fold_prefix(cand) + '*']), stdout
                      
 
 if __name__ == "__main__":
 
+    #--executor/--workers choose the backend for every stage (see executor.py)
+    backend, workers = parse_args(sys.argv)
+    #--fold-budget SECONDS folds candidates only while they fit in that much wall-clock time (see foldbudget.py)
+    fold_budget = parse_budget(sys.argv)
     filename = sys.argv[1]
     if len(sys.argv) > 2:
         maskfile = sys.argv[2]
@@ -181,17 +462,10 @@ if __name__ == "__main__":
         pr = cProfile.Profile()
         pr.enable()
 
-    readheadercmd = 'readfile %s | iconv --to-code utf-8//IGNORE' % filename
-    print(readheadercmd)
-    output = getoutput(readheadercmd)
+    print('readfile %s' % filename)
+    output, header = read_header(filename)
     print(output)
 
-    header = {}
-    for line in output.split('\n'):
-        items = line.split("=")
-        if len(items) > 1:
-            header[items[0].strip()] = items[1].strip()
-
 
     if PROFILE:
         pr.disable()
@@ -226,32 +500,15 @@ if __name__ == "__main__":
             print('see how these numbers are used in the next step.')
             print('')
 
-        ddplancmd = 'DDplan.py -d %(maxDM)s -n %(Nchan)d -b %(BandWidth)s -t %(tsamp)f -f %(fcenter)f -s %(Nsub)s -o DDplan.ps' % {
-                'maxDM':maxDM, 'Nchan':Nchan, 'tsamp':tsamp, 'BandWidth':BandWidth, 'fcenter':fcenter, 'Nsub':Nsub}
-        print(ddplancmd)
-        ddplanout = getoutput(ddplancmd)
+        ddplanout, ddplan = dedispersion_plan(header, 'DDplan.ps' if DDPLAN_PLOT else None)
         print(ddplanout)
-        planlist = ddplanout.split('\n')
-        ddplan = []
-        planlist.reverse()
-        for plan in planlist:
-            if plan == '':
-                continue
-            elif plan.strip().startswith('Low DM'):
-                break
-            else:
-                ddplan.append(plan)
-        ddplan.reverse()
     except:
         print('failed at generating DDplan.')
         sys.exit(0)
 
 
     if Tutorial_Mode:
-        calls = 0
-        for line in ddplan:
-            ddpl = line.split()
-            calls += int(ddpl[7])
+        calls = int(ddplan['calls'].sum())
         query("According to the DDplan, how many times in total do we have to call prepsubband?", calls, int)
         print('see how these numbers are used in the next step.')
         print('')
@@ -277,8 +534,36 @@ if __name__ == "__main__":
 
     #Multiprocessing Pool definition
     #Made this way to have only one pool along the entire script
-    cores = mp.cpu_count()
-    pool = mp.Pool(cores)
+    executor = get_executor(backend, workers, wdir=os.getcwd())
+    if hasattr(executor, 'map_tasks'):
+        #The hybrid backend runs batches per node, so its stages are mapped, not streamed
+        STREAMING = False
+    costs = None
+    if OPTIMIZE_CHUNKS:
+        costs = chunking.CostLog(CHUNK_COSTS, Nchan, Nsub)
+        if os.access('chunks.npy', os.F_OK):
+            #A restart keeps the chunks its manifest was written for
+            ddplan = np.load('chunks.npy')
+        else:
+            model = costs.model(stage_of(dedisperse_step()))
+            ddplan = chunking.optimize(ddplan, model, executor.workers, Nchan, Nsub, Nsamp, keep=FDMT_ROWS)
+            np.save('chunks.npy', ddplan)
+        print('\n'.join(planner.table(ddplan)))
+    if MEMORY_AWARE and isinstance(executor, (ProcessPoolExecutor, ThreadPoolExecutor)):
+        #Per-task memory of each stage for the longest series; measured peaks replace these as tasks finish
+        maxNDMs = int(ddplan['DMs_per_call'].max())
+        estimates = {'prepsubband_f': prepsubband_memory(Nchan, Nsub, maxNDMs, Nsamp),
+                     'dedisperse_numpy': dedisp_memory(Nchan, Nsub, Nsamp),
+                     'dedisperse_fdmt': fdmt_memory(Nchan, maxNDMs),
+                     'realfft': realfft_memory(Nsamp),
+                     'accelsearch': accelsearch_memory(Nsamp, zmax)}
+        estimates['fused_search'] = max(estimates.values())
+        executor = MemoryLimiter(executor, estimates)
+
+    #Completed tasks of an earlier run of this observation are skipped
+    manifest = Manifest('manifest.jsonl')
+    #Tasks that still fail after their retries are reported here and the rest carry on
+    failures = FailureReport('failed_tasks.jsonl')
         
     print('''
 
@@ -290,30 +575,124 @@ if __name__ == "__main__":
         pr = cProfile.Profile()
         pr.enable()
 
+    if ASYNC_RUNNER:
+        runner = Runner(workers or os.cpu_count(), retries=RETRIES, backoff=RETRY_BACKOFF)
+
     try:
-        logfile = open('dedisperse.log', 'wt')
-        for line in ddplan:
-            ddpl = line.split()
-            lowDM = float(ddpl[0])
-            hiDM = float(ddpl[1])
-            dDM = float(ddpl[2])
-            DownSamp = int(ddpl[3])
-            NDMs = int(ddpl[6])
-            calls = int(ddpl[7])
-            Nout = Nsamp/DownSamp 
-            Nout -= (Nout % 500)
-            dmlist = np.split(np.arange(lowDM, hiDM, dDM), calls)
-            
-            subdownsamp = DownSamp/2
-            datdownsamp = 2
-            if DownSamp < 2: subdownsamp = datdownsamp = 1
-            
-            function = partial(prepsubband_f, lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile) # for passing several params to Executor.map
-            result = pool.map(function, dmlist)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
-            
+        if ASYNC_RUNNER:
+            #Each .dat is searched as soon as its prepsubband call finishes, at most 'workers' tools at a time
+            logfile = open('dedisperse.log', 'wt')
+            fftlog = open('fft.log', 'wt')
+            accellog = open('accelsearch.log', 'wt')
+
+            async def fft_search(df):
+                fftfile = df[:-4]+'.fft'
+                if not manifest.done('realfft:'+df):
+                    result = await runner.run('realfft_'+df[:-4], [realfft_cmd(df)], [fftfile])
+                    log_result(fftlog, result, failures)
+                    if result.status != 0:
+                        return
+                    manifest.record('realfft:'+df, result.cmd, result.outputs)
+                if not manifest.done('accelsearch:'+fftfile):
+                    result = await runner.run('accelsearch_'+df[:-4], [accelsearch_cmd(fftfile)], [fftfile[:-4]+'_ACCEL_%d*' % zmax])
+                    log_result(accellog, result, failures)
+                    if result.status == 0:
+                        manifest.record('accelsearch:'+fftfile, result.cmd, result.outputs)
+
+            async def search(commands, dml, datfiles):
+                if not manifest.done('prepsubband:'+datfiles[0]):
+                    result = await runner.run('prepsubband_'+datfiles[0][:-4], commands(dml), dedisperse_outputs(datfiles))
+                    log_result(logfile, result, failures)
+                    if result.status != 0:
+                        return
+                    manifest.record('prepsubband:'+datfiles[0], result.cmd, result.outputs)
+                await asyncio.gather(*[fft_search(df) for df in datfiles if os.access(df, os.F_OK)])
+
+            tasks = dedisperse_tasks(ddplan, Nsamp, filename, maskfile, step=prepsubband_cmds)
+            tasks.sort(key=itemgetter(3), reverse=True)
+            asyncio.run(runner.gather(search(commands, dml, datfiles) for commands, dml, datfiles, _ in tasks))
+            fftlog.close()
+            accellog.close()
+
+        elif FUSED:
+            #One task per DM chunk does the whole fft search; the logs all go to dedisperse.log
+            logfile = open('dedisperse.log', 'wt')
+            tasks = manifest.pending(dedisperse_tasks(ddplan, Nsamp, filename, maskfile, step=fused_search), lambda t: 'fused:'+t[2][0])
+            #Each chunk is checkpointed as soon as it finishes; failed ones are in failed_tasks.jsonl
+            results = ranked_results(executor, [(function, (dml,)) for function, dml, _, _ in tasks], [cost for _, _, _, cost in tasks], failures)
+            for ii, task_result in results:
+                datfiles = tasks[ii][2]
+                write_logs(logfile, [task_result])
+                manifest.record('fused:'+datfiles[0], task_result[1], fused_outputs(datfiles))
+
+        elif STREAMING:
+            #Every .dat goes to realfft, and every .fft to accelsearch, as soon as it is written
+            logfile = open('dedisperse.log', 'wt')
+            fftlog = open('fft.log', 'wt')
+            accellog = open('accelsearch.log', 'wt')
+            scheduler = StreamScheduler(executor, failures)
+
+            #Each after_* callback checkpoints its task (result is None if it was
+            #already done) and returns the follow-up tasks still to run
+            def after_accelsearch(fftfile, result):
+                manifest.record('accelsearch:'+fftfile, result[1], accel_outputs(fftfile))
+                return []
+
+            def after_realfft(df, result):
+                fftfile = df[:-4]+'.fft'
+                if result is not None:
+                    manifest.record('realfft:'+df, result[1], [fftfile])
+                if manifest.done('accelsearch:'+fftfile):
+                    return []
+                return [(accelsearch, (fftfile,), accellog, partial(after_accelsearch, fftfile))]
+
+            def after_prepsubband(datfiles, result):
+                if result is not None:
+                    manifest.record('prepsubband:'+datfiles[0], result[1], dedisperse_outputs(datfiles))
+                tasks = []
+                for df in datfiles:
+                    if not os.access(df, os.F_OK):
+                        continue
+                    if manifest.done('realfft:'+df):
+                        tasks.extend(after_realfft(df, None))
+                    else:
+                        tasks.append((realfft, (df,), fftlog, partial(after_realfft, df)))
+                return tasks
+
+            tasks = dedisperse_tasks(ddplan, Nsamp, filename, maskfile, costs=costs)
+            if FLAT_DDPLAN:
+                tasks.sort(key=itemgetter(3), reverse=True)
+            for function, dml, datfiles, cost in tasks:
+                if manifest.done('prepsubband:'+datfiles[0]):
+                    for task in after_prepsubband(datfiles, None):
+                        scheduler.submit(*task)
+                else:
+                    scheduler.submit(function, (dml,), logfile, partial(after_prepsubband, datfiles))
+            scheduler.join()
+            fftlog.close()
+            accellog.close()
+
+        elif FLAT_DDPLAN:
+            #The whole DDplan in one pass; each call is logged and checkpointed as soon as it finishes
+            logfile = open('dedisperse.log', 'wt')
+            tasks = manifest.pending(dedisperse_tasks(ddplan, Nsamp, filename, maskfile, costs=costs), lambda t: 'prepsubband:'+t[2][0])
+            results = ranked_results(executor, [(function, (dml,)) for function, dml, _, _ in tasks], [cost for _, _, _, cost in tasks], failures)
+            for ii, task_result in results:
+                datfiles = tasks[ii][2]
+                write_logs(logfile, [task_result])
+                manifest.record('prepsubband:'+datfiles[0], task_result[1], dedisperse_outputs(datfiles))
+
+        else:
+            logfile = open('dedisperse.log', 'wt')
+            #One stage per DDplan row; the tasks of a row share the same partial, keyed here by their first DM
+            tasks = manifest.pending(dedisperse_tasks(ddplan, Nsamp, filename, maskfile, costs=costs), lambda t: 'prepsubband:'+t[2][0])
+            for function, row in groupby(tasks, key=itemgetter(0)):
+                row = dict((dml[0], (dml, datfiles)) for _, dml, datfiles, _ in row)
+                for dml, (output, stdout) in stage_results(executor, function, [dml for dml, _ in row.values()], failures):
+                    write_logs(logfile, [(output, stdout)])
+                    datfiles = row[dml[0]][1]
+                    manifest.record('prepsubband:'+datfiles[0], stdout, dedisperse_outputs(datfiles))
+
         os.system('rm *.sub*')
         logfile.close()
 
@@ -338,53 +717,59 @@ if __name__ == "__main__":
 
     ''')                    
 
-    try:
-
-        if PROFILE:
-            pr = cProfile.Profile()
-            pr.enable()
-
-        datfiles = glob.glob("*.dat")
-        with open('fft.log', 'wt') as logfile:
-            result = pool.map(realfft, datfiles)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
-
-        if PROFILE:
-            pr.disable()
-            s = StringIO()
-            sortby = 'cumulative'
-            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            ps.print_stats()
-            print(s.getvalue())
+    #In streaming, fused and asyncio modes realfft and accelsearch already ran alongside prepsubband
+    if not (STREAMING or FUSED or ASYNC_RUNNER):
+        try:
+
+            if PROFILE:
+                pr = cProfile.Profile()
+                pr.enable()
+
+            datfiles = manifest.pending(glob.glob("*.dat"), lambda df: 'realfft:'+df)
+            with open('fft.log', 'wt') as logfile:
+                for df, (output, stdout) in stage_results(executor, realfft, datfiles, failures):
+                    write_logs(logfile, [(output, stdout)])
+                    manifest.record('realfft:'+df, stdout, [df[:-4]+'.fft'])
+
+            if PROFILE:
+                pr.disable()
+                s = StringIO()
+                sortby = 'cumulative'
+                ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
+                ps.print_stats()
+                print(s.getvalue())
         
 
-        if PROFILE:
-            pr = cProfile.Profile()
-            pr.enable()
+            if PROFILE:
+                pr = cProfile.Profile()
+                pr.enable()
 
                         
-        fftfiles = glob.glob("*.fft")
-        with open('accelsearch.log', 'wt') as logfile:
-            result = pool.map(accelsearch, fftfiles)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
-
-        if PROFILE:
-            pr.disable()
-            s = StringIO()
-            sortby = 'cumulative'
-            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-            ps.print_stats()
-            print(s.getvalue())
+            fftfiles = manifest.pending(glob.glob("*.fft"), lambda fftfile: 'accelsearch:'+fftfile)
+            with open('accelsearch.log', 'wt') as logfile:
+                if SPECULATE and not hasattr(executor, 'map_tasks'):
+                    tasks = [(fftfile, accelsearch_cmd(fftfile), [fftfile, fftfile[:-4]+'.inf'], [fftfile[:-4]+'_ACCEL_%d*' % zmax]) for fftfile in fftfiles]
+                    results = speculative_results(executor, tasks, executor.workers, RETRIES, failures, stage='accelsearch',
+                                                  cache=result_cache)
+                else:
+                    results = stage_results(executor, accelsearch, fftfiles, failures)
+                for fftfile, (output, stdout) in results:
+                    write_logs(logfile, [(output, stdout)])
+                    manifest.record('accelsearch:'+fftfile, stdout, accel_outputs(fftfile))
+
+            if PROFILE:
+                pr.disable()
+                s = StringIO()
+                sortby = 'cumulative'
+                ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
+                ps.print_stats()
+                print(s.getvalue())
                         
 
-    except Exception as e:
-        print('failed at fft search.', e)
-        os.chdir(cwd)
-        sys.exit(0)
+        except Exception as e:
+            print('failed at fft search.', e)
+            os.chdir(cwd)
+            sys.exit(0)
 
 
     print('''
@@ -419,25 +804,66 @@ if __name__ == "__main__":
         pr.enable()
         
 
-    #===========================
-    #Since we moved to 'subbands', let's come back
-
-    pool.close()
-
     try:
-        #MPI Pool definition
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        executor = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
         os.system('ln -s ../%s %s' % (filename, filename))
+        #Highest sigma first, each fold published to results.jsonl/.txt as soon as it finishes
+        index = ResultsIndex('results.jsonl')
         with open('folding.log', 'wt') as logfile:
             function = partial(prepfold, filename)
-            result = executor.map(function, cands)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
+            cands = by_sigma(manifest.pending(cands, fold_task))
+            budget = None
+            if fold_budget is not None and hasattr(executor, 'map_tasks'):
+                print('--fold-budget needs a streaming backend; folding every candidate on the hybrid backend')
+            elif fold_budget is not None:
+                budget = FoldBudget(fold_budget, partial(fold_cost, Nint=Nint, Nsub=Nsub, Nchan=Nchan, Nsamp=Nsamp, tsamp=tsamp))
+                #Candidates are taken one at a time as workers free up, while they still fit in the budget
+                queue = budget.admitted(cands)
+            if ASYNC_RUNNER:
+                async def fold(cand):
+                    result = await runner.run('prepfold_%s_%.12g' % (cand.DMstr, cand.p), [prepfold_cmd(filename, cand)],
+                                              [fold_prefix(cand) + '*.pfd*'])
+                    log_result(logfile, result, failures)
+                    if result.status == 0:
+                        manifest.record(fold_task(cand), result.cmd, result.outputs)
+                        index.publish(cand, result.outputs)
+                        if budget is not None:
+                            budget.finished(cand)
+                async def folder(queue):
+                    for cand in queue:
+                        await fold(cand)
+                if budget is not None:
+                    asyncio.run(runner.gather(folder(queue) for ii in range(runner.limit)))
+                else:
+                    asyncio.run(runner.gather(fold(cand) for cand in cands))
+            else:
+                if budget is not None:
+                    #Speculative copies would spend the budget twice; one fold per worker keeps the timing honest
+                    results = unordered_results(executor, function, queue, executor.workers, failures)
+                elif SPECULATE and not hasattr(executor, 'map_tasks'):
+                    #The command is made on the worker, which reads its own staged copy
+                    tasks = [(cand, partial(prepfold_cmd, filename, cand), [filename], [fold_prefix(cand) + '*']) for cand in cands]
+                    results = speculative_results(executor, tasks, executor.workers, RETRIES, failures, stage='prepfold',
+                                                  cache=result_cache)
+                elif not hasattr(executor, 'map_tasks'):
+                    #Completion order whatever ORDERED_LOGS says, so a fold is published the moment it is done
+                    results = unordered_results(executor, function, cands, REORDER_WINDOW, failures)
+                else:
+                    results = stage_results(executor, function, cands, failures)
+                for cand, (output, stdout) in results:
+                    write_logs(logfile, [(output, stdout)])
+                    outputs = fold_outputs(cand)
+                    manifest.record(fold_task(cand), stdout, outputs)
+                    index.publish(cand, outputs)
+                    if budget is not None:
+                        budget.finished(cand)
+            if budget is not None and budget.deferred:
+                #Not in the manifest, so a rerun with a bigger budget folds just these
+                sifting.write_candlist(budget.deferred, 'deferred_cands.txt')
+                print('fold budget used up: %d candidates deferred to deferred_cands.txt' % len(budget.deferred))
+        index.close()
+        manifest.close()
         
-        #Close MPI processes and do not wait till it is done
+        #Close the workers and do not wait till it is done
         executor.shutdown(wait = False)
         
     except:
@@ -455,3 +881,7 @@ if __name__ == "__main__":
         print(s.getvalue())
 
     os.chdir(cwd)
+    failures.close()
+    if len(failures):
+        print(failures.summary())
+        sys.exit(1)
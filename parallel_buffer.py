@@ -19,10 +19,14 @@ from operator import attrgetter
 # For multiprocessing (parallelism)
 import multiprocessing as mp
 from functools import partial
+from collections import deque
+from itertools import islice
 
 #For profiling
 import cProfile, pstats, StringIO
 PROFILE = True #Change to False unless you need to find out bottlenecks
+ORDERED_LOGS = True #Keep the logs in task order; False writes each result as soon as it finishes
+REORDER_WINDOW = 256 #At most this many tasks in flight or waiting for their turn in the logs
 
 
 #Tutorial_Mode = True
@@ -70,6 +74,32 @@ def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, dml):
     return output, stdout 
 
 
+def stage_results(function, items):
+    '''
+    Yield the (output, stdout) of function(item) for every item as the
+    tasks finish, so logs are written while the stage runs and no more
+    than REORDER_WINDOW results are held at once.
+    '''
+    if not ORDERED_LOGS:
+        for result in pool.imap_unordered(function, items):
+            yield result
+        return
+    items = iter(items)
+    pending = deque(pool.apply_async(function, (item,)) for item in islice(items, REORDER_WINDOW))
+    while pending:
+        result = pending.popleft().get()
+        for item in islice(items, 1):
+            pending.append(pool.apply_async(function, (item,)))
+        yield result
+
+
+def write_logs(logfile, results):
+    for output, stdout in results:
+        logfile.write(output)
+        sys.stdout.write(stdout)
+        sys.stdout.flush()
+
+
 def realfft(df): 
     fftcmd = "realfft %s" % df
     stdout = "%s\n" % fftcmd
@@ -304,10 +334,7 @@ try:
         if DownSamp < 2: subdownsamp = datdownsamp = 1
         
         function = partial(prepsubband_f, lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp) # for passing several params to Pool.map
-        result = pool.map(function, dmlist)
-        output, stdout = zip(*result)
-        logfile.writelines(output)
-        sys.stdout.writelines(stdout)
+        write_logs(logfile, stage_results(function, dmlist))
         
     os.system('rm *.sub*')
     logfile.close()
@@ -341,10 +368,7 @@ if PROFILE:
 
 datfiles = glob.glob("*.dat")
 with open('fft.log', 'wt') as logfile:
-    result = pool.map(realfft, datfiles)
-    output, stdout = zip(*result)
-    logfile.writelines(output)
-    sys.stdout.writelines(stdout)
+    write_logs(logfile, stage_results(realfft, datfiles))
 
 if PROFILE:
     pr.disable()
@@ -361,10 +385,7 @@ if PROFILE:
                 
 fftfiles = glob.glob("*.fft")
 with open('accelsearch.log', 'wt') as logfile:
-    result = pool.map(accelsearch, fftfiles)
-    output, stdout = zip(*result)
-    logfile.writelines(output)
-    sys.stdout.writelines(stdout)
+    write_logs(logfile, stage_results(accelsearch, fftfiles))
 
 if PROFILE:
     pr.disable()
@@ -415,10 +436,7 @@ if PROFILE:
 try:
     os.system('ln -s ../%s %s' % (filename, filename))
     with open('folding.log', 'wt') as logfile:
-        result = pool.map(prepfold, cands)
-        output, stdout = zip(*result)
-        logfile.writelines(output)
-        sys.stdout.writelines(stdout)
+        write_logs(logfile, stage_results(prepfold, cands))
     
 except:
     print 'failed at folding candidates.'
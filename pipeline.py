@@ -5,9 +5,9 @@ Weiwei Zhu
 Max-Plank Institute for Radio Astronomy
 zhuwwpku@gmail.com
 """
-import os, sys, glob, re
+import os, sys, glob, re, time
 import sifting
-from commands import getoutput
+from commands import getoutput, getstatusoutput
 import numpy as np
 
 #Tutorial_Mode = True
@@ -19,6 +19,8 @@ Nsub = 32 #32 subbands
 Nint = 64 #64 sub integration
 Tres = 0.5 #ms
 zmax = 0
+retries = 2 #extra attempts for a command that exits non-zero
+backoff = 5. #seconds before the first retry, doubled for each one after
 
 filename = sys.argv[1]
 if len(sys.argv) > 2:
@@ -26,6 +28,24 @@ if len(sys.argv) > 2:
 else:
     maskfile = None
 
+failed = [] #(command, status) of the commands that failed after their retries
+
+def run(cmd):
+    '''
+    getstatusoutput(cmd), retried while cmd exits non-zero. A command that
+    still fails is added to failed and the pipeline carries on.
+    '''
+    for attempt in range(retries + 1):
+        status, output = getstatusoutput(cmd)
+        if status == 0:
+            break
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    if status != 0:
+        print 'failed with status %d: %s' % (status, cmd)
+        failed.append((cmd, status))
+    return status, output
+
 def query(question, answer, input_type):
     print "Based on output of the last step, answer the following questions:"
     Ntry = 3
@@ -149,8 +169,10 @@ try:
             else:
                 prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -o %s %s" % (subDM, Nsub, subdownsamp, rootname, '../'+filename)
             print prepsubband
-            output = getoutput(prepsubband)
+            status, output = run(prepsubband)
             logfile.write(output)
+            if status != 0:
+                continue
 
             subnames = rootname+"_DM%.2f.sub[0-9]*" % subDM
             #prepsubcmd = "prepsubband -nsub %(Nsub)d -lodm %(lowdm)f -dmstep %(dDM)f -numdms %(NDMs)d -numout %(Nout)d -downsamp %(DownSamp)d -o %(root)s ../%(filfile)s" % {
@@ -158,7 +180,7 @@ try:
             prepsubcmd = "prepsubband -nsub %(Nsub)d -lodm %(lowdm)f -dmstep %(dDM)f -numdms %(NDMs)d -numout %(Nout)d -downsamp %(DownSamp)d -o %(root)s %(subfile)s" % {
                     'Nsub':Nsub, 'lowdm':lodm, 'dDM':dDM, 'NDMs':NDMs, 'Nout':Nout, 'DownSamp':datdownsamp, 'root':rootname, 'subfile':subnames}
             print prepsubcmd
-            output = getoutput(prepsubcmd)
+            status, output = run(prepsubcmd)
             logfile.write(output)
     os.system('rm *.sub*')
     logfile.close()
@@ -182,7 +204,7 @@ try:
     for df in datfiles:
         fftcmd = "realfft %s" % df
         print fftcmd
-        output = getoutput(fftcmd)
+        status, output = run(fftcmd)
         logfile.write(output)
     logfile.close()
     logfile = open('accelsearch.log', 'wt')
@@ -190,7 +212,7 @@ try:
     for fftf in fftfiles:
         searchcmd = "accelsearch -zmax %d %s"  % (zmax, fftf)
         print searchcmd
-        output = getoutput(searchcmd)
+        status, output = run(searchcmd)
         logfile.write(output)
     logfile.close()
     os.chdir(cwd)
@@ -316,7 +338,7 @@ try:
                 'Nint':Nint, 'Nsub':Nsub, 'dm':cand.DM,  'period':cand.p, 'filfile':filename, 'outfile':rootname+'_DM'+cand.DMstr} #full plots
         print foldcmd
         #os.system(foldcmd)
-        output = getoutput(foldcmd)
+        status, output = run(foldcmd)
         logfile.write(output)
     logfile.close()
     os.chdir(cwd)
@@ -325,3 +347,9 @@ except:
     os.chdir(cwd)
     sys.exit(0)
 
+if failed:
+    with open('subbands/failed_tasks.txt', 'wt') as report:
+        for cmd, status in failed:
+            report.write('%d %s\n' % (status, cmd))
+    print '%d commands failed, see subbands/failed_tasks.txt' % len(failed)
+    sys.exit(1)
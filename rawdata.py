@@ -0,0 +1,392 @@
+"""
+Memory-mapped readers for raw search-mode data
+
+PSRFITS (.fits) and SIGPROC filterbank (.fil) files are mapped, not
+read: a block of samples is a NumPy view into the file, so a block
+costs only the pages it touches and an observation of any length is
+streamed in bounded memory. Header fields are typed attributes:
+
+    raw = rawdata.open_raw('obs.fits')
+    raw.nchan, raw.nspec, raw.tsamp, raw.freqs, raw.mjd, raw.source ...
+    for start, block in raw.blocks(2**16, overlap=maxdelay):
+        ...                                  # block is (samples, nchan)
+
+Samples are in file order: time then channel, with the channels in the
+file's frequency order (raw.freqs). samples() returns the stored values
+(a view where the file allows it); spectra() returns float32 with
+PSRFITS's scales, offsets and weights applied. Data of fewer than 8 bits
+per sample are unpacked (with unpack.py's lookup tables, which scale as
+they unpack for spectra()), so those blocks are copies, as are PSRFITS
+blocks that span subintegrations.
+
+    python rawdata.py FILE
+
+prints the header as readfile would summarise it.
+"""
+import os
+import re
+import sys
+import mmap
+import struct
+import numpy as np
+from unpack import unpack, Unpacker
+
+FITS_BLOCK = 2880 #Bytes in a FITS header or data block
+FITS_CARD = 80 #Bytes in a FITS header card
+
+#SIGPROC header keywords and how their values are stored
+SIGPROC_INTS = ('telescope_id', 'machine_id', 'data_type', 'barycentric', 'pulsarcentric',
+                'nbits', 'nsamples', 'nchans', 'nifs', 'nbeams', 'ibeam')
+SIGPROC_DOUBLES = ('tstart', 'tsamp', 'fch1', 'foff', 'refdm', 'az_start', 'za_start',
+                   'src_raj', 'src_dej', 'period')
+SIGPROC_STRINGS = ('source_name', 'rawdatafile')
+
+#Bytes per element of each FITS binary table column type
+TFORM_SIZES = {'L': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4, 'D': 8, 'C': 8, 'M': 16}
+TFORM_DTYPES = {'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8', 'E': '>f4', 'D': '>f8'}
+
+
+class RawFile(object):
+    '''
+    What PSRFITS and filterbank files have in common. Subclasses set the
+    header attributes and samples().
+    '''
+    path = None
+    nchan = 0 #Channels
+    nspec = 0 #Spectra (time samples)
+    nbits = 8 #Bits per sample
+    tsamp = 0.0 #Seconds per sample
+    freqs = None #MHz, centre of each channel in file order
+    mjd = 0.0 #Start of the observation
+    source = 'Unknown'
+    telescope = 'Unknown'
+    ra = '00:00:00.0000' #J2000, hh:mm:ss.ssss
+    dec = '00:00:00.0000' #J2000, dd:mm:ss.ssss
+    beam = 0.0 #FWHM in arcsec
+
+    @property
+    def chanwidth(self):
+        return abs(self.freqs[1] - self.freqs[0]) if self.nchan > 1 else 0.0
+
+    @property
+    def bandwidth(self):
+        return self.nchan * self.chanwidth
+
+    @property
+    def fcenter(self):
+        return 0.5 * (self.freqs.min() + self.freqs.max())
+
+    @property
+    def duration(self):
+        return self.nspec * self.tsamp
+
+    def samples(self, start, nspec):
+        raise NotImplementedError
+
+    def spectra(self, start, nspec):
+        """nspec spectra from sample start as float32 (nspec, nchan)."""
+        return np.asarray(self.samples(start, nspec), dtype=np.float32)
+
+    def blocks(self, nspec, overlap=0, start=0, stop=None, spectra=False):
+        '''
+        (first sample, block) for consecutive blocks of nspec samples from
+        start to stop, each with the overlap samples after it as well
+        (fewer at the end of the file). Blocks come from samples(), or
+        from spectra() if spectra is true.
+        '''
+        stop = self.nspec if stop is None else min(stop, self.nspec)
+        read = self.spectra if spectra else self.samples
+        for first in range(start, stop, nspec):
+            yield first, read(first, min(nspec + overlap, self.nspec - first))
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            pass # blocks handed out still use it; it is unmapped when they go
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Filterbank(RawFile):
+    """A SIGPROC filterbank file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, self.header_size = self.read_header(f)
+        header = self.header
+        self.nchan = header['nchans']
+        self.nifs = header.get('nifs', 1)
+        self.nbits = header['nbits']
+        self.tsamp = header['tsamp']
+        self.mjd = header['tstart']
+        self.freqs = header['fch1'] + header['foff'] * np.arange(self.nchan)
+        self.source = header.get('source_name', 'Unknown')
+        self.telescope = str(header.get('telescope_id', 'Unknown'))
+        self.ra = sigproc_angle(header.get('src_raj', 0.0))
+        self.dec = sigproc_angle(header.get('src_dej', 0.0))
+        bytes_per_spectrum = self.nifs * self.nchan * self.nbits // 8
+        self.nspec = (os.path.getsize(path) - self.header_size) // bytes_per_spectrum
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.nbits >= 8:
+            dtype = {8: 'i1' if header.get('signed') else 'u1', 16: '<u2', 32: '<f4'}[self.nbits]
+            self.data = np.ndarray((self.nspec, self.nifs, self.nchan), dtype=dtype, buffer=self.map, offset=self.header_size)
+        else:
+            self.data = np.ndarray((self.nspec, bytes_per_spectrum), dtype=np.uint8, buffer=self.map, offset=self.header_size)
+
+    @staticmethod
+    def read_header(f):
+        '''The header of the open filterbank file f as a dict, and its size in bytes.'''
+        def string():
+            size = f.read(4)
+            length = struct.unpack('<i', size)[0] if len(size) == 4 else 0
+            if not 0 < length < 80:
+                raise ValueError('%s is not a SIGPROC filterbank file' % f.name)
+            return f.read(length).decode()
+        if string() != 'HEADER_START':
+            raise ValueError('%s is not a SIGPROC filterbank file' % f.name)
+        header = {}
+        while True:
+            key = string()
+            if key == 'HEADER_END':
+                return header, f.tell()
+            elif key in SIGPROC_INTS:
+                header[key] = struct.unpack('<i', f.read(4))[0]
+            elif key in SIGPROC_DOUBLES:
+                header[key] = struct.unpack('<d', f.read(8))[0]
+            elif key in SIGPROC_STRINGS:
+                header[key] = string()
+            elif key == 'signed':
+                header[key] = struct.unpack('<b', f.read(1))[0]
+            else:
+                raise ValueError('%s: unknown SIGPROC header keyword %s' % (f.name, key))
+
+    def samples(self, start, nspec):
+        """nspec samples of the first IF from sample start, (nspec, nchan); a view unless nbits < 8."""
+        if self.nbits >= 8:
+            return self.data[start:start + nspec, 0]
+        return unpack(self.data[start:start + nspec], self.nbits)[:, :self.nchan]
+
+    def spectra(self, start, nspec):
+        """nspec spectra from sample start as float32 (nspec, nchan)."""
+        if self.nbits > 8 or self.header.get('signed'):
+            return RawFile.spectra(self, start, nspec)
+        return Unpacker(self.nbits, self.nchan)(self.data[start:start + nspec, :self.nchan * self.nbits // 8] if self.nbits < 8
+                                                else self.data[start:start + nspec, 0])
+
+
+def sigproc_angle(value):
+    # SIGPROC stores angles as ddmmss.s; PRESTO's .inf wants dd:mm:ss.ssss
+    sign = '-' if value < 0 else ''
+    value = abs(value)
+    return '%s%02d:%02d:%07.4f' % (sign, value // 10000, (value // 100) % 100, value % 100)
+
+
+def fits_value(text):
+    # the value of a FITS header card, without its comment
+    text = text.strip()
+    if text.startswith("'"):
+        return text[1:text.index("'", 1)].strip()
+    text = text.split('/')[0].strip()
+    if text in ('T', 'F'):
+        return text == 'T'
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text.replace('D', 'E'))
+        except ValueError:
+            return text
+
+
+def fits_hdus(f):
+    '''(header dict, data offset, data size) of each HDU in the open FITS file f.'''
+    offset = 0
+    size = os.fstat(f.fileno()).st_size
+    while offset < size:
+        header = {}
+        f.seek(offset)
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError('%s: truncated FITS header' % f.name)
+            offset += FITS_BLOCK
+            cards = [block[ii:ii + FITS_CARD].decode('ascii', 'replace') for ii in range(0, FITS_BLOCK, FITS_CARD)]
+            for card in cards:
+                if card[8:10] == '= ':
+                    header[card[:8].strip()] = fits_value(card[10:])
+            if any(card.rstrip() == 'END' for card in cards):
+                break
+        datasize = 0
+        if header.get('NAXIS', 0):
+            datasize = abs(header.get('BITPIX', 8)) // 8 * int(np.prod([header['NAXIS%d' % ii] for ii in range(1, header['NAXIS'] + 1)]))
+            datasize += header.get('PCOUNT', 0)
+        yield header, offset, datasize
+        offset += -(-datasize // FITS_BLOCK) * FITS_BLOCK
+
+
+def tform(form):
+    """(repeat count, type letter) of a TFORM such as '4096E'."""
+    count, letter = re.match(r'\s*(\d*)([A-Z])', form).groups()
+    return int(count) if count else 1, letter
+
+
+class Psrfits(RawFile):
+    """A search-mode PSRFITS file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            hdus = list(fits_hdus(f))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        primary = hdus[0][0]
+        subint = [hdu for hdu in hdus if hdu[0].get('EXTNAME') == 'SUBINT']
+        if not subint:
+            raise ValueError('%s has no SUBINT table; not search-mode PSRFITS' % path)
+        self.primary, (self.header, offset, datasize) = primary, subint[0]
+        header = self.header
+        self.nchan = header['NCHAN']
+        self.npol = header['NPOL']
+        self.nbits = header['NBITS']
+        self.nsblk = header['NSBLK']
+        self.nrows = header['NAXIS2']
+        self.tsamp = header['TBIN']
+        self.nspec = self.nrows * self.nsblk
+        self.pol_type = header.get('POL_TYPE', 'AA+BB')
+        self.mjd = primary['STT_IMJD'] + (primary['STT_SMJD'] + primary.get('STT_OFFS', 0.0)) / 86400.0
+        self.source = primary.get('SRC_NAME', 'Unknown')
+        self.telescope = primary.get('TELESCOP', 'Unknown')
+        self.ra = primary.get('RA', self.ra)
+        self.dec = primary.get('DEC', self.dec)
+        self.beam = primary.get('BMAJ', 0.0) * 3600.0
+        if offset + datasize > len(self.map):
+            raise ValueError('%s: truncated SUBINT table (%d of %d bytes)' % (path, len(self.map) - offset, datasize))
+
+        # each row is NAXIS1 bytes of the columns in order; map the ones we read
+        rowsize = header['NAXIS1']
+        columns = {}
+        coloffset = 0
+        for ii in range(1, header['TFIELDS'] + 1):
+            count, letter = tform(header['TFORM%d' % ii])
+            name = header['TTYPE%d' % ii]
+            columns[name] = (coloffset, count, letter)
+            coloffset += (count + 7) // 8 if letter == 'X' else count * TFORM_SIZES[letter]
+
+        def column(name, shape, dtype):
+            start, count, letter = columns[name]
+            dtype = np.dtype(dtype)
+            strides = (rowsize,) + tuple(int(np.prod(shape[ii + 1:])) * dtype.itemsize for ii in range(len(shape)))
+            return np.ndarray((self.nrows,) + shape, dtype=dtype, buffer=self.map, offset=offset + start, strides=strides)
+
+        self.dat_freq = column('DAT_FREQ', (self.nchan,), TFORM_DTYPES[columns['DAT_FREQ'][2]])
+        self.freqs = np.asarray(self.dat_freq[0], dtype=np.float64)
+        self.scales = column('DAT_SCL', (self.npol, self.nchan), '>f4') if 'DAT_SCL' in columns else None
+        self.offsets = column('DAT_OFFS', (self.npol, self.nchan), '>f4') if 'DAT_OFFS' in columns else None
+        self.weights = column('DAT_WTS', (self.nchan,), '>f4') if 'DAT_WTS' in columns else None
+        self.unpacker = None
+        if self.nbits >= 8:
+            dtype = {8: 'u1', 16: '>i2', 32: '>f4'}[self.nbits]
+            self.data = column('DATA', (self.nsblk, self.npol, self.nchan), dtype)
+        else:
+            self.data = column('DATA', (self.nsblk, self.npol * self.nchan * self.nbits // 8), 'u1')
+
+    def rows(self, start, nspec):
+        # (row, first sample in it, samples from it) covering nspec samples from start
+        stop = min(start + nspec, self.nspec)
+        while start < stop:
+            row, first = divmod(start, self.nsblk)
+            n = min(self.nsblk - first, stop - start)
+            yield row, first, n
+            start += n
+
+    def row_samples(self, row, first, n):
+        # samples of one row, (n, npol, nchan)
+        data = self.data[row, first:first + n]
+        if self.nbits < 8:
+            data = unpack(data, self.nbits).reshape(n, self.npol, self.nchan)
+        return data
+
+    def intensity(self, data):
+        # AA+BB data hold the two polarisations' powers; the others' first is total intensity
+        if self.npol > 1 and self.pol_type.startswith('AABB'):
+            return data[:, 0].astype(np.float32) + data[:, 1]
+        return data[:, 0]
+
+    def samples(self, start, nspec):
+        """nspec samples of total intensity from sample start, (nspec, nchan); a view if they lie in one subintegration."""
+        parts = [self.intensity(self.row_samples(*part)) for part in self.rows(start, nspec)]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.empty((0, self.nchan), dtype=self.data.dtype)
+
+    def row_unpacker(self, row):
+        # an Unpacker applying row's scales, offsets and weights, kept for the next block
+        if self.unpacker is None or self.unpacker[0] != row:
+            scale = self.scales[row, 0] if self.scales is not None else np.ones(self.nchan, dtype=np.float32)
+            offset = self.offsets[row, 0] if self.offsets is not None else np.zeros(self.nchan, dtype=np.float32)
+            weight = self.weights[row] if self.weights is not None else 1.0
+            self.unpacker = (row, Unpacker(self.nbits, self.nchan, scale * weight, offset * weight))
+        return self.unpacker[1]
+
+    def spectra(self, start, nspec):
+        """nspec spectra from sample start as float32 (nspec, nchan), scaled, offset and weighted as PRESTO reads them."""
+        parts = []
+        for row, first, n in self.rows(start, nspec):
+            if self.npol == 1 and self.nbits <= 8:
+                parts.append(self.row_unpacker(row)(self.data[row, first:first + n]))
+                continue
+            data = self.row_samples(row, first, n).astype(np.float32)
+            if self.scales is not None:
+                data = data * self.scales[row] + self.offsets[row]
+            data = self.intensity(data)
+            if self.weights is not None:
+                data = data * self.weights[row]
+            parts.append(data)
+        return np.concatenate(parts) if parts else np.empty((0, self.nchan), dtype=np.float32)
+
+
+def open_raw(path):
+    """A Psrfits or Filterbank for path, by its contents."""
+    with open(path, 'rb') as f:
+        magic = f.read(9)
+    if magic == b'SIMPLE  =':
+        return Psrfits(path)
+    return Filterbank(path)
+
+
+def summary(raw):
+    '''The header of raw as lines like readfile's.'''
+    return ['%-35s = %s' % item for item in (
+            ('Source Name', raw.source),
+            ('Telescope', raw.telescope),
+            ('Right Ascension (J2000)', raw.ra),
+            ('Declination (J2000)', raw.dec),
+            ('MJD', '%.15g' % raw.mjd),
+            ('Number of channels', raw.nchan),
+            ('Sample time (us)', '%.15g' % (raw.tsamp * 1e6)),
+            ('Spectra per file', raw.nspec),
+            ('Bits per sample', raw.nbits),
+            ('Total Bandwidth (MHz)', '%.15g' % raw.bandwidth),
+            ('Central freq (MHz)', '%.15g' % raw.fcenter),
+            ('Low channel (MHz)', '%.15g' % raw.freqs.min()),
+            ('High channel (MHz)', '%.15g' % raw.freqs.max()),
+            ('Channel width (MHz)', '%.15g' % raw.chanwidth),
+            ('Time per file (sec)', '%.15g' % raw.duration))]
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        sys.exit('usage: python rawdata.py FILE')
+    try:
+        raw = open_raw(sys.argv[1])
+    except ValueError as e:
+        sys.exit(str(e))
+    with raw:
+        print('\n'.join(summary(raw)))
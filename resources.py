@@ -0,0 +1,263 @@
+"""
+Memory-aware concurrency for the PRESTO pipeline stages
+
+Running one task per core is fine for realfft, but accelsearch with a
+large zmax/wmax needs several GB per process and can run a node out of
+memory. MemoryLimiter wraps an executor and only starts a task when its
+stage's per-task memory fits in what the node has available, so each
+stage runs as many tasks at once as RAM allows, up to the pool size.
+
+Each stage starts from an estimate (the *_memory functions below) and
+switches to the largest peak RSS measured for its tool runs as tasks
+finish, so the limit adjusts during the stage.
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+from collections import deque
+from functools import partial
+from concurrent.futures import Executor, Future
+
+#Keep this much memory free for the OS, page cache and the pipeline itself
+RESERVE_BYTES = 2 * 2**30
+#Head room on top of a measured peak
+SAFETY = 1.2
+#How often waited() checks on a process it has a timeout for (s)
+POLL = 0.1
+
+#accelsearch's plane geometry (see PRESTO's accel.h)
+ACCEL_DZ = 2
+ACCEL_DW = 20
+ACCEL_USELEN = 7470
+ACCEL_NUMHARM = 8
+
+_local = threading.local()
+
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or None where there is none."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def prepsubband_memory(Nchan, Nsub, NDMs, Nout):
+    """Rough peak of one prepsubband_f call: raw blocks plus subband and DM series buffers."""
+    return 64 * 2**20 + 4 * (Nchan * 2**14 + Nout * (Nsub + NDMs))
+
+
+def dedisp_memory(Nchan, Nsub, Nsamp):
+    """Peak of one dedisperse_numpy call: the undownsampled subbands plus raw blocks (dedisp.BLOCK) and one series."""
+    return 64 * 2**20 + 4 * (Nsub * Nsamp + 2 * Nchan * 2**17 + Nsamp)
+
+
+def fdmt_memory(Nchan, NDMs):
+    """Peak of one dedisperse_fdmt call: two levels of the tree, each about Nchan + NDMs rows of a block (fdmt.BLOCK) plus the delays."""
+    return 64 * 2**20 + 4 * 3 * (Nchan + NDMs) * (2**14 + NDMs)
+
+
+def realfft_memory(Nout):
+    """realfft transforms in core: the series plus the same again as workspace."""
+    return 32 * 2**20 + 2 * 4 * Nout
+
+
+def accelsearch_memory(Nout, zmax, wmax=0):
+    """Rough peak of accelsearch: the spectrum, the correlation kernels and the harmonic planes."""
+    numz = 2 * zmax // ACCEL_DZ + 1
+    numw = 2 * wmax // ACCEL_DW + 1
+    halfwidth = 2 * (zmax + wmax) + 32
+    fftlen = 1
+    while fftlen < ACCEL_USELEN + 2 * halfwidth:
+        fftlen *= 2
+    kernels = numz * numw * fftlen * 8
+    planes = ACCEL_NUMHARM * numz * numw * fftlen * 4
+    return 64 * 2**20 + 4 * Nout + kernels + planes
+
+
+def waited(proc, timeout=None):
+    """
+    proc.wait(), but through os.wait4 so the peak RSS of proc (and anything
+    it ran) is recorded for measured(). With a timeout, None if proc is
+    still running after it.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        pid, status, usage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        if pid:
+            break
+        if time.time() >= deadline:
+            return None
+        time.sleep(min(POLL, timeout))
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if sys.platform.startswith('linux'):
+        peak = usage.ru_maxrss * 1024 # kB on Linux, bytes elsewhere
+    else:
+        peak = usage.ru_maxrss
+    _local.peak = max(getattr(_local, 'peak', 0), peak)
+    return proc.returncode
+
+
+def getstatusoutput(cmd):
+    """
+    subprocess.getstatusoutput(cmd) that also records the peak RSS of cmd
+    (and anything it ran) for measured().
+    """
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    data = proc.stdout.read()
+    proc.stdout.close()
+    waited(proc)
+    output = data.decode(errors='replace')
+    if output.endswith('\n'):
+        output = output[:-1]
+    return proc.returncode, output
+
+
+def getoutput(cmd):
+    return getstatusoutput(cmd)[1]
+
+
+def measured(function, *args):
+    """Run function(*args) and return (result, peak RSS of the tools it ran)."""
+    _local.peak = 0
+    result = function(*args)
+    return result, _local.peak
+
+
+def waiting(seconds):
+    """Count seconds this thread spent waiting on other workers (e.g. for a lock) rather than working."""
+    _local.waiting = getattr(_local, 'waiting', 0.0) + seconds
+
+
+def cache_hit():
+    """Note that a tool call of this thread was served from the result cache."""
+    _local.hits = getattr(_local, 'hits', 0) + 1
+
+
+def own_work(function, *args):
+    """
+    Run function(*args) and return (result, seconds of work it did
+    itself), leaving out time counted by waiting(). The seconds are None
+    if any of its tool calls came from the result cache.
+    """
+    waited_before = getattr(_local, 'waiting', 0.0)
+    hits_before = getattr(_local, 'hits', 0)
+    start = time.time()
+    result = function(*args)
+    seconds = time.time() - start - (getattr(_local, 'waiting', 0.0) - waited_before)
+    if getattr(_local, 'hits', 0) != hits_before:
+        return result, None
+    return result, seconds
+
+
+def stage_of(function):
+    while isinstance(function, partial):
+        function = function.func
+    return function.__name__
+
+
+class MemoryLimiter(Executor):
+    """
+    Wraps a local executor and holds submitted tasks back until their
+    stage's per-task memory fits in the node's available memory. Tasks are
+    started in submission order, except that a task that does not fit yet
+    lets later tasks of lighter stages go first. No more tasks are handed
+    to the executor than it has workers, so the memory reserved is that
+    of tasks actually running.
+    """
+
+    def __init__(self, executor, estimates=None):
+        self.executor = executor
+        self.workers = getattr(executor, 'workers', None)
+        self.estimates = dict(estimates or {})
+        self.peaks = {}
+        self.queue = deque()
+        self.reserved = 0 # memory of the running tasks, by their estimates
+        self.running = 0
+        self.budget = None
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def set_estimate(self, stage, nbytes):
+        with self.cond:
+            self.estimates[stage] = nbytes
+            self.cond.notify()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.cond:
+            self.queue.append((stage_of(fn), fn, args, future))
+            self.cond.notify()
+        return future
+
+    def _fits(self, stage, available):
+        if available is None:
+            return True
+        if self.running == 0:
+            # Measure the budget while none of our tasks hold memory
+            self.budget = available - RESERVE_BYTES
+            return True # always let one task through
+        # Count running tasks at their full estimate, since a task that has
+        # just started has not allocated yet, and also check what is free
+        # now in case something else on the node has grown
+        estimate = self.estimates.get(stage, 0)
+        return (self.reserved + estimate <= self.budget and
+                estimate <= available + self.reserved - RESERVE_BYTES)
+
+    def _dispatch(self):
+        # Submits from its own thread, never from the executor's callbacks
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed and not self.queue:
+                        return
+                    # no more in the pool than it has workers, so every task counted here is running
+                    if self.queue and not (self.workers and self.running >= self.workers):
+                        available = available_memory() # once per pass, however many tasks wait
+                        task = next((task for task in self.queue if self._fits(task[0], available)), None)
+                        if task is not None:
+                            break
+                    self.cond.wait(1.0) # memory may free up without a task finishing
+                self.queue.remove(task)
+                stage, fn, args, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue # cancelled while it waited, e.g. a speculative copy no longer needed
+                estimate = self.estimates.get(stage, 0)
+                self.reserved += estimate
+                self.running += 1
+            inner = self.executor.submit(measured, fn, *args)
+            inner.add_done_callback(partial(self._finished, stage, estimate, future))
+
+    def _finished(self, stage, estimate, future, inner):
+        peak = 0
+        try:
+            result, peak = inner.result()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        with self.cond:
+            self.reserved -= estimate
+            self.running -= 1
+            if peak:
+                # The largest measured peak replaces the first guess for the rest of the stage
+                self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+                self.estimates[stage] = int(SAFETY * self.peaks[stage])
+            self.cond.notify()
+
+    def shutdown(self, wait=True):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if wait:
+            self.dispatcher.join()
+        self.executor.shutdown(wait=wait)
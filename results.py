@@ -0,0 +1,90 @@
+"""
+Results index for the folded candidates
+
+ACCEL_sift ranks the candidates by sigma, so the fold stage takes them
+highest sigma first (by_sigma), and every finished prepfold is published
+straight away instead of when the whole stage is done:
+
+    results.jsonl   one JSON line per folded candidate, appended as each
+                    fold finishes: DM, p, sigma, its .pfd and .bestprof
+                    and the time it was published
+    results.txt     the same candidates as a table, highest sigma first,
+                    rewritten (atomically) on every publish
+
+so the best candidates can be looked at minutes into the fold stage.
+Entries of an earlier run are kept, since a resumed run does not fold
+those candidates again.
+"""
+import os
+import json
+import time
+import threading
+from operator import itemgetter
+
+
+def by_sigma(cands):
+    """The candidates in the order to fold them, highest sigma first."""
+    return sorted(cands, key=lambda cand: cand.sigma, reverse=True)
+
+
+def fold_files(cand, outputs):
+    """
+    The (.pfd, .bestprof) names of cand's fold among outputs, or None for
+    a missing file. Candidates folded at the same DM share the outputs'
+    prefix, so the .pfd named after cand's period is preferred.
+    """
+    pfds = sorted(name for name in outputs if name.endswith('.pfd'))
+    named = [name for name in pfds if '_%.2fms_' % (cand.p * 1000.0) in os.path.basename(name)]
+    pfd = (named or pfds or [None])[0]
+    bestprof = None
+    if pfd is not None and pfd + '.bestprof' in outputs:
+        bestprof = pfd + '.bestprof'
+    return pfd, bestprof
+
+
+class ResultsIndex(object):
+    """
+    Output names are relative to root (default: the current directory),
+    the directory prepfold runs in, as in the Manifest.
+    """
+
+    def __init__(self, path='results.jsonl', root=''):
+        self.path = path
+        self.table = os.path.splitext(path)[0] + '.txt'
+        self.root = root
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.access(path, os.F_OK):
+            with open(path) as index:
+                for line in index:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # last line torn by a crash
+                    self.entries[entry['pfd']] = entry
+        self.file = open(path, 'at')
+
+    def publish(self, cand, outputs):
+        """Add the fold of cand, which wrote outputs; False if it wrote no .pfd."""
+        pfd, bestprof = fold_files(cand, outputs)
+        if pfd is None or not os.access(os.path.join(self.root, pfd), os.F_OK):
+            return False
+        entry = {'DM': cand.DM, 'p': cand.p, 'sigma': cand.sigma, 'pfd': pfd, 'bestprof': bestprof,
+                 'time': time.time()}
+        with self.lock:
+            self.entries[pfd] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.write_table()
+        return True
+
+    def write_table(self):
+        tmpfile = self.table + '.tmp'
+        with open(tmpfile, 'wt') as table:
+            table.write('#%9s %10s %14s  %s\n' % ('sigma', 'DM', 'P (ms)', 'pfd'))
+            for entry in sorted(self.entries.values(), key=itemgetter('sigma'), reverse=True):
+                table.write('%10.2f %10.2f %14.6f  %s\n' % (entry['sigma'], entry['DM'], entry['p'] * 1000.0, entry['pfd']))
+        os.replace(tmpfile, self.table) # readers never see a half-written table
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,102 @@
+"""
+Asyncio driver for the PRESTO tools
+
+subprocess.getoutput starts a shell for every tool call, holds all of its
+output in memory and, on a pool, pickles it back to the head process,
+which adds up over thousands of accelsearch runs. Runner instead starts
+the tools itself from one event loop (no shell, no pool), with at most
+'limit' running at once, and gives each task's stdout and stderr straight
+to a log file, logs/<task>.log. Only a TaskResult comes back: the exit
+status, the run time and the output files.
+
+    runner = Runner(16)
+    async def search(df):
+        result = await runner.run('realfft_'+df[:-4], ['realfft '+df], [df[:-4]+'.fft'])
+        if result.status == 0:
+            await runner.run('accelsearch_'+df[:-4], ['accelsearch -zmax 0 '+df[:-4]+'.fft'])
+    asyncio.run(runner.gather(search(df) for df in glob.glob('*.dat')))
+"""
+import os
+import glob
+import time
+import shlex
+import asyncio
+from collections import namedtuple
+from subprocess import STDOUT
+
+TaskResult = namedtuple('TaskResult', 'name cmd status elapsed log outputs')
+
+
+def split_command(cmd):
+    """
+    Split cmd into arguments as the shell would, expanding glob patterns
+    (e.g. prepsubband's 'Sband_DM1.00.sub[0-9]*') that match any files.
+    """
+    args = []
+    for token in shlex.split(cmd):
+        matches = sorted(glob.glob(token)) if glob.has_magic(token) else []
+        args.extend(matches or [token])
+    return args
+
+
+class Runner(object):
+
+    def __init__(self, limit, logdir='logs', retries=0, backoff=5.0):
+        self.limit = limit
+        self.logdir = logdir
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = None
+        if not os.access(logdir, os.F_OK):
+            os.makedirs(logdir, exist_ok=True)
+
+    async def run(self, name, cmds, outputs=()):
+        """
+        Run the commands of task name one after the other, stopping at the
+        first that fails, and return a TaskResult; outputs are the globs of
+        the files the task writes. A failed task is run again from its
+        first command up to 'retries' times, waiting 'backoff' seconds
+        (doubling) first, with every attempt appended to the same log.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        logpath = os.path.join(self.logdir, name + '.log')
+        with open(logpath, 'wb'):
+            pass
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2**(attempt-1))
+            status, elapsed = await self.attempt(cmds, logpath)
+            if status == 0:
+                break
+        files = [f for pattern in outputs for f in glob.glob(pattern)]
+        return TaskResult(name, '\n'.join(cmds), status, elapsed, logpath, files)
+
+    async def attempt(self, cmds, logpath):
+        status = 0
+        async with self.semaphore:
+            start = time.time()
+            with open(logpath, 'ab') as log:
+                for cmd in cmds:
+                    log.write(('%s\n' % cmd).encode())
+                    log.flush()
+                    try:
+                        # globs are expanded only now, after the previous command wrote its files
+                        proc = await asyncio.create_subprocess_exec(*split_command(cmd), stdout=log, stderr=STDOUT)
+                        status = await proc.wait()
+                    except OSError as e:
+                        log.write(('%s\n' % e).encode())
+                        status = 127
+                    if status != 0:
+                        break
+            return status, time.time() - start
+
+    async def gather(self, coroutines):
+        """Run the coroutines together; use as asyncio.run(runner.gather(...))."""
+        self.semaphore = asyncio.Semaphore(self.limit) # a semaphore belongs to one event loop
+        return await asyncio.gather(*coroutines)
+
+
+def summary(result):
+    """One line for a stage log in place of the tool's full output."""
+    return '%s exit %d %.2fs %s\n' % (result.name, result.status, result.elapsed, result.log)
@@ -0,0 +1,173 @@
+"""
+Dependency-driven scheduling for the PRESTO pipeline
+
+Instead of running each stage as a barrier (every prepsubband call, then
+every realfft call, then every accelsearch call), a finished task can
+enqueue the tasks that depend on its outputs, so the stages overlap on
+the executor and the cores stay busy through the tail of each stage.
+"""
+import sys
+import queue
+from collections import deque, OrderedDict, Counter
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, wait, as_completed
+
+
+class StreamScheduler(object):
+    """
+    Submits tasks to an executor and, as each one finishes, writes its
+    (output, stdout) result to the stage log and submits its follow-ups.
+
+    Completions are handed back to the thread calling join(), so logs,
+    follow-up callbacks and new submissions all happen on that thread
+    rather than in the executor's own threads. With a FailureReport, a
+    task that raises is added to it and the rest keep running.
+
+    Tasks can be tagged with a group (e.g. the observation they belong
+    to). With a window, at most that many tasks are in the executor at
+    once and the waiting ones are started round-robin over their groups,
+    so every group makes progress. idle(group) is called on the join
+    thread whenever a group has no tasks left, and may submit more.
+    """
+
+    def __init__(self, executor, failures=None, window=None, idle=None):
+        self.executor = executor
+        self.failures = failures
+        self.window = window
+        self.idle = idle
+        self.pending = 0
+        self.running = 0
+        self.errors = []
+        self.finished = queue.Queue()
+        self.waiting = OrderedDict() # group -> tasks not started yet
+        self.outstanding = Counter() # group -> tasks waiting or running
+
+    def submit(self, function, args, logfile, then=None, group=None):
+        """
+        Run function(*args) on the executor. When it finishes, then(result)
+        may return more (function, args, logfile, then) tasks to submit;
+        they join the same group.
+        """
+        self.pending += 1
+        self.outstanding[group] += 1
+        self.waiting.setdefault(group, deque()).append((function, args, logfile, then, group))
+        self.dispatch()
+
+    def dispatch(self):
+        while self.waiting and (self.window is None or self.running < self.window):
+            group, tasks = self.waiting.popitem(last=False)
+            function, args, logfile, then, group = tasks.popleft()
+            if tasks:
+                self.waiting[group] = tasks # to the back of the line
+            self.running += 1
+            future = self.executor.submit(function, *args)
+            future.add_done_callback(lambda future, task=(args, logfile, then, group): self.finished.put((future,) + task))
+
+    def join(self):
+        """Wait until every task, including follow-ups, has finished."""
+        while self.pending:
+            future, args, logfile, then, group = self.finished.get()
+            self.pending -= 1
+            self.running -= 1
+            try:
+                result = future.result()
+                logfile.write(result[0])
+                sys.stdout.write(result[1])
+                if then is not None:
+                    for task in then(result):
+                        self.submit(*task, group=group)
+            except Exception as e:
+                if self.failures is None:
+                    self.errors.append(e)
+                elif group is None:
+                    self.failures.add(args[0], e)
+                else:
+                    self.failures.add('%s: %s' % (group, args[0]), e)
+            self.outstanding[group] -= 1
+            if self.outstanding[group] == 0 and self.idle is not None:
+                del self.outstanding[group]
+                try:
+                    self.idle(group)
+                except Exception as e:
+                    self.errors.append(e)
+            self.dispatch()
+        if self.errors:
+            raise self.errors[0]
+
+
+def ranked_results(executor, tasks, costs, failures=None):
+    """
+    Submit every (function, args) task to the executor at once, most
+    expensive first, and yield (index, result) for each task as it
+    finishes, so the caller can checkpoint it straight away. With a
+    FailureReport, a task that raises is added to it and skipped.
+    """
+    if hasattr(executor, 'map_tasks'):
+        for ii, result in enumerate(executor.map_tasks(tasks, costs, failures)):
+            if result is not None:
+                yield ii, result
+        return
+    pending = {}
+    for ii in sorted(range(len(tasks)), key=lambda ii: costs[ii], reverse=True):
+        function, args = tasks[ii]
+        pending[executor.submit(function, *args)] = ii
+    for future in as_completed(pending):
+        ii = pending[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            if failures is None:
+                raise
+            failures.add(tasks[ii][1][0], e)
+            continue
+        yield ii, result
+
+
+def ordered_results(executor, function, items, window, failures=None):
+    """
+    Yield (item, function(item)) for every item in order, each as soon as
+    it and all the items before it have finished. At most window tasks are
+    in flight or waiting for their turn, which bounds the memory held by
+    finished results while a slow task blocks the ones after it. With a
+    FailureReport, a task that raises is added to it and skipped.
+    """
+    items = iter(items)
+    pending = deque((item, executor.submit(function, item)) for item in islice(items, window))
+    while pending:
+        item, future = pending.popleft()
+        for next_item in islice(items, 1):
+            pending.append((next_item, executor.submit(function, next_item)))
+        try:
+            result = future.result()
+        except Exception as e:
+            if failures is None:
+                raise
+            failures.add(item, e)
+            continue
+        yield item, result
+
+
+def unordered_results(executor, function, items, window, failures=None):
+    """
+    Yield (item, function(item)) for every item in the order the tasks
+    finish, keeping at most window tasks in flight. With a FailureReport,
+    a task that raises is added to it and skipped.
+    """
+    items = iter(items)
+    pending = {}
+    for item in islice(items, window):
+        pending[executor.submit(function, item)] = item
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            for next_item in islice(items, 1):
+                pending[executor.submit(function, next_item)] = next_item
+            try:
+                result = future.result()
+            except Exception as e:
+                if failures is None:
+                    raise
+                failures.add(item, e)
+                continue
+            yield item, result
@@ -25,11 +25,12 @@ import numpy as np
 import time
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from executor import get_executor, parse_args
+
 #=================== Define Parameter ===================#
 Tutorial_Mode = False
 
@@ -42,14 +43,15 @@ Nint = 64 #64 sub integration
 Tres = 0.5 #ms
 zmax = 200
 wmax = 100
-ENABLE_MPI = False
 
 def accelsearch(fft_file):
-    searchcmd = "accelsearch -zmax %d -wmax %d %s"  % (zmax, wmax, fftf)
+    searchcmd = "accelsearch -zmax %d -wmax %d %s"  % (zmax, wmax, fft_file)
     stdout = "%s\n" % searchcmd
     return getoutput(searchcmd), stdout
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
 
     #====================== fft search ======================#
 
@@ -61,13 +63,7 @@ if __name__ == "__main__":
         print(output)
     os.chdir(working_dir)
 
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
 
     t0 = time.time() # start wall time of accelsearch
     fftfiles = glob.glob("*.fft")
@@ -84,7 +80,4 @@ if __name__ == "__main__":
     #===========================
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
@@ -24,11 +24,13 @@ import numpy as np
 import time
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from executor import get_executor, parse_args
+import ddplan as planner
+
 #================Define Parameter================#
 
 rootname = 'Sband'
@@ -39,9 +41,8 @@ Nint = 64 #64 sub integration
 Tres = 0.5 #ms
 zmax = 200
 wmax = 100
-ENABLE_MPI = False
 
-def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename dml):
+def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, dml):
     lodm = dml[0]
     subDM = np.mean(dml)
     prepsubband = "prepsubband -sub -subdm %.2f -nsub %d -downsamp %d -o %s %s" % (subDM, Nsub, subdownsamp, rootname, '../'+filename)
@@ -55,6 +56,8 @@ def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename dml
     return output, stdout 
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
     
     filename = sys.argv[1]
 
@@ -85,22 +88,10 @@ if __name__ == "__main__":
     BandWidth = float(header['Total Bandwidth (MHz)'])
     fcenter = float(header['Central freq (MHz)'])
 
-    ddplancmd = 'DDplan.py -l %(minDM)s -d %(maxDM)s -n %(Nchan)d -b %(BandWidth)s -t %(tsamp)f -f %(fcenter)f -s %(Nsub)s -o DDplan.ps' % {
-        'minDM':minDM, 'maxDM':maxDM, 'Nchan':Nchan, 'tsamp':tsamp, 'BandWidth':BandWidth, 'fcenter':fcenter, 'Nsub':Nsub}
-    print (ddplancmd)
-    ddplanout = getoutput(ddplancmd)
-    print (ddplanout)
-    planlist = ddplanout.split('\n')
-    ddplan = []
-    planlist.reverse()
-    for plan in planlist:
-        if plan == '':
-            continue
-        elif plan.strip().startswith('Low DM'):
-            break
-        else:
-            ddplan.append(plan)
-            ddplan.reverse()
+    Nsamp = int(header['Spectra per file'])
+
+    ddplan = planner.plan(maxDM, Nchan, tsamp, BandWidth, fcenter, Nsub, lowDM=minDM)
+    print ('\n'.join(planner.table(ddplan)))
         
     # print '''
 
@@ -116,25 +107,17 @@ if __name__ == "__main__":
 
     #Multiprocessing Pool definition
     #Made this way to have only one pool along the entire script
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-        
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
     
     logfile = open('disperse.log', 'wt')
     t0 = time.time() #collect start time
-    for line in ddplan:
-        ddpl = line.split()
-        lowDM = float(ddpl[0])
-        hiDM = float(ddpl[1])
-        dDM = float(ddpl[2])
-        DownSamp = int(ddpl[3])
-        NDMs = int(ddpl[6])
-        calls = int(ddpl[7])
+    for plan in ddplan:
+        lowDM = float(plan['lowDM'])
+        hiDM = float(plan['hiDM'])
+        dDM = float(plan['dDM'])
+        DownSamp = int(plan['DownSamp'])
+        NDMs = int(plan['DMs_per_call'])
+        calls = int(plan['calls'])
         Nout = Nsamp/DownSamp 
         Nout -= (Nout % 500)
         dmlist = np.split(np.arange(lowDM, hiDM, dDM), calls)
@@ -156,7 +139,4 @@ if __name__ == "__main__":
     #===========================
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
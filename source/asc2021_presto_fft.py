@@ -24,11 +24,12 @@ import numpy as np
 import time
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from executor import get_executor, parse_args
+
 #=================== Define Parameter ===================#
 Tutorial_Mode = False
 
@@ -40,7 +41,6 @@ Nint = 64 #64 sub integration
 Tres = 0.5 #ms
 zmax = 200
 wmax = 100
-ENABLE_MPI = False
 
 def realfft(df): 
     fftcmd = "realfft %s" % df
@@ -48,6 +48,8 @@ def realfft(df):
     return getoutput(fftcmd), stdout
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
     
     #====================== fft search ======================#
 
@@ -59,14 +61,7 @@ if __name__ == "__main__":
         print(output)
     os.chdir(working_dir)
 
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
 
     datfiles = glob.glob("*.dat")
     t0 = time.time() #start wall time of fft
@@ -83,7 +78,4 @@ if __name__ == "__main__":
     #===========================
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
@@ -24,11 +24,12 @@ import time
 
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from executor import get_executor, parse_args
+
 #=================== Define Parameter ===================#
 # Tutorial_Mode = True
 Tutorial_Mode = False
@@ -50,6 +51,8 @@ def prepfold(filename, cand):
     return getoutput(foldcmd), stdout
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
     filename = sys.argv[1]
 
     # print '''
@@ -82,6 +85,7 @@ if __name__ == "__main__":
         os.mkdir(working_dir)
     os.chdir(working_dir)
     os.system('ln -s ../%s %s' % (filename, filename))
+    pool = get_executor(backend, workers, wdir=os.getcwd())
 
     t0 = time.time() #start wall time of fold
     with open('folding.log', 'wt') as logfile:
@@ -99,8 +103,5 @@ if __name__ == "__main__":
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
 
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
 
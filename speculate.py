@@ -0,0 +1,211 @@
+"""
+Speculative re-execution of straggling PRESTO tasks
+
+One slow node or one pathological candidate can hold up a whole prepfold
+or accelsearch stage. speculative_results() keeps at most one task per
+worker in flight and records how long each task takes. Once most of the
+stage is done, any task running well past the median run time is started
+again on an idle worker. Whichever copy finishes first is kept and the
+other is killed.
+
+Every copy runs in its own directory under the working directory, with
+its inputs symlinked in, so copies never write the same files. A copy
+that finishes creates the task's claim file with O_EXCL, and only the
+one that creates it moves its outputs into the working directory
+(os.replace, atomic per file). The other copy sees the claim, kills its
+tool and removes its directory without publishing anything. Given the
+result cache, a copy runs its tool through it, so a task whose outputs
+are cached is restored into the copy's directory instead of run.
+"""
+import os
+import glob
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+from statistics import median
+from concurrent.futures import FIRST_COMPLETED, wait
+from failures import TaskFailed, RETRY_BACKOFF
+from resources import waited
+
+#Start duplicating stragglers once this fraction of the tasks has finished
+SPECULATE_AFTER = 0.75
+#A task is a straggler once it has run this many times the median run time
+SLOWDOWN = 2.0
+#Need this many finished tasks for a meaningful median
+MIN_SAMPLES = 3
+#How often a running copy checks whether the other copy won (s)
+POLL = 1.0
+
+
+class Lost(Exception):
+    """Another copy of the task claimed it first."""
+
+
+def attempt(cmd, inputs, outputs, claim, resultdir, start=None, cache=None, delay=0.0):
+    '''
+    Run one copy of a task (on a worker): cmd, or the command cmd()
+    returns, in a fresh directory under resultdir with the inputs linked
+    in, after sleeping delay seconds. Returns (output, stdout) if this
+    copy won the task, or None if another copy claimed it first; raises
+    TaskFailed if cmd exits non-zero. With a cache (a ResultCache) the
+    outputs of an earlier run of cmd are restored instead of running it.
+    The file start is created as the copy starts, and the tool's peak
+    memory is recorded for the MemoryLimiter.
+    '''
+    if delay:
+        time.sleep(delay)
+    if start:
+        os.close(os.open(start, os.O_CREAT | os.O_WRONLY))
+    if callable(cmd):
+        cmd = cmd()
+    workdir = tempfile.mkdtemp(prefix='.attempt_', dir=resultdir)
+
+    def run(cmd):
+        with open(os.path.join(workdir, 'output.log'), 'w+b') as log:
+            proc = subprocess.Popen(cmd, shell=True, cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+            while waited(proc, POLL) is None:
+                if os.access(claim, os.F_OK):
+                    os.killpg(proc.pid, signal.SIGKILL) # the other copy won
+                    waited(proc)
+                    raise Lost(cmd)
+            log.seek(0)
+            return proc.returncode, log.read().decode(errors='replace')
+
+    try:
+        for infile in inputs:
+            link = os.path.join(workdir, infile)
+            if not os.access(os.path.dirname(link), os.F_OK):
+                os.makedirs(os.path.dirname(link))
+            os.symlink(os.path.abspath(os.path.join(resultdir, infile)), link)
+
+        try:
+            if cache is None:
+                status, output = run(cmd)
+            else:
+                status, output = cache.getstatusoutput(cmd, inputs, outputs, workdir, run)
+        except Lost:
+            return None
+        if status != 0:
+            raise TaskFailed(cmd, status, output)
+        try:
+            os.close(os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return None
+
+        for pattern in outputs:
+            for path in glob.glob(os.path.join(workdir, pattern)):
+                if not os.path.islink(path):
+                    os.replace(path, os.path.join(resultdir, os.path.basename(path)))
+        return output, '%s\n' % cmd
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class Attempt(object):
+    '''
+    attempt() named after the stage it runs a copy of, so the
+    MemoryLimiter (see resources.stage_of) sizes it as that stage.
+    '''
+
+    def __init__(self, stage):
+        self.__name__ = stage
+
+    def __call__(self, *args):
+        return attempt(*args)
+
+
+def speculative_results(executor, tasks, workers, retries=0, failures=None, stage='attempt', cache=None,
+                        backoff=RETRY_BACKOFF):
+    '''
+    Run (item, cmd, inputs, outputs) tasks on executor, where inputs are the
+    files cmd reads and outputs the globs of the files it writes, both
+    relative to the working directory, and yield (item, (output, stdout))
+    as tasks finish. workers is the number of tasks that can run at once.
+    A task whose every copy fails is started again up to retries times;
+    after that it is added to failures (a FailureReport) if given, or its
+    error is raised, each retry starting backoff seconds later than the one
+    before (see failures.retried). cache, a ResultCache, serves copies whose
+    outputs it already holds. stage names the copies for the MemoryLimiter. A copy's
+    run time counts from when it starts on its worker, not from when it is
+    submitted, so time spent waiting for memory is not straggling.
+    '''
+    resultdir = os.getcwd()
+    claimdir = tempfile.mkdtemp(prefix='.claims_', dir=resultdir)
+    next_task = 0
+    copies = {}     # future -> task index
+    started = {}    # future -> file the copy creates when it starts
+    running = {}    # task index -> futures of its copies
+    runtimes = []
+    finished = set()
+    failed = {}     # task index -> failed attempts
+
+    function = Attempt(stage)
+
+    def submit(ii, delay=0.0):
+        item, cmd, inputs, outputs = tasks[ii]
+        claim = os.path.join(claimdir, '%d.claim' % ii)
+        start = os.path.join(claimdir, '%d.%d.start' % (ii, len(started)))
+        future = executor.submit(function, cmd, inputs, outputs, claim, resultdir, start, cache, delay)
+        copies[future] = ii
+        started[future] = start
+        running.setdefault(ii, []).append(future)
+
+    def runtime(future):
+        # None until the copy has started on its worker
+        try:
+            return time.time() - os.path.getmtime(started[future])
+        except OSError:
+            return None
+
+    try:
+        while next_task < min(workers, len(tasks)):
+            submit(next_task)
+            next_task += 1
+        while copies:
+            done, _ = wait(list(copies), timeout=POLL, return_when=FIRST_COMPLETED)
+            for future in done:
+                ii = copies.pop(future)
+                running[ii].remove(future)
+                if ii in finished or future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    if running[ii]:
+                        continue # the other copy may still succeed
+                    failed[ii] = failed.get(ii, 0) + 1
+                    if failed[ii] <= retries:
+                        submit(ii, backoff * 2**(failed[ii] - 1))
+                    elif failures is not None:
+                        finished.add(ii)
+                        failures.add(tasks[ii][0], future.exception())
+                    else:
+                        raise future.exception()
+                    continue
+                result = future.result()
+                if result is None:
+                    continue # lost to the other copy
+                finished.add(ii)
+                if runtime(future) is not None:
+                    runtimes.append(runtime(future))
+                for other in running[ii]:
+                    other.cancel() # a started copy stops itself when it sees the claim
+                yield tasks[ii][0], result
+
+            idle = workers - len(copies)
+            while idle > 0 and next_task < len(tasks):
+                submit(next_task)
+                next_task += 1
+                idle -= 1
+
+            if idle > 0 and len(runtimes) >= max(MIN_SAMPLES, SPECULATE_AFTER * len(tasks)):
+                limit = SLOWDOWN * median(runtimes)
+                for ii, futures in list(running.items()):
+                    if idle <= 0:
+                        break
+                    if ii not in finished and len(futures) == 1 and (runtime(futures[0]) or 0.0) > limit:
+                        submit(ii)
+                        idle -= 1
+    finally:
+        shutil.rmtree(claimdir, ignore_errors=True)
@@ -0,0 +1,100 @@
+"""
+Node-local copies of the observation
+
+Every prepsubband -sub call and every prepfold reads the whole raw file,
+so with dozens of DM chunks and hundreds of candidates the same
+multi-GB .fits is read over the shared filesystem again and again.
+staged() copies a file once per node into node-local storage (tmpfs or a
+local SSD) and returns the copy's path for the tools to read instead.
+
+Copies live in <stagedir>/presto-stage-<uid>/<key>/, keyed by the
+file's real path, size and mtime, so every process on a node, and every
+node, names the same copy the same way. Each process using a copy holds
+a shared flock on <key>.users until it exits; the last one to exit
+removes the copy, and copies left behind by killed runs (no lock held)
+are removed the next time anything is staged on that node. If the
+storage does not have room, the original path is used.
+"""
+import os
+import fcntl
+import shutil
+import hashlib
+from multiprocessing.util import Finalize
+
+HEADROOM = 1.1 #Only stage a file when the local storage has this much more room than it needs
+
+_staged = {} # path -> path of its copy, in this process
+_users = []  # (lock file, copy directory) held by this process
+
+
+def stage_key(path):
+    st = os.stat(path)
+    return hashlib.sha1(('%s %d %d' % (os.path.realpath(path), st.st_size, st.st_mtime)).encode()).hexdigest()[:16]
+
+
+def staged(path, stagedir):
+    '''
+    The path of a copy of path in stagedir, copied there by the first
+    process on this node that asks for it, or path itself if stagedir
+    has no room for it.
+    '''
+    path = os.path.abspath(path)
+    if path in _staged:
+        return _staged[path]
+    root = os.path.join(stagedir, 'presto-stage-%d' % os.getuid())
+    os.makedirs(root, exist_ok=True)
+    if not _users:
+        sweep(root)
+        Finalize(None, release, exitpriority=0) # at exit, in pool workers as well as in scripts
+
+    key = stage_key(path)
+    users = open(os.path.join(root, key + '.users'), 'a')
+    fcntl.flock(users, fcntl.LOCK_SH) # before the copy is looked at, so it cannot be swept from under us
+    _users.append((users, os.path.join(root, key)))
+    local = os.path.join(root, key, os.path.basename(path))
+    with open(os.path.join(root, key + '.copy'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # one process copies, the rest wait for it
+        if not os.access(local, os.F_OK):
+            size = os.stat(path).st_size
+            if shutil.disk_usage(root).free < HEADROOM * size:
+                print('staging: no room for %s in %s, reading it in place' % (path, root))
+                local = path
+            else:
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                shutil.copyfile(path, local + '.tmp')
+                os.rename(local + '.tmp', local)
+    _staged[path] = local
+    return local
+
+
+def unused(lockfile):
+    '''An open lock file, locked exclusively, if no process holds lockfile; else None.'''
+    lock = open(lockfile, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def sweep(root):
+    # copies nobody holds were left behind by runs that were killed
+    for name in os.listdir(root):
+        if name.endswith('.users'):
+            lock = unused(os.path.join(root, name))
+            if lock is not None:
+                shutil.rmtree(os.path.join(root, name[:-len('.users')]), ignore_errors=True)
+                lock.close()
+
+
+def release():
+    '''Let go of this process's copies, removing those no other process holds.'''
+    while _users:
+        users, copydir = _users.pop()
+        users.close()
+        lock = unused(users.name)
+        if lock is not None:
+            shutil.rmtree(copydir, ignore_errors=True)
+            lock.close()
+    _staged.clear()
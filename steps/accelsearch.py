@@ -8,8 +8,15 @@ zhuwwpku@gmail.com
 Modified by EAFIT University's team, ASC20-21
 2020-12-29
 """
-import os, sys, glob, re
-from commands import getoutput
+import os, sys
+# With PIPELINE_JOBSERVER set, this run is handed to the warm job server before the slow imports below (see jobserver.py)
+if __name__ == "__main__" and os.environ.get('PIPELINE_JOBSERVER'):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from jobserver import submit
+    sys.exit(submit(os.environ['PIPELINE_JOBSERVER'], __file__, sys.argv))
+
+import glob, re
+from subprocess import getoutput
 import numpy as np
 
 # Since we are using PRESTO v3.0.1
@@ -17,15 +24,17 @@ from presto import sifting
 from operator import attrgetter
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from manifest import Manifest
+from executor import get_executor, parse_args
+
 #For profiling
-import cProfile, pstats, StringIO
+import cProfile, pstats
+from io import StringIO
 PROFILE = True #Change to False unless you need to find out bottlenecks
-ENABLE_MPI = False
 
 #Tutorial_Mode = True
 Tutorial_Mode = False
@@ -40,12 +49,16 @@ zmax = 0
 #=====FUNCTION DEFINITIONS=====
 
 def query(question, answer, input_type):
-    print "Based on output of the last step, answer the following questions:"
+    print("Based on output of the last step, answer the following questions:")
     Ntry = 3
-    while not input_type(raw_input("%s:" % question)) == answer and Ntry > 0:
+    while not input_type(input("%s:" % question)) == answer and Ntry > 0:
         Ntry -= 1
-        print "try again..."
-    if Ntry == 0:print "The correct answer is:", answer
+        print("try again...")
+    if Ntry == 0:print("The correct answer is:", answer)
+
+
+def accel_outputs(fft_file):
+    return glob.glob(fft_file[:-4]+'_ACCEL_%d*' % zmax)
 
 
 def accelsearch(fft_file):
@@ -54,6 +67,8 @@ def accelsearch(fft_file):
     return getoutput(searchcmd), stdout
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
 
     #===========================================
     #Changing to 'subbands' where the results are saved
@@ -65,20 +80,13 @@ if __name__ == "__main__":
 
     #Multiprocessing Pool definition
     #Made this way to have only one pool along the entire script
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-        
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
                         
-    print '''
+    print('''
 
     ================fft-search subbands==================
 
-    '''                     
+    ''')                     
 
     try:        
 
@@ -87,23 +95,27 @@ if __name__ == "__main__":
             pr.enable()
 
                         
-        fftfiles = glob.glob("*.fft")
+        #Completed tasks of an earlier run are skipped
+        manifest = Manifest('manifest.jsonl')
+        fftfiles = manifest.pending(glob.glob("*.fft"), lambda fftfile: 'accelsearch:'+fftfile)
         with open('accelsearch.log', 'wt') as logfile:
             result = pool.map(accelsearch, fftfiles)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
+            for fftfile, (output, stdout) in zip(fftfiles, result):
+                logfile.write(output)
+                sys.stdout.write(stdout)
+                manifest.record('accelsearch:'+fftfile, stdout, accel_outputs(fftfile))
+        manifest.close()
 
         if PROFILE:
             pr.disable()
-            s = StringIO.StringIO()
+            s = StringIO()
             sortby = 'cumulative'
             ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
             ps.print_stats()
-            print s.getvalue()
+            print(s.getvalue())
                         
     except Exception as e:
-        print 'failed at fft search.', e
+        print('failed at fft search.', e)
         os.chdir(cwd)
         sys.exit(0)
 
@@ -112,7 +124,4 @@ if __name__ == "__main__":
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
     
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
@@ -8,8 +8,15 @@ zhuwwpku@gmail.com
 Modified by EAFIT University's team, ASC20-21
 2020-12-29
 """
-import os, sys, glob, re
-from commands import getoutput
+import os, sys
+# With PIPELINE_JOBSERVER set, this run is handed to the warm job server before the slow imports below (see jobserver.py)
+if __name__ == "__main__" and os.environ.get('PIPELINE_JOBSERVER'):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from jobserver import submit
+    sys.exit(submit(os.environ['PIPELINE_JOBSERVER'], __file__, sys.argv))
+
+import glob, re
+from subprocess import getoutput
 import numpy as np
 
 # Since we are using PRESTO v3.0.1
@@ -17,15 +24,19 @@ from presto import sifting
 from operator import attrgetter
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from manifest import Manifest
+from executor import get_executor, parse_args
+import ddplan as planner
+
 #For profiling
-import cProfile, pstats, StringIO
+import cProfile, pstats
+from io import StringIO
 PROFILE = True #Change to False unless you need to find out bottlenecks
-ENABLE_MPI = False #In case of running with MPI
+DDPLAN_PLOT = False #Also run DDplan.py to draw the plan in DDplan.ps
 
 #Tutorial_Mode = True
 Tutorial_Mode = False
@@ -40,12 +51,12 @@ zmax = 0
 #=====FUNCTION DEFINITIONS=====
 
 def query(question, answer, input_type):
-    print "Based on output of the last step, answer the following questions:"
+    print("Based on output of the last step, answer the following questions:")
     Ntry = 3
-    while not input_type(raw_input("%s:" % question)) == answer and Ntry > 0:
+    while not input_type(input("%s:" % question)) == answer and Ntry > 0:
         Ntry -= 1
-        print "try again..."
-    if Ntry == 0:print "The correct answer is:", answer
+        print("try again...")
+    if Ntry == 0:print("The correct answer is:", answer)
 
     
 def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile, dml):
@@ -65,8 +76,19 @@ def prepsubband_f(lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, ma
     return output, stdout 
 
 
+def dat_names(lodm, dDM, NDMs):
+    # prepsubband parses -lodm/-dmstep from '%f' and names each series with '%.2f'
+    lodm, dDM = float("%f" % lodm), float("%f" % dDM)
+    return ["%s_DM%.2f.dat" % (rootname, lodm + ii*dDM) for ii in range(NDMs)]
+
+
+def dedisperse_outputs(datfiles):
+    return datfiles + [df[:-4]+'.inf' for df in datfiles]
+
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
 
     filename = sys.argv[1]
     if len(sys.argv) > 2:
@@ -75,20 +97,20 @@ if __name__ == "__main__":
         maskfile = None
 
     
-    print '''
+    print('''
 
     ====================Read Header======================
 
-    '''
+    ''')
 
     if PROFILE:
         pr = cProfile.Profile()
         pr.enable()
 
-    readheadercmd = 'readfile %s' % filename
-    print readheadercmd
+    readheadercmd = 'readfile %s | iconv --to-code utf-8//IGNORE' % filename
+    print(readheadercmd)
     output = getoutput(readheadercmd)
-    print output
+    print(output)
     header = {}
     for line in output.split('\n'):
         items = line.split("=")
@@ -98,17 +120,17 @@ if __name__ == "__main__":
 
     if PROFILE:
         pr.disable()
-        s = StringIO.StringIO()
+        s = StringIO()
         sortby = 'cumulative'
         ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
         ps.print_stats()
-        print s.getvalue()
+        print(s.getvalue())
 
-    print '''
+    print('''
 
     ============Generate Dedispersion Plan===============
 
-    '''
+    ''')
     if PROFILE:
         pr = cProfile.Profile()
         pr.enable()
@@ -126,47 +148,33 @@ if __name__ == "__main__":
             query("what is the total bandwidth?", BandWidth, float)
             query("what is the size of each time sample in us?", tsamp*1.e6, float)
             query("what's the center frequency?", fcenter, float)
-            print 'see how these numbers are used in the next step.'
-            print ''
-
-        ddplancmd = 'DDplan.py -d %(maxDM)s -n %(Nchan)d -b %(BandWidth)s -t %(tsamp)f -f %(fcenter)f -s %(Nsub)s -o DDplan.ps' % {
-                'maxDM':maxDM, 'Nchan':Nchan, 'tsamp':tsamp, 'BandWidth':BandWidth, 'fcenter':fcenter, 'Nsub':Nsub}
-        print ddplancmd
-        ddplanout = getoutput(ddplancmd)
-        print ddplanout
-        planlist = ddplanout.split('\n')
-        ddplan = []
-        planlist.reverse()
-        for plan in planlist:
-            if plan == '':
-                continue
-            elif plan.strip().startswith('Low DM'):
-                break
-            else:
-                ddplan.append(plan)
-        ddplan.reverse()
+            print('see how these numbers are used in the next step.')
+            print('')
+
+        ddplan = planner.plan(maxDM, Nchan, tsamp, BandWidth, fcenter, Nsub)
+        ddplanout = '\n'.join(planner.table(ddplan))
+        print(ddplanout)
+        if DDPLAN_PLOT:
+            planner.draw('DDplan.ps', maxDM, Nchan, tsamp, BandWidth, fcenter, Nsub)
     except:
-        print 'failed at generating DDplan.'
+        print('failed at generating DDplan.')
         sys.exit(0)
 
 
     if Tutorial_Mode:
-        calls = 0
-        for line in ddplan:
-            ddpl = line.split()
-            calls += int(ddpl[7])
+        calls = int(ddplan['calls'].sum())
         query("According to the DDplan, how many times in total do we have to call prepsubband?", calls, int)
-        print 'see how these numbers are used in the next step.'
-        print ''
+        print('see how these numbers are used in the next step.')
+        print('')
 
 
     if PROFILE:
         pr.disable()
-        s = StringIO.StringIO()
+        s = StringIO()
         sortby = 'cumulative'
         ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
         ps.print_stats()
-        print s.getvalue()
+        print(s.getvalue())
 
 
 
@@ -180,35 +188,29 @@ if __name__ == "__main__":
 
     #Multiprocessing Pool definition
     #Made this way to have only one pool along the entire script
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-        
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
     
-    print '''
+    print('''
 
     ================Dedisperse Subbands==================
 
-    '''
+    ''')
 
     if PROFILE:
         pr = cProfile.Profile()
         pr.enable()
 
     try:
+        #Completed tasks of an earlier run are skipped
+        manifest = Manifest('manifest.jsonl')
         logfile = open('dedisperse.log', 'wt')
-        for line in ddplan:
-            ddpl = line.split()
-            lowDM = float(ddpl[0])
-            hiDM = float(ddpl[1])
-            dDM = float(ddpl[2])
-            DownSamp = int(ddpl[3])
-            NDMs = int(ddpl[6])
-            calls = int(ddpl[7])
+        for plan in ddplan:
+            lowDM = float(plan['lowDM'])
+            hiDM = float(plan['hiDM'])
+            dDM = float(plan['dDM'])
+            DownSamp = int(plan['DownSamp'])
+            NDMs = int(plan['DMs_per_call'])
+            calls = int(plan['calls'])
             Nout = Nsamp/DownSamp 
             Nout -= (Nout % 500)
             dmlist = np.split(np.arange(lowDM, hiDM, dDM), calls)
@@ -217,33 +219,34 @@ if __name__ == "__main__":
             datdownsamp = 2
             if DownSamp < 2: subdownsamp = datdownsamp = 1                
             function = partial(prepsubband_f, lowDM, dDM, NDMs, Nout, subdownsamp, datdownsamp, filename, maskfile) # for passing several params to Executor.map
+            dmlist = manifest.pending(dmlist, lambda dml: 'prepsubband:'+dat_names(dml[0], dDM, NDMs)[0])
             result = pool.map(function, dmlist)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
+            for dml, (output, stdout) in zip(dmlist, result):
+                logfile.write(output)
+                sys.stdout.write(stdout)
+                datfiles = dat_names(dml[0], dDM, NDMs)
+                manifest.record('prepsubband:'+datfiles[0], stdout, dedisperse_outputs(datfiles))
             
         os.system('rm *.sub*')
         logfile.close()
+        manifest.close()
 
     except Exception as e:
-        print 'failed at prepsubband.', e
+        print('failed at prepsubband.', e)
         os.chdir(cwd)
         sys.exit(0)
 
 
     if PROFILE:
         pr.disable()
-        s = StringIO.StringIO()
+        s = StringIO()
         sortby = 'cumulative'
         ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
         ps.print_stats()
-        print s.getvalue()
+        print(s.getvalue())
         
     #===========================
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
 
@@ -8,8 +8,15 @@ zhuwwpku@gmail.com
 Modified by EAFIT University's team, ASC20-21
 2020-12-29
 """
-import os, sys, glob, re
-from commands import getoutput
+import os, sys
+# With PIPELINE_JOBSERVER set, this run is handed to the warm job server before the slow imports below (see jobserver.py)
+if __name__ == "__main__" and os.environ.get('PIPELINE_JOBSERVER'):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from jobserver import submit
+    sys.exit(submit(os.environ['PIPELINE_JOBSERVER'], __file__, sys.argv))
+
+import glob, re
+from subprocess import getoutput
 import numpy as np
 
 # Since we are using PRESTO v3.0.1
@@ -17,15 +24,17 @@ from presto import sifting
 from operator import attrgetter
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from manifest import Manifest
+from executor import get_executor, parse_args
+
 #For profiling
-import cProfile, pstats, StringIO
+import cProfile, pstats
+from io import StringIO
 PROFILE = True #Change to False unless you need to find out bottlenecks
-ENABLE_MPI = False #In case of running with MPI
 
 #Tutorial_Mode = True
 Tutorial_Mode = False
@@ -40,12 +49,12 @@ zmax = 0
 #=====FUNCTION DEFINITIONS=====
 
 def query(question, answer, input_type):
-    print "Based on output of the last step, answer the following questions:"
+    print("Based on output of the last step, answer the following questions:")
     Ntry = 3
-    while not input_type(raw_input("%s:" % question)) == answer and Ntry > 0:
+    while not input_type(input("%s:" % question)) == answer and Ntry > 0:
         Ntry -= 1
-        print "try again..."
-    if Ntry == 0:print "The correct answer is:", answer
+        print("try again...")
+    if Ntry == 0:print("The correct answer is:", answer)
 
 
 def realfft(df): 
@@ -54,6 +63,8 @@ def realfft(df):
     return getoutput(fftcmd), stdout
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
 
     #===========================================
     #Changing to 'subbands' where the results are saved
@@ -63,20 +74,13 @@ if __name__ == "__main__":
         os.mkdir(working_dir)
     os.chdir(working_dir)
 
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
 
-    print '''
+    print('''
 
     ================fft-search subbands==================
 
-    '''                     
+    ''')                     
 
     try:
 
@@ -84,29 +88,30 @@ if __name__ == "__main__":
             pr = cProfile.Profile()
             pr.enable()
 
-        datfiles = glob.glob("*.dat")
+        #Completed tasks of an earlier run are skipped
+        manifest = Manifest('manifest.jsonl')
+        datfiles = manifest.pending(glob.glob("*.dat"), lambda df: 'realfft:'+df)
         with open('fft.log', 'wt') as logfile:
             result = pool.map(realfft, datfiles)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
+            for df, (output, stdout) in zip(datfiles, result):
+                logfile.write(output)
+                sys.stdout.write(stdout)
+                manifest.record('realfft:'+df, stdout, [df[:-4]+'.fft'])
+        manifest.close()
 
         if PROFILE:
             pr.disable()
-            s = StringIO.StringIO()
+            s = StringIO()
             sortby = 'cumulative'
             ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
             ps.print_stats()
-            print s.getvalue()
+            print(s.getvalue())
         
     except Exception as e:
-        print 'failed at fft search.', e
+        print('failed at fft search.', e)
         os.chdir(cwd)
         sys.exit(0)
 
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
 
     os.chdir(cwd)
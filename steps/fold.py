@@ -8,8 +8,15 @@ zhuwwpku@gmail.com
 Modified by EAFIT University's team, ASC20-21
 2020-12-29
 """
-import os, sys, glob, re
-from commands import getoutput
+import os, sys
+# With PIPELINE_JOBSERVER set, this run is handed to the warm job server before the slow imports below (see jobserver.py)
+if __name__ == "__main__" and os.environ.get('PIPELINE_JOBSERVER'):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from jobserver import submit
+    sys.exit(submit(os.environ['PIPELINE_JOBSERVER'], __file__, sys.argv))
+
+import glob, re
+from subprocess import getoutput
 import numpy as np
 
 # Since we are using PRESTO v3.0.1
@@ -17,15 +24,19 @@ from presto import sifting
 from operator import attrgetter
 
 # For multiprocessing (parallelism)
-from mpi4py.futures import MPIPoolExecutor
-from mpi4py import MPI
-import multiprocessing as mp
 from functools import partial
 
+# The shared pipeline modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from manifest import Manifest
+from results import ResultsIndex, by_sigma
+from scheduler import unordered_results
+from executor import get_executor, parse_args
+
 #For profiling
-import cProfile, pstats, StringIO
+import cProfile, pstats
+from io import StringIO
 PROFILE = True #Change to False unless you need to find out bottlenecks
-ENABLE_MPI = False
 
 #Tutorial_Mode = True
 Tutorial_Mode = False
@@ -40,12 +51,12 @@ zmax = 0
 #=====FUNCTION DEFINITIONS=====
 
 def query(question, answer, input_type):
-    print "Based on output of the last step, answer the following questions:"
+    print("Based on output of the last step, answer the following questions:")
     Ntry = 3
-    while not input_type(raw_input("%s:" % question)) == answer and Ntry > 0:
+    while not input_type(input("%s:" % question)) == answer and Ntry > 0:
         Ntry -= 1
-        print "try again..."
-    if Ntry == 0:print "The correct answer is:", answer
+        print("try again...")
+    if Ntry == 0:print("The correct answer is:", answer)
 
 def ACCEL_sift(zmax):
     '''
@@ -97,7 +108,7 @@ def ACCEL_sift(zmax):
         dmstrs = [x.split("DM")[-1].split("_")[0] for x in candfiles]
     else:
         dmstrs = [x.split("DM")[-1].split(".inf")[0] for x in inffiles]
-    dms = map(float, dmstrs)
+    dms = list(map(float, dmstrs))
     dms.sort()
     dmstrs = ["%.2f"%x for x in dms]
 
@@ -124,6 +135,19 @@ def ACCEL_sift(zmax):
     return cands
 
 
+def fold_task(cand):
+    return 'prepfold:%s_%.12g' % (cand.DMstr, cand.p)
+
+
+def fold_prefix(cand):
+    # prepfold -p names its outputs <root>_DM<DMstr>_<P>ms_Cand.*; the period leaves out other candidates at the same DM
+    return '%s_DM%s_%.2fms_' % (rootname, cand.DMstr, cand.p * 1000.0)
+
+
+def fold_outputs(cand):
+    return glob.glob(fold_prefix(cand) + '*.pfd*')
+
+
 def prepfold(filename, cand):
     foldcmd = "prepfold -n %(Nint)d -nsub %(Nsub)d -dm %(dm)f -p %(period)f %(filfile)s -o %(outfile)s -noxwin -nodmsearch" % {
                 'Nint':Nint, 'Nsub':Nsub, 'dm':cand.DM,  'period':cand.p, 'filfile':filename, 'outfile':rootname+'_DM'+cand.DMstr} #full plots
@@ -132,6 +156,8 @@ def prepfold(filename, cand):
                      
 
 if __name__ == "__main__":
+    #--executor/--workers choose the pool backend (see executor.py)
+    backend, workers = parse_args(sys.argv)
 
     filename = sys.argv[1]
     if len(sys.argv) > 2:
@@ -147,11 +173,11 @@ if __name__ == "__main__":
         os.mkdir(working_dir)
     os.chdir(working_dir)
     
-    print '''
+    print('''
 
     ================sifting candidates==================
 
-    '''
+    ''')
     if PROFILE:
         pr = cProfile.Profile()
         pr.enable()
@@ -160,29 +186,22 @@ if __name__ == "__main__":
 
     if PROFILE:
         pr.disable()
-        s = StringIO.StringIO()
+        s = StringIO()
         sortby = 'cumulative'
         ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
         ps.print_stats()
-        print s.getvalue()
+        print(s.getvalue())
 
 
-    print '''
+    print('''
 
     ================folding candidates==================
 
-    '''
+    ''')
     
     #Multiprocessing Pool definition
     #Made this way to have only one pool along the entire script
-    if ENABLE_MPI:
-        comm = MPI.COMM_WORLD
-        nprocs = comm.Get_attr(MPI.UNIVERSE_SIZE)
-        pool = MPIPoolExecutor(max_workers=nprocs, wdir=working_dir)
-        
-    else:
-        cores = mp.cpu_count()
-        pool = mp.Pool(cores)
+    pool = get_executor(backend, workers, wdir=os.getcwd())
 
     
     if PROFILE:
@@ -192,33 +211,39 @@ if __name__ == "__main__":
 
     try:
         os.system('ln -s ../%s %s' % (filename, filename))
+        #Completed tasks of an earlier run are skipped
+        manifest = Manifest('manifest.jsonl')
+        #Folded highest sigma first, each one published to results.jsonl/.txt as it finishes
+        index = ResultsIndex('results.jsonl')
+        cands = by_sigma(manifest.pending(cands, fold_task))
         with open('folding.log', 'wt') as logfile:
             function = partial(prepfold, filename)
-            result = pool.map(function, cands)
-            output, stdout = zip(*result)
-            logfile.writelines(output)
-            sys.stdout.writelines(stdout)
+            for cand, (output, stdout) in unordered_results(pool, function, cands, len(cands)):
+                logfile.write(output)
+                sys.stdout.write(stdout)
+                outputs = fold_outputs(cand)
+                manifest.record(fold_task(cand), stdout, outputs)
+                index.publish(cand, outputs)
+        index.close()
+        manifest.close()
             
     except:
-        print 'failed at folding candidates.'
+        print('failed at folding candidates.')
         os.chdir(cwd)
         sys.exit(0)
 
 
     if PROFILE:
         pr.disable()
-        s = StringIO.StringIO()
+        s = StringIO()
         sortby = 'cumulative'
         ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
         ps.print_stats()
-        print s.getvalue()
+        print(s.getvalue())
 
         
     #===========================
     #Since we moved to 'subbands', let's come back
     os.chdir(cwd)
     
-    if ENABLE_MPI:
-        pool.shutdown(wait = False)
-    else:
-        pool.close()
+    pool.shutdown(wait = False)
@@ -0,0 +1,311 @@
+"""
+Task queue on a shared filesystem, for running across nodes without MPI
+
+The 'queue' executor backend (executor.py) writes every task to a queue
+directory on a filesystem all the nodes mount, and workers started on
+any node, at any time, take tasks from it:
+
+    export PIPELINE_QUEUE_DIR=/scratch/$USER/queue
+    python taskqueue.py --processes 32 &                  # on each node, any time
+    python mpi_pipeline_py3.py --executor queue obs.fits
+
+The queue is plain files, one per task, moved between directories with
+rename(), which is atomic on a shared filesystem (locks and SQLite on NFS
+are not to be trusted):
+
+    pending/<task>            waiting; a worker claims it by renaming it to
+    running/<task>@<worker>   its lease, touched by the worker as it runs
+    done/<task>               the pickled result, picked up by the executor
+    workers/<worker>          touched by every live worker
+
+A worker that stops touching a lease for LEASE seconds (its node died,
+or it was killed) has its task put back in pending/ by the executor.
+SIGTERM tells a worker to finish its task and exit, so nodes can be
+added and drained mid-run.
+
+Functions from the pipeline script itself are found the way
+multiprocessing's spawn finds them: the worker runs the submitting
+script as '__mp_main__', which defines them without running its main
+block. A task runs in the submitter's working directory (or the wdir
+given to the executor).
+"""
+import os
+import sys
+import time
+import types
+import pickle
+import runpy
+import signal
+import socket
+import itertools
+import threading
+import multiprocessing as mp
+from concurrent.futures import Executor, Future, InvalidStateError
+
+POLL = 0.5 #Seconds between looks at the queue, by workers and the executor
+HEARTBEAT = 10.0 #Seconds between touches of a worker's lease and heartbeat file
+LEASE = 60.0 #A task whose lease is not touched for this long is put back in the queue
+
+
+def makedirs(path):
+    for subdir in ('pending', 'running', 'done', 'workers'):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+
+def write_file(path, data):
+    # readers only ever see a complete file
+    tmpfile = os.path.join(os.path.dirname(path), '.%s.tmp' % os.path.basename(path))
+    with open(tmpfile, 'wb') as f:
+        f.write(data)
+    os.rename(tmpfile, path)
+
+
+def live_workers(path):
+    """Names of the workers that have touched their heartbeat file within the lease."""
+    now = time.time()
+    names = []
+    for name in os.listdir(os.path.join(path, 'workers')):
+        try:
+            if now - os.stat(os.path.join(path, 'workers', name)).st_mtime < LEASE:
+                names.append(name)
+        except OSError:
+            pass # exited while we looked
+    return names
+
+
+class QueueExecutor(Executor):
+    """
+    Runs tasks on the taskqueue.py workers serving the queue directory
+    path. 'workers' is the number of live workers unless set.
+    """
+
+    def __init__(self, path, wdir=None, workers=None):
+        self.path = os.path.abspath(path)
+        self.wdir = wdir
+        self.fixed_workers = workers
+        makedirs(self.path)
+        self.prefix = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.counter = itertools.count()
+        self.futures = {} # task name -> future
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    @property
+    def workers(self):
+        return self.fixed_workers or max(1, len(live_workers(self.path)))
+
+    def submit(self, fn, *args, **kwargs):
+        # named by submission time, so workers take tasks first come first served
+        name = '%017.6f-%s-%d' % (time.time(), self.prefix, next(self.counter))
+        main = getattr(sys.modules['__main__'], '__file__', None)
+        task = (main and os.path.abspath(main), self.wdir or os.getcwd(), pickle.dumps((fn, args, kwargs)))
+        future = Future()
+        future.add_done_callback(lambda future: self.cancelled(name, future))
+        with self.lock:
+            self.futures[name] = future
+        write_file(os.path.join(self.path, 'pending', name), pickle.dumps(task))
+        return future
+
+    def cancelled(self, name, future):
+        if future.cancelled():
+            try:
+                os.remove(os.path.join(self.path, 'pending', name)) # too late if a worker has it
+            except OSError:
+                pass
+
+    def collect(self):
+        # Hands finished tasks' results to their futures, and requeues tasks whose workers died
+        last_check = time.time()
+        while not self.stopped.wait(POLL):
+            with self.lock:
+                names = set(self.futures)
+            done = os.listdir(os.path.join(self.path, 'done'))
+            self.discard_extra(names, done)
+            for name in names.intersection(done):
+                result = os.path.join(self.path, 'done', name)
+                try:
+                    with open(result, 'rb') as f:
+                        ok, value = pickle.load(f)
+                except Exception as e:
+                    ok, value = False, e
+                os.remove(result)
+                with self.lock:
+                    future = self.futures.pop(name)
+                try:
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                except InvalidStateError:
+                    pass # cancelled after a worker took it
+            if time.time() - last_check > HEARTBEAT:
+                last_check = time.time()
+                self.requeue(names)
+
+    def discard_extra(self, names, done):
+        # the second result of a requeued task whose first was collected already; nothing will ever read it
+        for name in done:
+            if name.startswith('.') or name in names or '-%s-' % self.prefix not in name:
+                continue
+            with self.lock:
+                if name in self.futures:
+                    continue # submitted since names was taken
+            try:
+                os.remove(os.path.join(self.path, 'done', name))
+            except OSError:
+                pass
+
+    def requeue(self, names):
+        for lease in os.listdir(os.path.join(self.path, 'running')):
+            name = lease.split('@')[0]
+            if name not in names:
+                continue
+            path = os.path.join(self.path, 'running', lease)
+            try:
+                if time.time() - os.stat(path).st_mtime > LEASE:
+                    os.rename(path, os.path.join(self.path, 'pending', name))
+                    print('taskqueue: worker %s stopped; requeued %s' % (lease.split('@')[1], name))
+            except OSError:
+                pass # finished or requeued meanwhile
+
+    def shutdown(self, wait=True):
+        if wait:
+            with self.lock:
+                futures = list(self.futures.values())
+            for future in futures:
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+        self.stopped.set()
+
+
+class Worker(object):
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = '%s.%d' % (socket.gethostname(), os.getpid())
+        self.heartbeat = os.path.join(self.path, 'workers', self.name)
+        self.lease = None
+        self.mains = {} # script path -> its '__mp_main__' module
+        self.draining = False
+
+    def claim(self):
+        """The name of a pending task this worker now holds, or None."""
+        for name in sorted(os.listdir(os.path.join(self.path, 'pending'))):
+            if name.startswith('.'):
+                continue
+            lease = os.path.join(self.path, 'running', '%s@%s' % (name, self.name))
+            try:
+                os.rename(os.path.join(self.path, 'pending', name), lease)
+                os.utime(lease) # the pending file's mtime is when it was submitted
+            except OSError:
+                continue # another worker got it first, or it looked stale and was requeued
+            self.lease = lease
+            return name
+        return None
+
+    def touch(self):
+        while True:
+            for path in (self.heartbeat, self.lease):
+                if path is not None:
+                    try:
+                        os.utime(path)
+                    except OSError:
+                        pass # the lease was requeued or finished
+            time.sleep(HEARTBEAT)
+
+    def main_module(self, main):
+        # the submitting script, as multiprocessing's spawn would load it
+        if main not in self.mains:
+            sys.path.insert(0, os.path.dirname(main))
+            module = types.ModuleType('__mp_main__')
+            module.__dict__.update(runpy.run_path(main, run_name='__mp_main__'))
+            self.mains[main] = module
+        return self.mains[main]
+
+    def run(self, name):
+        with open(self.lease, 'rb') as f:
+            main, cwd, payload = pickle.load(f)
+        try:
+            if main is not None:
+                sys.modules['__main__'] = sys.modules['__mp_main__'] = self.main_module(main)
+            fn, args, kwargs = pickle.loads(payload)
+            os.chdir(cwd)
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            data = pickle.dumps(result)
+        except Exception as e:
+            data = pickle.dumps((False, RuntimeError('unpicklable result of %s: %s' % (name, e))))
+        write_file(os.path.join(self.path, 'done', name), data)
+        lease, self.lease = self.lease, None
+        try:
+            os.remove(lease)
+        except OSError:
+            pass # requeued while we ran; the first result to arrive is kept
+
+    def drain(self, signum, frame):
+        self.draining = True
+
+    def serve(self, idle_exit=None):
+        '''Run tasks until SIGTERM, or until idle for idle_exit seconds.'''
+        signal.signal(signal.SIGTERM, self.drain)
+        write_file(self.heartbeat, b'')
+        threading.Thread(target=self.touch, daemon=True).start()
+        idle_since = time.time()
+        try:
+            while not self.draining:
+                name = self.claim()
+                if name is not None:
+                    self.run(name)
+                    idle_since = time.time()
+                elif idle_exit is not None and time.time() - idle_since > idle_exit:
+                    break
+                else:
+                    time.sleep(POLL)
+        except KeyboardInterrupt:
+            if self.lease is not None:
+                try:
+                    os.rename(self.lease, os.path.join(self.path, 'pending', os.path.basename(self.lease).split('@')[0]))
+                except OSError:
+                    pass # the executor already requeued it
+        finally:
+            os.remove(self.heartbeat)
+
+
+def work(path, idle_exit):
+    Worker(path).serve(idle_exit)
+
+
+if __name__ == "__main__":
+
+    processes = mp.cpu_count()
+    idle_exit = None
+    args = sys.argv[1:]
+    for flag in ('--processes', '--idle-exit'):
+        if flag in args:
+            ii = args.index(flag)
+            if flag == '--processes':
+                processes = int(args[ii+1])
+            else:
+                idle_exit = float(args[ii+1])
+            del args[ii:ii+2]
+    path = args[0] if args else os.environ.get('PIPELINE_QUEUE_DIR')
+    if path is None:
+        sys.exit('usage: python taskqueue.py [--processes N] [--idle-exit SECONDS] [QUEUE_DIR]')
+    makedirs(path)
+
+    workers = [mp.Process(target=work, args=(path, idle_exit)) for ii in range(processes)]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: [w.terminate() for w in workers]) # drains them
+    for worker in workers:
+        while worker.is_alive():
+            try:
+                worker.join()
+            except KeyboardInterrupt:
+                pass # the workers got it too and requeue their tasks
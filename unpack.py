@@ -0,0 +1,76 @@
+"""
+Lookup-table unpacking of 1, 2, 4 and 8-bit samples
+
+Search-mode data are mostly 2 or 4 bits per sample, several samples to
+a byte, most significant first. Shifting and masking them out costs a
+pass over the data per sample in a byte; a 256-entry table of what each
+byte value holds expands a whole block with one np.take instead.
+
+With a scale and offset per channel (PSRFITS's DAT_SCL and DAT_OFFS, and
+DAT_WTS folded into both) the table has a row of 256 entries for every
+byte of a spectrum, already scaled for the channels that byte holds, so
+the float32 output is scaled in the same pass. Outputs can be given, so
+a reader can unpack block after block into one buffer.
+
+    python bench_unpack.py
+
+measures the throughput in GB/s.
+"""
+from functools import lru_cache
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def bit_table(nbits, dtype=np.float32):
+    '''(256, 8 // nbits): the samples packed in each byte value, most significant first.'''
+    values = np.arange(256, dtype=np.uint16)[:, None]
+    shifts = np.arange(8 - nbits, -1, -nbits, dtype=np.uint16)
+    table = ((values >> shifts) & ((1 << nbits) - 1)).astype(dtype)
+    table.flags.writeable = False # shared by every caller
+    return table
+
+
+def unpack(packed, nbits, dtype=np.uint8):
+    """The samples of nbits in the bytes of packed, one per element along its last axis."""
+    packed = np.asarray(packed, dtype=np.uint8)
+    return bit_table(nbits, dtype)[packed].reshape(packed.shape[:-1] + (-1,))
+
+
+class Unpacker(object):
+    '''
+    Unpacks spectra of nchan samples of nbits (1, 2, 4 or 8) each into
+    float32, times scale plus offset (per channel, optional).
+    '''
+
+    def __init__(self, nbits, nchan, scale=None, offset=None):
+        if nbits not in (1, 2, 4, 8):
+            raise ValueError('cannot unpack %d-bit samples' % nbits)
+        self.nbits = nbits
+        self.nchan = nchan
+        self.per_byte = 8 // nbits
+        self.nbytes = nchan // self.per_byte
+        values = bit_table(nbits)
+        if scale is None and offset is None:
+            self.table = values
+            self.index = None
+        else:
+            # a row of the table per byte of a spectrum, for the channels in that byte
+            scale = np.broadcast_to(np.ones(nchan) if scale is None else scale, (nchan,)).reshape(self.nbytes, 1, self.per_byte)
+            offset = np.broadcast_to(np.zeros(nchan) if offset is None else offset, (nchan,)).reshape(self.nbytes, 1, self.per_byte)
+            self.table = (values[None] * scale + offset).astype(np.float32).reshape(self.nbytes * 256, self.per_byte)
+            self.index = np.arange(self.nbytes, dtype=np.intp) * 256
+
+    def __call__(self, packed, out=None):
+        '''
+        packed (nspec, nchan * nbits / 8 bytes) unpacked into out (a
+        C-contiguous float32 (nspec, nchan), allocated if not given).
+        '''
+        packed = np.asarray(packed, dtype=np.uint8).reshape(-1, self.nbytes)
+        if out is None:
+            out = np.empty((len(packed), self.nchan), dtype=np.float32)
+        view = out.reshape(len(packed), self.nbytes, self.per_byte)
+        if self.index is None:
+            np.take(self.table, packed, axis=0, out=view, mode='clip')
+        else:
+            np.take(self.table, packed + self.index, axis=0, out=view, mode='clip')
+        return out